@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# chunker.py — 文の区切りを守り、トークン数で詰めるチャンク分割
+# 日本語コメント：
+#   固定長（800 文字 + 120 文字の重なり）だと文の途中で切れ、ページ境界で小さなチャンクができ、
+#   重なりの分（約15%）だけ埋め込みの計算が無駄になる。ここでは
+#     - 。！？（と閉じ括弧）・改行で文に分け、文の途中では切らない
+#     - 埋め込みモデルの最大系列長（トークン数）に収まるまで文を詰める（超えると後ろが切り捨てられて検索に効かないため）
+#     - 見出しらしい行の前では必ず区切り、段落（空行）の前ではチャンクが半分以上埋まっていれば区切る
+#     - 重なりは「1文だけで上限を超える」ときの分割にだけ使う
+#   ページは改行でつないで流すので、ページ境界では区切らない（ページ末の短い断片がチャンクにならない）。
+#   トークン数の数え方は呼び出し側が渡す（rag.py はモデルのトークナイザ。無ければ estimate_tokens）。
+import re
+from typing import Callable, List, Optional
+
+TokenCounter = Callable[[str], int]
+
+# 文末：。！？!?（直後の閉じ括弧・引用符も含める）。改行も区切り
+# 英文のピリオドは直後が空白のときだけ文末（"3.14" は切らない。数字の直後は "1. 導入" の番号とみなして切らない）。
+# 入力の終わりのピリオドは finish() で残りを1文にするので、ここでは空白が来るまで待つ（ストリームの途中で切らない）
+# 文末の記号だけに一致させ、文はその間を切り出す（文全体に一致させると、文末の無い長い入力で O(n²) になる）。
+# ピリオドの連続（目次の "......"）は先頭の1個からだけ試す
+_CLOSE = "[」』）)】〕\"'’”]"
+_SENT_END = re.compile(rf"[。！？!?]+{_CLOSE}*|(?<![0-9０-９.])\.+{_CLOSE}*(?=[^\S\n])|\n")
+# 見出しらしい行：「第1章」「1.」「1.2」「(1)」「■」「#」などで始まる短い行
+_HEADING = re.compile(r"^\s*(?:#{1,6}\s|第[0-9０-９一二三四五六七八九十百]+[章節部回講]|"
+                      r"[0-9０-９]+(?:[.．][0-9０-９]+)*[.．、)）]?\s|[(（][0-9０-９]+[)）]|[■□◆◇●○▼▶【])")
+_HEADING_MAX = 60  # これより長い行は見出しとみなさない
+_TOKEN_RE = re.compile(r"[぀-ヿ㐀-鿿豈-﫿＀-￯]|[A-Za-z]+|[0-9]+|\S")
+
+
+def estimate_tokens(text: str) -> int:
+    """日本語：トークナイザが無いときの見積もり（かな・漢字は1文字1トークン、英数字は1語1トークン）"""
+    return len(_TOKEN_RE.findall(text))
+
+def is_heading(line: str) -> bool:
+    s = line.strip()
+    return 0 < len(s) <= _HEADING_MAX and not s.endswith(("。", "、")) and bool(_HEADING.match(s))
+
+
+class SentenceChunker:
+    """
+    日本語：StreamChunker と同じ使い方（feed() で確定したチャンク、finish() で残り）。
+    max_tokens は1チャンクのトークン数の上限、overlap は長い1文を分割するときの重なり（トークン数）。
+    """
+
+    def __init__(self, max_tokens: int = 254, count_tokens: Optional[TokenCounter] = None,
+                 overlap: int = 32, min_fill: float = 0.5):
+        self.max_tokens = max(8, max_tokens)
+        self.count = count_tokens or estimate_tokens
+        self.overlap = min(overlap, self.max_tokens // 4)
+        self.min_fill = min_fill
+        self._buf = ""           # まだ文末が来ていない入力
+        self._cur: List[str] = []  # 詰めている途中のチャンク（文のリスト）
+        self._cur_tokens = 0
+        self._line_end = True    # 直前で行が終わっている（次の文は行頭から始まる）
+        self._blank = False      # 直前が空行（段落の区切り）
+
+    def feed(self, text: str) -> List[str]:
+        self._buf += text.replace("\r\n", "\n")
+        out: List[str] = []
+        # 文末は cap 文字ずつの窓で探し、見つからなかった所は探し直さない（1回の feed は入力の長さに比例する時間）
+        start = scan = 0
+        cap = 4 * self.max_tokens
+        while True:
+            m = _SENT_END.search(self._buf, scan, scan + cap + 1)
+            if m:
+                self._add(self._buf[start:m.end()], out)
+                start = scan = m.end()
+            elif len(self._buf) - scan > cap:
+                scan += cap
+            else:
+                break
+        rest = self._buf[start:]
+        # 文末の無い長い入力（表の行など）は上限の数倍たまったらそこで1文とみなす
+        if len(rest) > cap:
+            self._add(rest, out)
+            rest = ""
+        self._buf = rest
+        return out
+
+    def finish(self) -> List[str]:
+        out: List[str] = []
+        if self._buf:
+            self._add(self._buf, out)
+            self._buf = ""
+        self._flush(out)
+        return out
+
+    # --- 内部 ---
+    def _add(self, sent: str, out: List[str]):
+        s = sent.strip()
+        if not s:
+            self._blank = self._line_end  # 改行だけの行 = 空行
+            self._line_end = True
+            return
+        if self._line_end and sent.endswith("\n") and is_heading(s):
+            self._flush(out)  # 見出しは次の本文と同じチャンクの先頭に置く
+        elif self._blank and self._cur_tokens >= self.min_fill * self.max_tokens:
+            self._flush(out)
+        self._blank = False
+        self._line_end = sent.endswith("\n")
+        n = self.count(s)
+        if n > self.max_tokens:
+            self._flush(out)
+            out.extend(self._split_long(s, n))
+            return
+        if self._cur_tokens + n > self.max_tokens:
+            self._flush(out)
+        self._cur.append(s if not sent.endswith("\n") else s + "\n")
+        self._cur_tokens += n
+
+    def _flush(self, out: List[str]):
+        if self._cur:
+            chunk = "".join(self._cur).strip()
+            if chunk:
+                out.append(chunk)
+        self._cur, self._cur_tokens = [], 0
+
+    def _split_long(self, s: str, n: int) -> List[str]:
+        """日本語：上限を超える1文を、overlap トークン分だけ重ねながら上限以内に切る"""
+        per = len(s) / n  # 1トークンあたりの文字数（この文での平均）
+        size = max(1, int(self.max_tokens * per))
+        step = max(1, size - int(self.overlap * per))
+        out, i = [], 0
+        while i < len(s):
+            piece = s[i:i + size]
+            while len(piece) > 1 and self.count(piece) > self.max_tokens:
+                piece = piece[:int(len(piece) * 0.9)]
+            out.append(piece)
+            if i + len(piece) >= len(s):
+                break
+            i += max(1, min(step, len(piece) - int(self.overlap * per)))
+        return [p.strip() for p in out if p.strip()]
+
+
+def chunk_sentences(text: str, max_tokens: int = 254, count_tokens: Optional[TokenCounter] = None,
+                    overlap: int = 32) -> List[str]:
+    c = SentenceChunker(max_tokens, count_tokens, overlap)
+    return c.feed(text) + c.finish()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# emb_cache.py — 埋め込みの永続キャッシュ + 取り込み済みファイルの記録（SQLite）
+# 日本語コメント：
+#   - embeddings: (モデル名, チャンク本文の sha256) → float32 ベクトル
+#     同じ資料の再アップロードや、大半のページが同じ改訂版では埋め込み計算がほぼ表引きになる
+#   - files: ファイル内容の sha256 → 取り込み済み資料（同一ファイルは「取り込み済み」を返す）
+import hashlib, sqlite3, threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL, h TEXT NOT NULL, vec BLOB NOT NULL,
+    PRIMARY KEY (model, h)
+);
+CREATE TABLE IF NOT EXISTS files (
+    sha TEXT PRIMARY KEY, mat_id TEXT NOT NULL, title TEXT, kind TEXT,
+    chunks INTEGER, created_at TEXT
+);
+"""
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """日本語：スレッドごとに接続を持つ SQLite キャッシュ（複数ワーカーからも共有可）"""
+
+    def __init__(self, path: str, model_name: str):
+        self.path = path
+        self.model = model_name
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []  # close() で閉じるため（スレッドごとの接続すべて）
+        self._conns_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def close(self):
+        """日本語：全スレッドの接続を閉じる（使われなくなったテナントをメモリから外すとき）"""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    # --- 埋め込み ---
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, np.ndarray]:
+        hashes = list(dict.fromkeys(hashes))
+        out: Dict[str, np.ndarray] = {}
+        conn = self._conn()
+        for i in range(0, len(hashes), 500):  # SQLite の変数上限を避けて分割
+            part = hashes[i:i + 500]
+            rows = conn.execute(
+                f"SELECT h, vec FROM embeddings WHERE model = ? AND h IN ({','.join('?' * len(part))})",
+                (self.model, *part),
+            ).fetchall()
+            for h, blob in rows:
+                out[h] = np.frombuffer(blob, dtype="float32")
+        return out
+
+    def put_many(self, items: List[Tuple[str, np.ndarray]]) -> None:
+        if not items:
+            return
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, h, vec) VALUES (?, ?, ?)",
+                [(self.model, h, np.asarray(v, dtype="float32").tobytes()) for h, v in items],
+            )
+
+    # --- 取り込み済みファイル ---
+    def lookup_file(self, sha: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            "SELECT mat_id, title, kind, chunks, created_at FROM files WHERE sha = ?", (sha,)
+        ).fetchone()
+        if not row:
+            return None
+        return {"mat_id": row[0], "title": row[1], "kind": row[2], "chunks": row[3], "created_at": row[4]}
+
+    def remember_file(self, sha: str, mat_id: str, title: str, kind: str, chunks: int) -> None:
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files (sha, mat_id, title, kind, chunks, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (sha, mat_id, title, kind, chunks, datetime.utcnow().isoformat()),
+            )
+
+    def forget_material(self, mat_id: str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM files WHERE mat_id = ?", (mat_id,))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# embedder.py — 埋め込み計算のマイクロバッチ化
+# 日本語コメント：
+#   検索は1リクエスト1クエリなので、同時に来たリクエストがそれぞれ model.encode([1文]) を呼ぶと
+#   バッチ化の効かない小さな計算を何本も並べることになる。ここでは
+#     - encode() を呼んだスレッドはキューに入れて結果を待つ
+#     - 専用スレッドが最初の1件から ENCODE_MAX_WAIT_MS だけ（または ENCODE_MAX_BATCH 件たまるまで）待ってまとめ、
+#       1回の model.encode で計算して各呼び出し元へ切り分けて返す
+#   すでに ENCODE_MAX_BATCH 件以上ある呼び出し（取り込み時のチャンク列）は待たせずにそのまま計算する。
+import os, queue, threading, time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+
+ENCODE_MAX_BATCH = int(os.getenv("RAG_ENCODE_MAX_BATCH", "32"))
+ENCODE_MAX_WAIT_MS = float(os.getenv("RAG_ENCODE_MAX_WAIT_MS", "5"))
+ENCODE_BATCHING = os.getenv("RAG_ENCODE_BATCHING", "1") != "0"
+
+EncodeFn = Callable[[List[str]], np.ndarray]
+
+
+class BatchEncoder:
+    """
+    日本語：同時に来た encode 要求を束ねて fn（texts → (n, dim) の配列）に渡す。スレッドセーフ。
+    fn はこのクラスの専用スレッドからしか呼ばれない（max_batch 以上の大きな要求を除く）。
+    """
+
+    def __init__(self, fn: EncodeFn, max_batch: int = ENCODE_MAX_BATCH, max_wait_ms: float = ENCODE_MAX_WAIT_MS,
+                 enabled: bool = ENCODE_BATCHING):
+        self._fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.enabled = enabled and max_batch > 1
+        self._q: "queue.Queue[tuple]" = queue.Queue()  # (texts, Future)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0  # 計算したバッチ数（統計）
+        self.items = 0    # その中の文の数
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        if not self.enabled or not texts or len(texts) >= self.max_batch:
+            return self._fn(texts)
+        fut: Future = Future()
+        self._ensure_started()
+        self._q.put((texts, fut))
+        return fut.result()
+
+    def stats(self) -> Dict:
+        return {"batches": self.batches, "items": self.items,
+                "mean_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "max_batch": self.max_batch, "max_wait_ms": self.max_wait * 1000.0, "enabled": self.enabled}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True, name="embed-batcher")
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            reqs = [self._q.get()]
+            n = len(reqs[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while n < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    # 締め切りまでは待ち、過ぎたら（前のバッチの計算中に）たまっている分だけ取る
+                    r = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+                except queue.Empty:
+                    break
+                reqs.append(r)
+                n += len(r[0])
+            texts = [t for ts, _ in reqs for t in ts]
+            try:
+                out = self._fn(texts)
+            except BaseException as e:
+                for _, fut in reqs:
+                    fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(texts)
+            off = 0
+            for ts, fut in reqs:
+                fut.set_result(out[off:off + len(ts)])
+                off += len(ts)
+
+
+# =============================================================================
+# ベンチマーク：python -m backend.embedder [最大同時数] [1スレッドあたりの要求数]
+#   同時数ごとに「直接 model.encode」と「マイクロバッチ（待ち時間別）」のスループット・遅延を測る
+# =============================================================================
+def _run(encode: EncodeFn, concurrency: int, per_thread: int) -> Dict:
+    lat: List[float] = []
+    lat_lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+
+    def worker(k: int):
+        mine = []
+        start.wait()
+        for j in range(per_thread):
+            t0 = time.perf_counter()
+            encode([f"講義資料の検索クエリ {k}-{j}：固有値と固有ベクトルの求め方"])
+            mine.append(time.perf_counter() - t0)
+        with lat_lock:
+            lat.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    for th in threads:
+        th.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for th in threads:
+        th.join()
+    sec = time.perf_counter() - t0
+    ms = np.array(lat) * 1000.0
+    return {"concurrency": concurrency, "requests": len(lat), "qps": round(len(lat) / sec, 1),
+            "p50_ms": round(float(np.percentile(ms, 50)), 2), "p95_ms": round(float(np.percentile(ms, 95)), 2)}
+
+def bench(fn: EncodeFn, max_concurrency: int = 32, per_thread: int = 20,
+          waits_ms: Sequence[float] = (0.0, 2.0, 5.0, 10.0), max_batch: int = ENCODE_MAX_BATCH) -> List[Dict]:
+    fn(["warm up"])
+    levels = [1]
+    while levels[-1] * 2 <= max_concurrency:
+        levels.append(levels[-1] * 2)
+    rows = []
+    for c in levels:
+        rows.append({"mode": "direct", **_run(fn, c, per_thread)})
+        for w in waits_ms:
+            enc = BatchEncoder(fn, max_batch=max_batch, max_wait_ms=w, enabled=True)
+            r = _run(enc.encode, c, per_thread)
+            rows.append({"mode": "batched", "max_wait_ms": w, **r, "mean_batch": enc.stats()["mean_batch"]})
+    return rows
+
+
+if __name__ == "__main__":
+    import json, sys
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(os.getenv("RAG_EMB_MODEL", "sentence-transformers/all-MiniLM-L6-v2"))
+
+    def fn(texts):
+        return np.array(model.encode(texts, normalize_embeddings=True), dtype="float32")
+
+    mc = int(sys.argv[1]) if len(sys.argv) >= 2 else 32
+    pt = int(sys.argv[2]) if len(sys.argv) >= 3 else 20
+    for row in bench(fn, mc, pt):
+        print(json.dumps(row, ensure_ascii=False))
@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+# ingest.py — 資料取り込みのバックグラウンドパイプライン
+# 日本語コメント：
+#   /api/materials/upload はジョブを投入して即 202 を返し、重い処理は以下の段で流す。
+#     抽出(ページ単位) → 分割 → 埋め込み(EMBED_BATCH 件ずつ) → FAISS 追加
+#   段と段の間は上限付きキュー（QUEUE_SIZE）なので、遅い段があれば前段が待つ（メモリが膨らまない）。
+#   進捗は /api/materials/{id}/status で参照でき、data/rag/jobs/<id>.json にも書き出す（他ワーカーから参照可）。
+#   フォルダ単位の一括取り込み（bulk_ingest / python -m backend.ingest <dir>）は下の「一括取り込み」を参照。
+#   ジョブは投入したテナントの索引へ取り込む（各段はジョブのテナントで動く）。投入待ちはテナントごとの列から
+#   順番に取り出すので、あるテナントがジョブを大量に積んでも他のテナントのジョブは待たされない。
+#   テナントごとの待ち/実行中のジョブ数は TENANT_MAX_JOBS まで。
+import os, sys, json, hashlib, queue, threading, time, uuid
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from . import rag, tenants
+from .locks import FileLock
+
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", str(rag.EMBED_BATCH)))
+JOBS_DIR = os.path.join(rag.RAG_DIR, "jobs")  # 既定テナント（他のテナントは <テナントの rag>/jobs）
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+def _jobs_dir(tenant: Optional[str] = None) -> str:
+    path = os.path.join(rag.tenant_dir("rag", tenant), "jobs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+_END = object()  # ジョブ終端の目印（各段を順に流れる）
+
+
+class Job:
+    """日本語：1ファイル分の取り込みジョブ。id はそのまま資料の mat_id になる"""
+
+    def __init__(self, title: str, filepath: str, remove_if_duplicate: bool = False,
+                 replace_id: Optional[str] = None, namespaces: Optional[List[str]] = None):
+        self.id = replace_id or str(uuid.uuid4())
+        self.tenant = tenants.current()
+        self.title = title
+        self.filepath = filepath
+        self.remove_if_duplicate = remove_if_duplicate
+        self.replace = replace_id is not None  # 既存資料の差し替え（同じ mat_id で取り込み、最後に旧チャンクを消す）
+        self.namespaces = list(namespaces or [])  # "course:..." / "owner:..."
+        self.kind: Optional[str] = None
+        self.state = "queued"  # queued / running / done / error
+        self.pages_total: Optional[int] = None
+        self.pages_done = 0
+        self.chunks_total = 0     # 分割済み
+        self.chunks_embedded = 0  # 埋め込み済み（重複スキップ分を含む）
+        self.chunks_indexed = 0   # FAISS 反映済み（重複スキップ分を含む）
+        self.new_chunks = 0       # 実際に索引へ追加した数
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.fsha: Optional[str] = None
+        self.seen = set()  # 同じ資料内で既出のチャンク
+        self._saved_at = 0.0
+
+    @property
+    def failed(self) -> bool:
+        return self.state == "error"
+
+    @property
+    def mat(self) -> Dict[str, Any]:
+        return {"mat_id": self.id, "title": self.title, "filepath": self.filepath, "kind": self.kind,
+                "ns": self.namespaces}
+
+    def eta_sec(self) -> Optional[float]:
+        """日本語：ページ当たりのチャンク数から総チャンク数を見積もり、処理速度から残り時間を出す"""
+        if self.state != "running" or not (self.pages_total and self.pages_done and self.chunks_total):
+            return None
+        est_chunks = self.chunks_total * self.pages_total / self.pages_done
+        p = self.chunks_indexed / est_chunks
+        if p <= 0:
+            return None
+        return max(0.0, (time.time() - self.started_at) * (1 - p) / p)
+
+    def to_dict(self) -> Dict[str, Any]:
+        eta = self.eta_sec()
+        def iso(t):
+            return datetime.utcfromtimestamp(t).isoformat() if t else None
+        return {
+            "id": self.id, "title": self.title, "kind": self.kind, "namespaces": self.namespaces,
+            "state": self.state,
+            "pages_total": self.pages_total, "pages_done": self.pages_done,
+            "chunks_total": self.chunks_total, "chunks_embedded": self.chunks_embedded,
+            "chunks_indexed": self.chunks_indexed, "new_chunks": self.new_chunks,
+            "eta_sec": round(eta, 1) if eta is not None else None,
+            "created_at": iso(self.created_at), "started_at": iso(self.started_at),
+            "finished_at": iso(self.finished_at),
+            "error": self.error, "result": self.result,
+        }
+
+    def save(self, force: bool = False):
+        """日本語：状態ファイルを書き出す（進捗更新は1秒に1回まで）"""
+        now = time.time()
+        if not force and now - self._saved_at < 1.0:
+            return
+        self._saved_at = now
+        try:
+            rag._atomic_write(os.path.join(_jobs_dir(self.tenant), f"{self.id}.json"),
+                              json.dumps(self.to_dict(), ensure_ascii=False).encode("utf-8"))
+        except Exception as e:
+            print("[INGEST] failed to save job status:", e)
+
+    def fail(self, err: Any):
+        print(f"[INGEST] job {self.id} failed:", err)
+        self.state = "error"
+        self.error = str(err)
+        self.finished_at = time.time()
+        self.save(force=True)
+        _forget(self)
+
+    def finish(self, result: Dict[str, Any]):
+        self.state = "done"
+        self.result = result
+        self.finished_at = time.time()
+        self.save(force=True)
+        _forget(self)
+
+
+class _FairQueue:
+    """日本語：テナントごとの FIFO を順番に回って取り出すキュー（get() はテナントをまたいでラウンドロビン）"""
+
+    def __init__(self):
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()  # 先頭のテナントが次に取り出される
+        self._cv = threading.Condition()
+
+    def put(self, job: "Job"):
+        with self._cv:
+            self._queues.setdefault(job.tenant, deque()).append(job)
+            self._cv.notify()
+
+    def get(self) -> "Job":
+        with self._cv:
+            while not self._queues:
+                self._cv.wait()
+            tenant, q = next(iter(self._queues.items()))
+            job = q.popleft()
+            del self._queues[tenant]
+            if q:
+                self._queues[tenant] = q  # 残りがあれば最後尾へ回す
+            return job
+
+
+_jobs: Dict[str, Job] = {}  # 待ち/実行中のジョブだけ（終わったら _forget で外す）
+_jobs_lock = threading.Lock()
+_submit_q = _FairQueue()                                   # ジョブ投入（ジョブ自体は軽いので上限なし）
+_pages_q: "queue.Queue[tuple]" = queue.Queue(QUEUE_SIZE)   # (job, ページ文字列 | _END)
+_chunks_q: "queue.Queue[tuple]" = queue.Queue(QUEUE_SIZE)  # (job, [(chunk_id, 本文)] | _END)
+_index_q: "queue.Queue[tuple]" = queue.Queue(QUEUE_SIZE)   # (job, (vecs, rows, 処理チャンク数) | _END)
+_started = False
+
+
+# ---------- 各段 ----------
+def _extract_stage():
+    while True:
+        job = _submit_q.get()
+        with tenants.scope(job.tenant):  # このジョブの段はすべてジョブのテナントの索引・保存先を使う
+            try:
+                job.state = "running"
+                job.started_at = time.time()
+                job.save(force=True)
+                job.fsha, prev = rag.find_ingested_file(job.filepath)
+                if prev and not job.replace:
+                    rag.tag_material(prev["mat_id"], job.namespaces)  # 別の講義での再アップロードならタグを足す
+                    if job.remove_if_duplicate:
+                        try:
+                            os.remove(job.filepath)
+                        except Exception:
+                            pass
+                    job.finish({"ok": True, "already_indexed": True, "mat_id": prev["mat_id"],
+                                "chunks": prev["chunks"], "kind": prev["kind"]})
+                    continue
+                job.pages_total = rag.page_count(job.filepath)
+                job.kind, pages = rag.extract_pages_any(job.filepath)
+                for text in pages:
+                    _pages_q.put((job, text))  # 後段が詰まっていればここで待つ
+                    job.pages_done += 1
+                    job.save()
+            except Exception as e:
+                job.fail(e)
+            _pages_q.put((job, _END))
+
+def _chunk_stage():
+    chunkers: Dict[str, Any] = {}  # ジョブ ID → rag.new_chunker()
+    while True:
+        job, item = _pages_q.get()
+        try:
+            if item is _END:
+                c = chunkers.pop(job.id, None)
+                chunks = c.finish() if (c and not job.failed) else []
+            elif job.failed:
+                continue
+            else:
+                chunks = chunkers.setdefault(job.id, rag.new_chunker()).feed(item + "\n")
+            if chunks:
+                numbered = list(enumerate(chunks, start=job.chunks_total))
+                job.chunks_total += len(chunks)
+                _chunks_q.put((job, numbered))
+        except Exception as e:
+            job.fail(e)
+        if item is _END:
+            _chunks_q.put((job, _END))
+
+def _embed_stage():
+    pending: Dict[str, List] = {}
+
+    def run(job: Job, batch: List):
+        rows = rag.new_chunk_rows(job.mat, batch, job.seen)
+        vecs = rag.embed_rows(rows)
+        job.chunks_embedded += len(batch)
+        _index_q.put((job, (vecs, rows, len(batch))))
+
+    while True:
+        job, item = _chunks_q.get()
+        with tenants.scope(job.tenant):
+            try:
+                if item is _END:
+                    buf = pending.pop(job.id, [])
+                    if buf and not job.failed:
+                        run(job, buf)
+                elif not job.failed:
+                    buf = pending.setdefault(job.id, [])
+                    buf.extend(item)
+                    while len(buf) >= EMBED_BATCH:
+                        run(job, buf[:EMBED_BATCH])
+                        del buf[:EMBED_BATCH]
+            except Exception as e:
+                job.fail(e)
+            if item is _END:
+                _index_q.put((job, _END))
+
+def _index_stage():
+    while True:
+        job, item = _index_q.get()
+        with tenants.scope(job.tenant):
+            try:
+                if item is _END:
+                    if job.failed:
+                        continue
+                    if job.chunks_total == 0:
+                        job.fail("有効なテキストなし")
+                        continue
+                    result = {"ok": True, "mat_id": job.id, "chunks": job.chunks_total,
+                              "new_chunks": job.new_chunks, "kind": job.kind}
+                    if job.replace:
+                        result["removed_chunks"] = rag.finish_replace(job.id, job.filepath, job.seen)
+                    rag.remember_ingested_file(job.fsha, job.id, job.title, job.kind, job.chunks_total)
+                    job.finish(result)
+                elif not job.failed:
+                    vecs, rows, n = item
+                    rag.index_rows(vecs, rows)
+                    job.chunks_indexed += n
+                    job.new_chunks += len(rows)
+                    job.save()
+            except Exception as e:
+                job.fail(e)
+
+
+def _ensure_started():
+    global _started
+    with _jobs_lock:
+        if _started:
+            return
+        for fn in (_extract_stage, _chunk_stage, _embed_stage, _index_stage):
+            threading.Thread(target=fn, daemon=True, name=f"ingest{fn.__name__}").start()
+        _started = True
+
+
+# ---------- 公開関数 ----------
+def submit(title: str, filepath: str, remove_if_duplicate: bool = False,
+           replace_id: Optional[str] = None, namespaces: Optional[List[str]] = None) -> Job:
+    """
+    日本語：今のテナントへの取り込みジョブを投入してすぐ返す（replace_id を渡すとその資料の差し替え）。
+    テナントの待ち/実行中のジョブが TENANT_MAX_JOBS 件あるか、チャンク数が上限なら tenants.QuotaExceeded
+    """
+    _ensure_started()
+    rag.check_chunk_quota()
+    job = Job(title, filepath, remove_if_duplicate, replace_id, namespaces)
+    with _jobs_lock:
+        tenants.check_quota("ingest jobs", _active_jobs_locked(job.tenant), tenants.TENANT_MAX_JOBS)
+        _jobs[job.id] = job
+    job.save(force=True)
+    _submit_q.put(job)
+    return job
+
+def _forget(job: Job):
+    """日本語：終わったジョブを一覧から外す（状態は jobs/<id>.json に書き出し済みなので get_status はそこから返す）"""
+    job.seen = set()  # 後段のキューに残っている間も既出チャンクの集合は持たない
+    with _jobs_lock:
+        if _jobs.get(job.id) is job:  # 同じ資料の差し替えジョブが後から入っていれば残す
+            del _jobs[job.id]
+
+def _active_jobs_locked(tenant: str) -> int:
+    return sum(j.tenant == tenant and j.state in ("queued", "running") for j in _jobs.values())
+
+def check_quota() -> None:
+    """日本語：今のテナントがジョブを投入できなければ tenants.QuotaExceeded（アップロードを保存する前に呼ぶ）"""
+    rag.check_chunk_quota()
+    with _jobs_lock:
+        tenants.check_quota("ingest jobs", _active_jobs_locked(tenants.current()), tenants.TENANT_MAX_JOBS)
+
+def _own_job(job_id: str) -> Optional[Job]:
+    """日本語：このプロセスの、今のテナントのジョブ"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    return job if job is not None and job.tenant == tenants.current() else None
+
+def is_active(job_id: str) -> bool:
+    """日本語：このプロセスで取り込み中（待ち/実行中）か"""
+    job = _own_job(job_id)
+    return job is not None and job.state in ("queued", "running")
+
+def get_status(job_id: str) -> Optional[Dict[str, Any]]:
+    """日本語：このプロセスのジョブ、無ければ状態ファイル（他ワーカーが受けたジョブ）から返す"""
+    job = _own_job(job_id)
+    if job:
+        return job.to_dict()
+    try:
+        with open(os.path.join(_jobs_dir(), f"{os.path.basename(job_id)}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# =============================================================================
+# 一括取り込み（フォルダ / 複数ファイル）
+# 日本語コメント：
+#   1ファイルずつ submit すると、ファイルごとに抽出→埋め込み→保存（index の書き出し）が走る。ここでは
+#     - 抽出と分割を BULK_WORKERS 本のスレッドで並行に行い（大きい PDF は pdf_extract のプロセスプール）、
+#     - ファイルをまたいで BULK_EMBED_BATCH 件ずつ埋め込み、
+#     - index の保存は最後に1回だけ行う（rag.bulk_commit。BULK_CHECKPOINT_FILES > 0 ならその件数ごとにも保存）。
+#   進み具合は data/rag/bulk/<run_id>.json（既定テナント以外は <テナントの rag>/bulk/）にファイルごとに書く。
+#   中断しても同じ run_id でやり直せば、保存まで済んだファイル（done / skipped）は飛ばして続きから取り込む
+#   （保存前のファイルはやり直しになるが、埋め込みはキャッシュに残っているので再計算しない）。
+# =============================================================================
+BULK_WORKERS = int(os.getenv("INGEST_BULK_WORKERS", str(min(4, os.cpu_count() or 1))))
+BULK_EMBED_BATCH = int(os.getenv("INGEST_BULK_EMBED_BATCH", "256"))
+BULK_CHECKPOINT_FILES = int(os.getenv("INGEST_BULK_CHECKPOINT_FILES", "0"))  # 0 なら最後に1回だけ保存
+BULK_DIR = os.path.join(rag.RAG_DIR, "bulk")  # 既定テナント
+os.makedirs(BULK_DIR, exist_ok=True)
+MATERIAL_EXTS = (".pdf", ".docx", ".xlsx", ".xls", ".txt")
+
+# 一括取り込みはプロセス内でテナントごとに1本ずつ（run ごとのファイルロックで同じ run の二重実行も防ぐ）
+_bulk_locks = tenants.TenantMap(lambda t: threading.Lock(), idle_sec=None, name="bulk")
+
+
+def _bulk_path(run_id: str) -> str:
+    d = os.path.join(rag.tenant_dir("rag"), "bulk")
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, f"{os.path.basename(run_id)}.json")
+
+def _save_run(run: Dict[str, Any]):
+    run["updated_at"] = datetime.utcnow().isoformat()
+    rag._atomic_write(_bulk_path(run["id"]), json.dumps(run, ensure_ascii=False, indent=1).encode("utf-8"))
+
+def get_bulk_status(run_id: str) -> Optional[Dict[str, Any]]:
+    """日本語：一括取り込みのマニフェスト（ファイルごとの状態つき）。無ければ None"""
+    try:
+        with open(_bulk_path(run_id), "r", encoding="utf-8") as f:
+            run = json.load(f)
+    except (OSError, ValueError):
+        return None
+    counts: Dict[str, int] = {}
+    for f in run["files"]:
+        counts[f["state"]] = counts.get(f["state"], 0) + 1
+    return {**run, "counts": counts}
+
+def bulk_running(run_id: str) -> bool:
+    """日本語：run_id の一括取り込みがどこかのプロセスで実行中（または実行待ち）か"""
+    lock = FileLock(_bulk_path(run_id) + ".lock")
+    if not lock.acquire(blocking=False):
+        return True
+    lock.release()
+    return False
+
+def list_material_files(root: str) -> List[str]:
+    """日本語：root 以下の資料ファイル（MATERIAL_EXTS）をパス順に"""
+    out = []
+    for d, _, names in os.walk(root):
+        out += [os.path.join(d, n) for n in names if n.lower().endswith(MATERIAL_EXTS) and not n.startswith(".")]
+    return sorted(out)
+
+def dir_run_id(root: str) -> str:
+    """日本語：フォルダの一括取り込みの run_id（同じフォルダなら同じ ID = 再実行で続きから）"""
+    return "dir-" + hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()[:12]
+
+def create_bulk_run(paths: List[str], titles: Optional[List[str]] = None, namespaces: Optional[List[str]] = None,
+                    run_id: Optional[str] = None, remove_if_duplicate: bool = False,
+                    source: str = "upload") -> Dict[str, Any]:
+    """
+    日本語：一括取り込みのマニフェストを作る（run_id のマニフェストが既にあれば、未登録のファイルを足して返す）。
+    remove_if_duplicate=True なら取り込み済みと同じ内容のファイルは消す（アップロードで保存したコピー用）。
+    """
+    run = get_bulk_status(run_id) if run_id else None
+    if run is None:
+        run = {"id": run_id or str(uuid.uuid4()), "tenant": tenants.current(), "source": source, "state": "queued",
+               "namespaces": list(namespaces or []), "remove_if_duplicate": remove_if_duplicate,
+               "created_at": datetime.utcnow().isoformat(), "commits": 0, "files": []}
+    run.pop("counts", None)
+    known = {f["path"] for f in run["files"]}
+    for k, p in enumerate(paths):
+        p = os.path.abspath(p)
+        if p not in known:
+            title = titles[k] if titles else os.path.basename(p)
+            run["files"].append({"path": p, "title": title, "state": "pending", "mat_id": None,
+                                 "chunks": 0, "new_chunks": 0, "error": None})
+    _save_run(run)
+    return run
+
+def _extract_file(path: str) -> Tuple[str, Optional[Dict], str, List[str]]:
+    """日本語：(ファイル sha256, 取り込み済みならその記録, kind, チャンク列)。スレッドプールで実行"""
+    fsha, prev = rag.find_ingested_file(path)
+    if prev:
+        return fsha, prev, prev["kind"], []
+    kind, pages = rag.extract_pages_any(path)
+    if kind == "unknown":
+        raise ValueError("対応していない形式")
+    return fsha, None, kind, list(rag.iter_chunks(pages))
+
+def bulk_ingest(run_id: str, progress=None) -> Dict[str, Any]:
+    """
+    日本語：今のテナントのマニフェスト run_id の未完了ファイルを取り込む（同期。API からはスレッドで呼ぶ）。
+    progress(file_entry) を渡すとファイルの状態が変わるたびに呼ぶ。最後のマニフェストを返す。
+    """
+    run_lock = FileLock(_bulk_path(run_id) + ".lock")
+    if not run_lock.acquire(blocking=False):
+        raise RuntimeError(f"bulk run {run_id} is already running")
+    try:
+        with tenants.scope(tenants.current()), _bulk_locks.get():  # 実行中はテナントを使用中にしておく
+            return _bulk_ingest_locked(run_id, progress)
+    finally:
+        run_lock.release()
+
+def _bulk_ingest_locked(run_id: str, progress) -> Dict[str, Any]:
+    run = get_bulk_status(run_id)
+    if run is None:
+        raise KeyError(run_id)
+    run.pop("counts", None)
+    run["state"] = "running"
+    _save_run(run)
+    ns = run["namespaces"]
+    todo = [f for f in run["files"] if f["state"] not in ("done", "skipped")]
+    by_sha: Dict[str, str] = {}        # この実行で取り込んだファイル sha256 → mat_id（同じ内容の2つ目を飛ばす）
+    rows: List[Dict] = []              # 埋め込み待ちの行（ファイルをまたぐ）
+    pending_h: Dict[str, None] = {}    # rows にある本文ハッシュ
+    shared: List[Tuple[Dict, List[Tuple[int, str]]]] = []  # rows 内のチャンクを共有する資料（埋め込み後に記録）
+    indexed: List[Tuple[Dict, str, str]] = []  # 索引に入れたが未保存のファイル (entry, sha256, kind)
+
+    def note(f: Dict):
+        _save_run(run)
+        if progress:
+            progress(f)
+
+    def embed_pending():
+        if rows:
+            rag.index_rows(rag.embed_rows(rows), rows)
+            rows.clear()
+            pending_h.clear()
+        for mat, refs in shared:
+            rag.share_chunks(mat, refs)
+        shared.clear()
+
+    def commit():
+        # 保存できたファイルだけ「取り込み済み」として記録する（保存前に落ちたら次回やり直す）
+        embed_pending()
+        rag.flush_index()
+        run["commits"] += bool(indexed)
+        for f, fsha, kind in indexed:
+            rag.remember_ingested_file(fsha, f["mat_id"], f["title"], kind, f["chunks"])
+            f["state"] = "done"
+        indexed.clear()
+        _save_run(run)
+
+    def take(f: Dict, fut):
+        mat, new = None, []
+        try:
+            fsha, prev, kind, chunks = fut.result()
+            if prev or fsha in by_sha:
+                mat_id = prev["mat_id"] if prev else by_sha[fsha]
+                if prev:
+                    rag.tag_material(mat_id, ns)
+                if run["remove_if_duplicate"]:
+                    try:
+                        os.remove(f["path"])
+                    except OSError:
+                        pass
+                f.update(state="skipped", mat_id=mat_id, chunks=prev["chunks"] if prev else 0)
+                return note(f)
+            if not chunks:
+                raise ValueError("有効なテキストなし")
+            f["mat_id"] = f["mat_id"] or str(uuid.uuid4())  # 再開時も同じ mat_id（やり直しても行が重複しない）
+            by_sha[fsha] = f["mat_id"]
+            mat = {"mat_id": f["mat_id"], "title": f["title"], "filepath": f["path"], "kind": kind, "ns": ns}
+            refs = []
+            for r in rag.new_chunk_rows(mat, list(enumerate(chunks)), set()):
+                if r["h"] in pending_h:
+                    refs.append((r["chunk_id"], r["h"]))  # 前のファイルの埋め込み待ちと同じチャンク
+                else:
+                    pending_h[r["h"]] = None
+                    new.append(r)
+            rows.extend(new)
+            if refs:
+                shared.append((mat, refs))
+            while len(rows) >= BULK_EMBED_BATCH:
+                batch = rows[:BULK_EMBED_BATCH]
+                rag.index_rows(rag.embed_rows(batch), batch)
+                del rows[:BULK_EMBED_BATCH]  # 索引に入れてから外す（失敗したら前のファイルの行も次の機会にやり直す）
+            # 行を索引へ渡し終えてから「保存待ち」にする（失敗したファイルを commit() で done にしない）
+            f.update(state="indexed", chunks=len(chunks), new_chunks=len(new), error=None)
+            indexed.append((f, fsha, kind))
+            note(f)
+            if BULK_CHECKPOINT_FILES and len(indexed) >= BULK_CHECKPOINT_FILES:
+                commit()
+        except Exception as e:
+            # このファイルの埋め込み待ちの行は取り下げる（前のファイルの行は残す）
+            mine = {id(r) for r in new}
+            rows[:] = [r for r in rows if id(r) not in mine]
+            for r in new:
+                pending_h.pop(r["h"], None)
+            shared[:] = [(m, refs) for m, refs in shared if m is not mat]
+            if mat is not None:
+                by_sha.pop(fsha, None)  # 同じ内容の別ファイルはこのファイルの代わりに取り込む
+            f.update(state="error", error=str(e))
+            note(f)
+
+    try:
+        with rag.bulk_commit(), ThreadPoolExecutor(BULK_WORKERS, thread_name_prefix="bulk-extract") as pool:
+            queue_ = list(todo)
+            inflight: Dict[Any, Dict] = {}
+            while queue_ or inflight:
+                # 抽出済みのチャンクを抱えすぎないよう、同時に扱うファイルはワーカー数×2まで
+                while queue_ and len(inflight) < BULK_WORKERS * 2:
+                    f = queue_.pop(0)
+                    inflight[pool.submit(tenants.bind(_extract_file), f["path"])] = f
+                done, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+                for fut in [x for x in inflight if x in done]:  # 同時に終わったものは投入順に
+                    take(inflight.pop(fut), fut)
+            embed_pending()
+        commit()  # bulk_commit を抜けた時点で保存済み。取り込み済みの記録とマニフェストを更新する
+        run["state"] = "done"
+    except BaseException as e:
+        run["state"] = "error"
+        run["error"] = str(e)
+        raise
+    finally:
+        _save_run(run)
+    return get_bulk_status(run_id)
+
+def submit_bulk(run_id: str) -> threading.Thread:
+    """日本語：bulk_ingest を今のテナントでバックグラウンドスレッドで始める（API 用）"""
+    def go():
+        try:
+            bulk_ingest(run_id)
+        except Exception as e:
+            print(f"[INGEST] bulk run {run_id} failed:", e)
+    th = threading.Thread(target=tenants.bind(go), daemon=True, name=f"bulk-{run_id[:8]}")
+    th.start()
+    return th
+
+
+# =============================================================================
+# CLI：python -m backend.ingest <フォルダ> [--course 講義名] [--owner 所有者] [--run run_id] [--tenant テナント]
+#   同じフォルダで再実行すると、前回中断したところから続ける（マニフェストは data/rag/bulk/）
+# =============================================================================
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(prog="python -m backend.ingest", description="資料フォルダの一括取り込み")
+    ap.add_argument("root", help="取り込むフォルダ（pdf/docx/xlsx/xls/txt を再帰的に探す）")
+    ap.add_argument("--course")
+    ap.add_argument("--owner")
+    ap.add_argument("--run", help="マニフェストの run_id（既定はフォルダのパスから決まる）")
+    ap.add_argument("--tenant", default=tenants.DEFAULT_TENANT, help="取り込み先のテナント")
+    args = ap.parse_args()
+    with tenants.scope(args.tenant):
+        paths = list_material_files(args.root)
+        run = create_bulk_run(paths, namespaces=rag.make_namespaces(args.course, args.owner),
+                              run_id=args.run or dir_run_id(args.root), source=os.path.abspath(args.root))
+        left = sum(f["state"] not in ("done", "skipped") for f in run["files"])
+        print(f"[INGEST] run {run['id']}: {len(run['files'])} files, {left} to ingest", file=sys.stderr)
+        t0 = time.time()
+        res = bulk_ingest(run["id"], progress=lambda f: print(
+            f"[INGEST] {f['state']:8} {f['title']} chunks={f['chunks']}"
+            + (f" error={f['error']}" if f["error"] else ""), file=sys.stderr))
+        print(json.dumps({"id": res["id"], "state": res["state"], "counts": res["counts"], "commits": res["commits"],
+                          "sec": round(time.time() - t0, 1)}, ensure_ascii=False))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# locks.py — プロセス間ファイルロック（追加依存なし：POSIX は fcntl、Windows は msvcrt）
+# 日本語コメント：uvicorn --workers N のような複数プロセス構成で
+#   「1プロセスだけが実行する処理」（リマインド送信など）を決めるのに使う。
+import os, time
+
+
+class FileLock:
+    """
+    日本語：排他ファイルロック。with 文でも使える。
+    - acquire(blocking=False) は取れなければ即 False（リーダー選出用）
+    - ロックはプロセス終了時に OS が自動解放するので、リーダーが落ちれば他が引き継げる
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                _lock_fd(fd, blocking)
+                self._fd = fd
+                return True
+            except OSError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                time.sleep(0.05)  # msvcrt の LK_LOCK は約10秒で諦めるので再試行
+
+    def release(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            _unlock_fd(fd)
+        finally:
+            os.close(fd)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_fd(fd: int, blocking: bool) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+
+    def _unlock_fd(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_fd(fd: int, blocking: bool) -> None:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _unlock_fd(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# lru.py — 件数上限つき LRU キャッシュ（任意で TTL）
+# 日本語コメント：検索クエリの埋め込み・検索結果のように「同じ入力が短時間に繰り返し来る」ものに使う。
+import threading, time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    日本語：maxsize 件を超えたら最も使われていない項目から捨てる。
+    ttl（秒）を渡すと、入れてから ttl 秒を過ぎた項目は無いものとして扱う。スレッドセーフ。
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._d: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key → (入れた時刻, 値)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._d.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._d[key]
+                item = _MISSING
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            self._d.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._d[key] = (time.monotonic(), value)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._d), "maxsize": self.maxsize, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses}
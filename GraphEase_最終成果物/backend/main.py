@@ -7,6 +7,17 @@ main.py — FastAPI：フロント配信(任意) + API
 - リマインド登録（別スレッドで送信）
 - 入力した重要文を重み付けにして再要約
 - 要約（または転写）の読み上げ（MP3を返す）
+- 転写/要約の全文検索（文字 n-gram + BM25、該当区間のタイムスタンプ付き）
+- 要約/転写の版履歴（差分保存）の一覧・取得・復元
+- 配布資料（RAG）の取り込み・差し替え・削除
+- 録音区間の意味検索（転写の追加・編集に合わせて差分で索引）
+- テナント（学校）ごとにデータを分割（X-Tenant ヘッダ。上限もテナントごと。詳細は tenants.py）
+
+複数ワーカー構成:
+- STORAGE_BACKEND=sqlite で保存先を共有 SQLite（data/preppal.db）にすると
+  uvicorn --workers N（または WEB_WORKERS=N python -m backend.main）で起動できます。
+- リマインド送信はファイルロックで選ばれた1プロセスだけが行います。
+- Whisper / 埋め込みモデルはワーカーごとにロードされる点に注意（メモリはワーカー数倍）。
 
 ポイント（この版の変更点）:
 - 以前は frontend/ が無いと RuntimeError で落ちていました。
@@ -20,7 +31,7 @@ import tempfile
 import shutil
 from uuid import uuid4
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import FastAPI, UploadFile, File, Form, Body, HTTPException
 from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, FileResponse
@@ -37,14 +48,25 @@ from .summarizer import summarize, make_weighted_summary  # 要約/重み付き
 from .storage import (
     add_record, get_record, list_records_light,
     update_title as storage_update_title,
+    update_fields as storage_update_fields,
+    export_record,
+    list_versions, get_version, VERSIONED_FIELDS,
+    search_records, check_record_quota, stored_tenants,
+    add_record_listener,
+    STORAGE_BACKEND,
     add_reminder as storage_add_reminder,
 )
+from .search import match_segments  # 全文検索
+from . import tenants
 from .reminders import start as start_reminders  # リマインド監視ループ開始
 from .tts import synthesize_to_file  # テキスト→MP3
 
 # ---- RAG は任意（インストール状況に応じて自動OFF）----
 try:
     from . import rag
+    from . import ingest  # 資料取り込みのバックグラウンドパイプライン
+    from . import recindex  # 録音区間の意味検索（別索引）
+    add_record_listener(recindex.enqueue)
     RAG_AVAILABLE = True
 except Exception as _e:
     print("[INFO] RAG disabled:", _e)
@@ -69,14 +91,28 @@ FRONT_DIR = next((p for p in CANDIDATES if os.path.isdir(p)), None)
 # 録音ファイルの保存先（元音声を配信用に残す）
 # =============================================================================
 DATA_DIR = os.path.join(BACKEND_DIR, "data")
-RECORDINGS_DIR = os.path.join(DATA_DIR, "recordings")
+RECORDINGS_DIR = os.path.join(DATA_DIR, "recordings")  # 既定テナント（他は data/tenants/<テナント>/recordings）
 os.makedirs(RECORDINGS_DIR, exist_ok=True)
 
+def recordings_dir() -> str:
+    path = os.path.join(tenants.data_dir(), "recordings")
+    os.makedirs(path, exist_ok=True)
+    return path
+
 # =============================================================================
 # FastAPI アプリ準備 + CORS
 # =============================================================================
 app = FastAPI(title="PrepPal — STT + Summary (API)")
 
+# =============================================================================
+# テナント：X-Tenant ヘッダ（無ければ既定テナント）で、このリクエストの読み書き先を決める
+# - 同じテナントの同時処理が TENANT_MAX_INFLIGHT を超えたら 429（他のテナントは待たされない）
+# - 件数などの上限（tenants.QuotaExceeded）も 429 で返す
+# - CORS より先に登録する（後から登録したミドルウェアほど外側になるので、429 にも CORS ヘッダが付く）
+# =============================================================================
+app.middleware("http")(tenants.http_middleware)
+app.add_exception_handler(tenants.QuotaExceeded, tenants.quota_response)
+
 # 日本語：開発中はオリジンを広めに許可（必要に応じて絞ってください）
 app.add_middleware(
     CORSMiddleware,
@@ -109,6 +145,16 @@ else:
         """フロント無しモード用のヘルスエンドポイント"""
         return PlainTextResponse("API is running (frontend not mounted).", status_code=200)
 
+@app.on_event("startup")
+def _on_startup():
+    """日本語：リマインド監視ループを開始（複数ワーカー時は内部でリーダー1つだけが送信）"""
+    start_reminders()
+    if RAG_AVAILABLE:
+        # 共有ストレージに残っている録音のうち、区間索引に無いものを取り込む（テナントごと）
+        for t in stored_tenants():
+            with tenants.scope(t):
+                recindex.backfill(r["id"] for r in list_records_light())
+
 # favicon（無ければ 204）
 @app.get("/favicon.ico")
 def favicon():
@@ -125,12 +171,15 @@ async def transcribe_and_summarize(
     language: Optional[str] = Form(None),
     duration_sec: Optional[float] = Form(None),
     use_rag: Optional[bool] = Form(False),  # true ならRAG文脈を付与
+    namespace: Optional[str] = Form(None),  # RAG の検索範囲（例: "course:線形代数"）。無指定なら全資料
 ):
     """
     日本語：音声→文字起こし→（任意RAG文脈付）要約→保存→結果返却
     - segments（区間情報）は同期ハイライト用に保持
     - 元音声は backend/data/recordings/<id>.webm として残す
     """
+    check_record_quota()  # 上限なら文字起こしの前に 429
+
     # --- 一時保存（UploadFile をファイルに落とす） ---
     with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp:
         contents = await audio.read()
@@ -153,7 +202,9 @@ async def transcribe_and_summarize(
         rag_context = ""
         if use_rag and RAG_AVAILABLE:
             try:
-                hits = rag.search_similar(transcript, top_k=5)
+                res = rag.transcript_search(transcript, top_k=5, namespace=namespace or None)
+                hits = res["hits"]
+                print(f"[RAG] search latency (ms, {res['windows']} windows):", res["latency_ms"])
                 ctx_lines = [f"{h.get('text','')}" for h in hits]
                 rag_context = "\n\n".join(ctx_lines)[:4000]
             except Exception as e:
@@ -167,7 +218,7 @@ async def transcribe_and_summarize(
             summary = summarize(transcript)
 
         # --- 元音声の恒久保存（失敗しても致命ではない） ---
-        final_audio_path = os.path.join(RECORDINGS_DIR, f"{rid}.webm")
+        final_audio_path = os.path.join(recordings_dir(), f"{rid}.webm")
         try:
             shutil.move(tmp_path, final_audio_path)
             tmp_path = None  # finally で消さない
@@ -206,13 +257,83 @@ def list_recordings():
     return list_records_light()
 
 
+@app.get("/api/search")
+def search_recordings(q: str = "", limit: int = 10):
+    """
+    日本語：転写・要約・タイトルの全文検索（BM25 順）。
+    各ヒットに一致した区間（segments の start/end）を付けるので、プレイヤーはそこへジャンプできる。
+    例: /api/search?q=フーリエ変換
+    """
+    q = (q or "").strip()
+    if not q:
+        return {"query": q, "hits": []}
+    hits = []
+    # 共有ストレージ時は他ワーカーの更新を取り込んでから検索する
+    for rid, score in search_records(q, top_k=max(1, min(limit, 50))):
+        r = get_record(rid)
+        if not r:
+            continue
+        hits.append({
+            "id": rid,
+            "title": r.get("title"),
+            "created_at": r.get("created_at"),
+            "score": round(score, 4),
+            "segments": match_segments(r.get("segments") or [], q),
+        })
+    return {"query": q, "hits": hits}
+
+
+@app.get("/api/recordings/search_semantic")
+def search_recordings_semantic(q: str = "", top_k: int = 10):
+    """
+    日本語：全講義の転写を意味で検索し、(録音 ID, 区間の start/end) を返す。
+    /api/recordings/{rid} より前に定義する（"search_semantic" が rid として扱われないように）。
+    例: /api/recordings/search_semantic?q=固有値の求め方
+    """
+    q = (q or "").strip()
+    if not q:
+        return {"query": q, "hits": []}
+    if not RAG_AVAILABLE:
+        raise HTTPException(status_code=503, detail="RAG is not available")
+    res = recindex.search(q, top_k=max(1, min(top_k, 50)))
+    hits = []
+    for h in res["hits"]:
+        r = get_record(h["id"])
+        if not r:
+            continue
+        hits.append({
+            "id": h["id"],
+            "title": r.get("title"),
+            "created_at": r.get("created_at"),
+            "start": h["start"],
+            "end": h["end"],
+            "text": h["text"],
+            "score": round(h["score"], 4),
+        })
+    return {"query": q, "hits": hits, "latency_ms": res["latency_ms"]}
+
+
 @app.get("/api/recordings/{rid}")
 def get_recording(rid: str):
     """日本語：詳細（転写・要約）"""
     r = get_record(rid)
     if not r:
         return JSONResponse({"error": "not found"}, status_code=404)
-    return r
+    return export_record(r)
+
+
+@app.get("/api/recordings/{rid}/segment_at")
+def get_segment_at(rid: str, t: float):
+    """
+    日本語：再生位置 t（秒）を含む区間を返す（同期ハイライト用、二分探索）。
+    区間の隙間にいるときは index=-1, segment=null。
+    """
+    r = get_record(rid)
+    if not r:
+        raise HTTPException(status_code=404, detail="recording not found")
+    segs = r.get("segments")
+    i = segs.index_at(t) if segs is not None and len(segs) else -1
+    return {"t": t, "index": i, "segment": segs[i] if i >= 0 else None}
 
 
 @app.get("/api/recordings/{rid}/audio")
@@ -295,18 +416,11 @@ def get_quiz_detail(qid: str):
     return q
 
 
-@app.post("/api/materials/upload")
-async def upload_material(file: UploadFile = File(...), title: Optional[str] = Form(None)):
-    """
-    日本語：PDF/Word/Excel/TXT を受け取り、抽出→分割→埋め込み→FAISSに追加
-    - RAG が無効のときは 503 を返す
-    """
-    if not RAG_AVAILABLE:
-        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
-
+async def _save_material_upload(file: UploadFile) -> str:
+    """日本語：アップロードされた資料をテナントの資料フォルダ（既定は data/materials）に保存してパスを返す"""
     fname = f"{uuid4()}_{file.filename}"
     tmp = os.path.join(tempfile.gettempdir(), fname)
-    final = os.path.join(rag.MATS_DIR, fname)
+    final = os.path.join(rag.materials_dir(), fname)
 
     with open(tmp, "wb") as f:
         f.write(await file.read())
@@ -314,10 +428,170 @@ async def upload_material(file: UploadFile = File(...), title: Optional[str] = F
         shutil.move(tmp, final)
     except Exception:
         final = tmp  # 移動失敗時は一時のまま
+    return final
+
+
+@app.post("/api/materials/upload")
+async def upload_material(
+    file: UploadFile = File(...),
+    title: Optional[str] = Form(None),
+    course: Optional[str] = Form(None),  # 名前空間タグ（検索時に namespace=course:... で絞れる）
+    owner: Optional[str] = Form(None),
+):
+    """
+    日本語：PDF/Word/Excel/TXT を受け取り、抽出→分割→埋め込み→FAISSに追加
+    - 処理はバックグラウンドのパイプラインで行い、ここでは 202 を即返す
+      進捗は /api/materials/{id}/status で確認
+    - course / owner を付けると名前空間タグになる（mat:<mat_id> は自動）
+    - RAG が無効のときは 503 を返す
+    """
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
 
+    ingest.check_quota()  # 上限なら保存する前に 429
+    final = await _save_material_upload(file)
     title = title or file.filename or "material"
-    ret = rag.add_material_and_index(title=title, filepath=final)
-    return JSONResponse(ret, status_code=200 if ret.get("ok") else 400)
+    # 日本語：同一内容のファイルが取り込み済みなら、今回保存したコピーはパイプライン側で削除
+    job = ingest.submit(title=title, filepath=final, remove_if_duplicate=True,
+                        namespaces=rag.make_namespaces(course, owner))
+    return JSONResponse(
+        {"ok": True, "mat_id": job.id, "state": job.state, "status_url": f"/api/materials/{job.id}/status"},
+        status_code=202,
+    )
+
+
+@app.post("/api/materials/bulk_upload")
+async def bulk_upload_materials(
+    files: List[UploadFile] = File(...),
+    course: Optional[str] = Form(None),
+    owner: Optional[str] = Form(None),
+):
+    """
+    日本語：複数の資料（学期分のフォルダなど）をまとめて取り込む（202 を即返す）
+    - 抽出は並列、埋め込みはファイルをまたいで大きなバッチ、index の保存は最後に1回（ingest.bulk_ingest）
+    - 進捗（ファイルごと）は /api/materials/bulk/{run_id}。中断したら /api/materials/bulk/{run_id}/resume
+    """
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
+    rag.check_chunk_quota()
+    paths = [await _save_material_upload(f) for f in files]
+    titles = [f.filename or "material" for f in files]
+    run = ingest.create_bulk_run(paths, titles, namespaces=rag.make_namespaces(course, owner),
+                                 remove_if_duplicate=True)
+    ingest.submit_bulk(run["id"])
+    return JSONResponse(
+        {"ok": True, "run_id": run["id"], "files": len(paths), "status_url": f"/api/materials/bulk/{run['id']}"},
+        status_code=202,
+    )
+
+
+@app.get("/api/materials/bulk/{run_id}")
+def bulk_status(run_id: str):
+    """日本語：一括取り込みの状態（files: [{path, title, state, mat_id, chunks, new_chunks, error}], counts）"""
+    if not RAG_AVAILABLE:
+        raise HTTPException(status_code=503, detail="RAG disabled")
+    st = ingest.get_bulk_status(run_id)
+    if st is None:
+        raise HTTPException(status_code=404, detail="bulk run not found")
+    return st
+
+
+@app.post("/api/materials/bulk/{run_id}/resume")
+def bulk_resume(run_id: str):
+    """日本語：中断した一括取り込みを続きから再開する（保存まで済んだファイルは飛ばす）"""
+    if not RAG_AVAILABLE:
+        raise HTTPException(status_code=503, detail="RAG disabled")
+    st = ingest.get_bulk_status(run_id)
+    if st is None:
+        raise HTTPException(status_code=404, detail="bulk run not found")
+    if ingest.bulk_running(run_id):
+        return JSONResponse({"ok": False, "error": "already running"}, status_code=409)
+    ingest.submit_bulk(run_id)
+    return JSONResponse({"ok": True, "run_id": run_id, "status_url": f"/api/materials/bulk/{run_id}"},
+                        status_code=202)
+
+
+@app.get("/api/materials/namespaces")
+def material_namespaces():
+    """日本語：名前空間（course:... / owner:...）ごとのチャンク数"""
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
+    return {"namespaces": rag.list_namespaces()}
+
+
+@app.get("/api/materials/search")
+def search_materials(q: str, top_k: int = 5, namespace: Optional[str] = None):
+    """
+    日本語：配布資料のハイブリッド検索（ベクトル + BM25 を RRF で統合）
+    namespace（"course:..." / "owner:..." / "mat:<mat_id>"）を付けるとその範囲だけを検索
+    resp: { query, hits: [{ mat_id, title, chunk_id, text, score, vec_score, bm25 }],
+            latency_ms: { vector, lexical, fuse, total } }
+    """
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
+    top_k = max(1, min(int(top_k), 50))
+    res = rag.hybrid_search(q, top_k=top_k, namespace=namespace or None)
+    hits = [{
+        "mat_id": h.get("mat_id"), "title": h.get("title"), "chunk_id": h.get("chunk_id"),
+        "text": h.get("text", ""), "score": h.get("_score"),
+        "vec_score": h.get("_vec_score"), "bm25": h.get("_bm25"),
+    } for h in res["hits"]]
+    return {"query": q, "hits": hits, "latency_ms": res["latency_ms"], "cached": bool(res.get("cached"))}
+
+
+@app.put("/api/materials/{mat_id}")
+async def replace_material(
+    mat_id: str,
+    file: UploadFile = File(...),
+    title: Optional[str] = Form(None),
+    course: Optional[str] = Form(None),
+    owner: Optional[str] = Form(None),
+):
+    """
+    日本語：資料の差し替え（同じ mat_id のまま新しいファイルを取り込み、完了時に旧版にしか無いチャンクを削除）
+    - 取り込み中は旧版がそのまま検索されるので、差し替えの途中で資料が消えることはない
+    - course / owner を省略すると旧版の名前空間を引き継ぐ
+    """
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
+    if not rag.has_material(mat_id):
+        raise HTTPException(status_code=404, detail="material not found")
+    if ingest.is_active(mat_id):
+        raise HTTPException(status_code=409, detail="material is being ingested")
+
+    ingest.check_quota()  # 上限なら保存する前に 429
+    final = await _save_material_upload(file)
+    namespaces = rag.make_namespaces(course, owner) if (course or owner) else rag.material_namespaces(mat_id)
+    job = ingest.submit(title=title or file.filename or "material", filepath=final,
+                        replace_id=mat_id, namespaces=namespaces)
+    return JSONResponse(
+        {"ok": True, "mat_id": job.id, "state": job.state, "status_url": f"/api/materials/{job.id}/status"},
+        status_code=202,
+    )
+
+
+@app.delete("/api/materials/{mat_id}")
+def delete_material(mat_id: str):
+    """日本語：資料を RAG から削除（検索からは即時に消え、索引の掃除はバックグラウンドのコンパクションで行う）"""
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
+    if ingest.is_active(mat_id):
+        raise HTTPException(status_code=409, detail="material is being ingested")
+    res = rag.delete_material(mat_id)
+    if res is None:
+        raise HTTPException(status_code=404, detail="material not found")
+    return res
+
+
+@app.get("/api/materials/{mat_id}/status")
+def material_status(mat_id: str):
+    """日本語：取り込みジョブの進捗（ページ数・埋め込み済みチャンク数・ETA 秒）"""
+    if not RAG_AVAILABLE:
+        return JSONResponse({"ok": False, "error": "RAG disabled"}, status_code=503)
+    st = ingest.get_status(mat_id)
+    if not st:
+        raise HTTPException(status_code=404, detail="job not found")
+    return st
 
 
 @app.post("/api/recordings/{rid}/title")
@@ -385,12 +659,11 @@ def resummarize_from_text(rid: str, payload: dict = Body(...)):
         raise HTTPException(status_code=400, detail="text is empty")
 
     wants = [ln.strip() for ln in raw.replace("\r\n", "\n").split("\n") if ln.strip()]
-    rec["highlights"] = [{"text": w, "weight": boost} for w in wants]
+    highlights = [{"text": w, "weight": boost} for w in wants]
 
-    # 要約を作り直す
-    new_summary = make_weighted_summary(rec.get("transcript", ""), rec["highlights"])
-    if new_summary:
-        rec["summary"] = new_summary
+    # 要約を作り直す（storage 経由で更新 → 検索インデックスも追従）
+    new_summary = make_weighted_summary(rec.get("transcript", ""), highlights)
+    rec = storage_update_fields(rid, {"highlights": highlights, "summary": new_summary or None}) or rec
 
     return {"ok": True, "summary": rec["summary"], "highlights": rec["highlights"]}
 
@@ -411,7 +684,7 @@ def tts_summary(rid: str, field: str = "summary"):
     if not text:
         raise HTTPException(status_code=400, detail="nothing to read")
 
-    mp3_path = synthesize_to_file(text)  # 一時ファイルパス
+    mp3_path = synthesize_to_file(text)  # data/tts_cache のファイル（同じ本文なら再合成しない）
     return FileResponse(mp3_path, media_type="audio/mpeg", filename=f"{rid}-{target_field}.mp3")
 
 
@@ -426,28 +699,52 @@ def update_recording_fields(
     """
     日本語：
     - 任意のフィールド（title/summary/transcript/category）を部分更新
-    - storage.get_record() が dict を返す実装なら、その場で書き換えで OK
-      （もしファイル永続化が必要なら、storage.py に update_fields を用意して呼び出してください）
+    - storage.update_fields() 経由で更新するので、全文検索インデックスも差分更新される
     """
-    r = get_record(rid)
+    fields = {
+        "title": title.strip() if title is not None else None,
+        "summary": summary,
+        "transcript": transcript,
+        "category": category,
+    }
+    r = storage_update_fields(rid, fields)
     if not r:
         raise HTTPException(status_code=404, detail="recording not found")
 
-    changed = False
-    if title is not None:
-        r["title"] = title.strip()
-        changed = True
-    if summary is not None:
-        r["summary"] = summary
-        changed = True
-    if transcript is not None:
-        r["transcript"] = transcript
-        changed = True
-    if category is not None:
-        r["category"] = category
-        changed = True
-
-    return {"ok": True, "changed": changed, "record": r}
+    changed = any(v is not None for v in fields.values())
+    return {"ok": True, "changed": changed, "record": export_record(r)}
+
+@app.get("/api/recordings/{rid}/versions")
+def get_recording_versions(rid: str):
+    """日本語：要約/転写の版一覧（本文は含めない）"""
+    if not get_record(rid):
+        raise HTTPException(status_code=404, detail="recording not found")
+    return {"id": rid, "versions": list_versions(rid)}
+
+
+@app.get("/api/recordings/{rid}/versions/{v}")
+def get_recording_version(rid: str, v: int, field: str = "summary"):
+    """日本語：v 版の全文を復元して返す。例: /api/recordings/<id>/versions/3?field=transcript"""
+    if field not in VERSIONED_FIELDS:
+        raise HTTPException(status_code=400, detail="field must be summary or transcript")
+    text = get_version(rid, field, v)
+    if text is None:
+        raise HTTPException(status_code=404, detail="version not found")
+    return {"id": rid, "field": field, "v": v, "text": text}
+
+
+@app.post("/api/recordings/{rid}/versions/{v}/restore")
+def restore_recording_version(rid: str, v: int, field: str = Form("summary")):
+    """日本語：v 版の内容に戻す（履歴は消さず、新しい版として追加される）"""
+    if field not in VERSIONED_FIELDS:
+        raise HTTPException(status_code=400, detail="field must be summary or transcript")
+    text = get_version(rid, field, v)
+    if text is None:
+        raise HTTPException(status_code=404, detail="version not found")
+    r = storage_update_fields(rid, {field: text})
+    if not r:
+        raise HTTPException(status_code=404, detail="recording not found")
+    return {"ok": True, "record": export_record(r)}
 
 # =============================================================================
 # 直接起動（python -m backend.main）
@@ -455,4 +752,9 @@ def update_recording_fields(
 if __name__ == "__main__":
     import uvicorn
     # 日本語：Windows向けに reload=False（ファイルロック回避のため）
-    uvicorn.run(app, host="127.0.0.1", port=8000, reload=False)
+    workers = int(os.getenv("WEB_WORKERS", "1"))
+    if workers > 1 and STORAGE_BACKEND != "sqlite":
+        print("[WARN] WEB_WORKERS>1 では STORAGE_BACKEND=sqlite にしないとワーカーごとにデータが分かれます")
+    # 複数ワーカーは import 文字列での指定が必要
+    uvicorn.run("backend.main:app" if workers > 1 else app,
+                host="127.0.0.1", port=8000, reload=False, workers=workers)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# metastore.py — RAG チャンクのメタ情報（固定長レコード + テキスト blob、mmap で参照）
+# 日本語コメント：
+#   meta.jsonl は検索のたびに必要な数行のために全行を JSON として読み込んでいた。ここでは
+#     meta-<n>.rec  … 固定長レコード（chunk ID / フラグ / 本文と属性の blob 内オフセット・長さ）
+#     meta-<n>.blob … 本文（UTF-8）と属性（mat_id・title などの小さな JSON）を追記していくファイル
+#   に分け、どちらも mmap で開く。どの <n> の何レコード目・何バイト目までが確定済みかは
+#   rag.py の manifest.json が持つ（それより後ろは書きかけ。次の追記で切り詰める）。
+#   ヒットの解決は ID → レコード位置 → blob のスライスで O(k)。
+#   ページはページキャッシュ上で共有されるので、複数ワーカーで開いても本文は1回分しかメモリを使わない。
+#   同じ ID のレコードが複数あれば最後のものが有効（更新 = 追記）。削除はフラグ付きレコードを追記する。
+import json, mmap, os, threading
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import numpy as np
+
+MAGIC = b"PPMETA01"
+HEADER_SIZE = 16
+FLAG_DELETED = 1
+
+REC_DTYPE = np.dtype([
+    ("id", "<i8"), ("flags", "<u4"),
+    ("text_off", "<u8"), ("text_len", "<u4"),
+    ("attr_off", "<u8"), ("attr_len", "<u4"),
+])
+
+_EMPTY = np.zeros(0, dtype=REC_DTYPE)
+
+
+def _paths(rag_dir: str, n: int):
+    return os.path.join(rag_dir, f"meta-{n}.rec"), os.path.join(rag_dir, f"meta-{n}.blob")
+
+def read_legacy_current(rag_dir: str) -> int:
+    """日本語：manifest.json 導入前の世代ポインタ（meta.current）。無ければ 0"""
+    try:
+        with open(os.path.join(rag_dir, "meta.current"), "r", encoding="ascii") as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def file_extent(rag_dir: str, n: int) -> Tuple[int, int]:
+    """日本語：meta-<n> のファイル上の (レコード数, blob バイト数)。書きかけの末尾も含む"""
+    rec_path, blob_path = _paths(rag_dir, n)
+    try:
+        n_recs = max(0, (os.path.getsize(rec_path) - HEADER_SIZE) // REC_DTYPE.itemsize)
+    except OSError:
+        n_recs = 0
+    try:
+        blob = os.path.getsize(blob_path)
+    except OSError:
+        blob = 0
+    return n_recs, blob
+
+def remove_files(rag_dir: str, n: int):
+    for p in _paths(rag_dir, n):
+        try:
+            os.remove(p)
+        except OSError:
+            pass  # Windows では他プロセスが開いていると消せない（残っても使われない。check で掃除）
+
+def _fsync_write(path: str, data: bytes):
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _encode(entries: Iterable[Dict], blob_off: int):
+    """日本語：行（または {"id", "deleted": True}）を (レコード配列, blob に足すバイト列) にする"""
+    entries = list(entries)
+    recs = np.zeros(len(entries), dtype=REC_DTYPE)
+    parts, off = [], blob_off
+    for k, e in enumerate(entries):
+        recs[k]["id"] = e["id"]
+        if e.get("deleted"):
+            recs[k]["flags"] = FLAG_DELETED
+            continue
+        text = e["text"].encode("utf-8")
+        attr = json.dumps({key: v for key, v in e.items() if key not in ("id", "text")},
+                          ensure_ascii=False).encode("utf-8")
+        recs[k]["text_off"], recs[k]["text_len"] = off, len(text)
+        recs[k]["attr_off"], recs[k]["attr_len"] = off + len(text), len(attr)
+        parts += [text, attr]
+        off += len(text) + len(attr)
+    return recs, b"".join(parts)
+
+
+class MetaStore:
+    """
+    日本語：chunk ID → 行（dict）の永続ストア。読み込みは mmap、書き込みは追記のみ。
+    records / blob_size で確定済みの範囲を渡すと、それより後ろ（書きかけ）は読まない。
+    スレッドセーフ（内部ロック）。書き込むのはプロセス間の書き込みロック（rag.py）を持つ1プロセスだけ。
+    """
+
+    def __init__(self, rag_dir: str, n: int = 0, records: Optional[int] = None, blob_size: Optional[int] = None):
+        self.rag_dir = rag_dir
+        self.n = n
+        self.rec_path, self.blob_path = _paths(rag_dir, n)
+        self._lock = threading.RLock()
+        self._recs = _EMPTY
+        self._blob: Optional[mmap.mmap] = None
+        self._n_recs = records
+        self._blob_size = blob_size
+        self._pos: Dict[int, int] = {}  # 生きている ID → レコード位置
+        self._max_id = -1
+        self._open()
+
+    # --- 読み込み ---
+    def _open(self):
+        for p in (self.rec_path, self.blob_path):
+            if not os.path.exists(p):
+                if self._n_recs:
+                    raise FileNotFoundError(p)  # 確定済みのレコードがあるはずのファイルが無い
+                try:
+                    with open(p, "xb") as f:  # 他プロセスと同時に作っても見出しを二重に書かない
+                        if p == self.rec_path:
+                            f.write(MAGIC.ljust(HEADER_SIZE, b"\0"))
+                except FileExistsError:
+                    pass
+        self._map()
+        recs = self._recs
+        if len(recs) == 0:
+            self._pos = {}
+            return
+        # blob の書き込み前に落ちたレコードは無効
+        ok = ((recs["flags"] & FLAG_DELETED) != 0) | (
+            (recs["text_off"] + recs["text_len"] <= self._blob_size)
+            & (recs["attr_off"] + recs["attr_len"] <= self._blob_size))
+        idx = np.nonzero(ok)[0]
+        ids = recs["id"][idx]
+        # 同じ ID は最後のレコードが有効
+        uniq, first_rev = np.unique(ids[::-1], return_index=True)
+        last = idx[len(idx) - 1 - first_rev]
+        live = (recs["flags"][last] & FLAG_DELETED) == 0
+        self._pos = dict(zip(uniq[live].tolist(), last[live].tolist()))
+        self._max_id = int(recs["id"].max())
+
+    def _map(self):
+        """日本語：レコードと blob の確定済みの範囲を（追記後に）開き直す"""
+        with open(self.rec_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"not a metadata store: {self.rec_path}")
+        n_file, blob_file = file_extent(self.rag_dir, self.n)
+        n = n_file if self._n_recs is None else min(self._n_recs, n_file)
+        self._n_recs = n
+        self._recs = (np.memmap(self.rec_path, dtype=REC_DTYPE, mode="r", offset=HEADER_SIZE, shape=(n,))
+                      if n > 0 else _EMPTY)
+        if self._blob is not None:
+            self._blob.close()
+        self._blob_size = blob_file if self._blob_size is None else min(self._blob_size, blob_file)
+        self._blob = None
+        if self._blob_size:
+            with open(self.blob_path, "rb") as f:
+                self._blob = mmap.mmap(f.fileno(), self._blob_size, access=mmap.ACCESS_READ)
+
+    def _row(self, pos: int) -> Dict:
+        r = self._recs[pos]
+        t0, a0 = int(r["text_off"]), int(r["attr_off"])
+        row = json.loads(self._blob[a0:a0 + int(r["attr_len"])].decode("utf-8"))
+        row["id"] = int(r["id"])
+        row["text"] = self._blob[t0:t0 + int(r["text_len"])].decode("utf-8")
+        return row
+
+    def get(self, i: int) -> Optional[Dict]:
+        with self._lock:
+            pos = self._pos.get(i)
+            return None if pos is None else self._row(pos)
+
+    def iter_rows(self) -> Iterator[Dict]:
+        """日本語：生きている全行（ID 順）。読み込み時の索引づくり・書き直し用"""
+        for i in sorted(self.ids()):
+            row = self.get(i)
+            if row is not None:
+                yield row
+
+    def ids(self) -> Set[int]:
+        with self._lock:
+            return set(self._pos)
+
+    @property
+    def max_id(self) -> int:
+        return self._max_id
+
+    @property
+    def extent(self) -> Tuple[int, int]:
+        """日本語：(レコード数, blob バイト数)。manifest.json に確定済みの範囲として書く"""
+        return len(self._recs), self._blob_size
+
+    def invalid_records(self) -> int:
+        """日本語：blob の範囲外を指すレコード数（整合性チェック用。読み込み時には無視される）"""
+        recs = self._recs
+        if len(recs) == 0:
+            return 0
+        bad = ((recs["flags"] & FLAG_DELETED) == 0) & (
+            (recs["text_off"] + recs["text_len"] > self._blob_size)
+            | (recs["attr_off"] + recs["attr_len"] > self._blob_size))
+        return int(bad.sum())
+
+    def __contains__(self, i: int) -> bool:
+        return i in self._pos
+
+    def __len__(self) -> int:
+        return len(self._pos)
+
+    # --- 書き込み ---
+    def append(self, entries: List[Dict]):
+        """
+        日本語：行の追加/更新と削除（{"id", "deleted": True}）を確定済みの範囲の後ろへ書く。
+        blob → レコードの順に fsync。
+        書いた分は呼び出し側が manifest.json を更新するまで他プロセスからは見えない（extent で新しい範囲を得る）。
+        """
+        if not entries:
+            return
+        with self._lock:
+            recs, data = _encode(entries, self._blob_size)
+            base = len(self._recs)
+            with open(self.blob_path, "r+b") as f:
+                f.truncate(self._blob_size)  # 前回の書きかけ（未確定）を捨てる
+                f.seek(self._blob_size)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.rec_path, "r+b") as f:
+                f.truncate(HEADER_SIZE + base * REC_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(recs.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._n_recs = base + len(recs)
+            self._blob_size += len(data)
+            self._map()
+            for k, e in enumerate(entries):
+                if e.get("deleted"):
+                    self._pos.pop(e["id"], None)
+                else:
+                    self._pos[e["id"]] = base + k
+                self._max_id = max(self._max_id, e["id"])
+
+    def truncate_uncommitted(self):
+        """日本語：確定済みの範囲より後ろ（保存途中で落ちた書きかけ）をファイルから切り詰める"""
+        with self._lock:
+            with open(self.blob_path, "r+b") as f:
+                f.truncate(self._blob_size)
+            with open(self.rec_path, "r+b") as f:
+                f.truncate(HEADER_SIZE + len(self._recs) * REC_DTYPE.itemsize)
+
+    @classmethod
+    def create(cls, rag_dir: str, n: int, rows: Iterable[Dict]) -> "MetaStore":
+        """
+        日本語：rows だけを持つ meta-<n> を新しく書いて返す（コンパクション・移行用）。
+        manifest.json で <n> に切り替えるまでは使われない。古い <n> の削除は呼び出し側（remove_files）。
+        """
+        rec_path, blob_path = _paths(rag_dir, n)
+        recs, data = _encode(rows, 0)
+        _fsync_write(blob_path, data)
+        _fsync_write(rec_path, MAGIC.ljust(HEADER_SIZE, b"\0") + recs.tobytes())
+        return cls(rag_dir, n)
+
+    def close(self):
+        with self._lock:
+            if self._blob is not None:
+                self._blob.close()
+                self._blob = None
+            self._recs = _EMPTY
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# pdf_extract.py — PDF のページ抽出（ページ範囲ごとにプロセスプールで並列化）
+# 日本語コメント：
+#   pdfplumber のテキスト抽出は CPU バウンドで GIL を離さないため、スレッドではなくプロセスで並列化する。
+#   - PDF_SHARD_PAGES ページずつの範囲に分けて投入し、結果はページ順に並べ直して返す
+#   - 同時に抱える範囲は「ワーカー数×2」まで（メモリを文書サイズに比例させない）
+#   - PDF_PARALLEL_MIN_PAGES 未満の小さい PDF は起動コストの方が大きいので逐次処理
+# 子プロセスはこのモジュールだけを import する（rag.py のモデル読み込みを子で繰り返さないため）。
+#   spawn / forkserver は既定では親の __main__ を子で import し直す。python -m backend.main / backend.ingest で
+#   起動していると Whisper や埋め込みモデルをワーカーごとに読み込んでしまうので、子に渡す準備データから
+#   __main__ の情報を外す（_WorkerPopen。sys.modules は書き換えないので、他のスレッドの起動と競合しない）。
+#   ワーカーは forkserver から fork し、forkserver にはこのモジュールと pdfplumber だけを先に読み込ませておく。
+import io, os, atexit, threading, time
+import multiprocessing
+from multiprocessing import context, reduction, spawn, util
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, List, Optional
+
+PDF_WORKERS = int(os.getenv("RAG_PDF_WORKERS", str(min(8, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("RAG_PDF_PARALLEL_MIN_PAGES", "40"))
+PDF_SHARD_PAGES = int(os.getenv("RAG_PDF_SHARD_PAGES", "16"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def page_count(path: str) -> int:
+    import pdfplumber
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+def extract_range(path: str, start: int, end: int) -> List[str]:
+    """日本語：ページ start..end-1（0 始まり）のテキスト。子プロセスで実行される"""
+    import pdfplumber
+    out = []
+    with pdfplumber.open(path, pages=list(range(start + 1, end + 1))) as pdf:
+        for p in pdf.pages:
+            out.append(p.extract_text() or "")
+            # 解析済みオブジェクトのキャッシュを捨てる（残すと全ページ分たまる）
+            if hasattr(p, "close"):
+                p.close()
+            else:
+                p.flush_cache()
+    return out
+
+# forkserver の無い環境（Windows）は spawn のまま（子は親の __main__ を読み込み直す）
+_FORKSERVER = "forkserver" in multiprocessing.get_all_start_methods()
+
+if _FORKSERVER:
+    from multiprocessing import forkserver, popen_forkserver
+
+    class _WorkerPopen(popen_forkserver.Popen):
+        """日本語：親の __main__ の情報を渡さずに forkserver から子を作る（手順は popen_forkserver.Popen._launch）"""
+
+        def _launch(self, process_obj):
+            prep_data = spawn.get_preparation_data(process_obj._name)
+            prep_data.pop("init_main_from_name", None)
+            prep_data.pop("init_main_from_path", None)
+            buf = io.BytesIO()
+            context.set_spawning_popen(self)
+            try:
+                reduction.dump(prep_data, buf)
+                reduction.dump(process_obj, buf)
+            finally:
+                context.set_spawning_popen(None)
+            self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+            _parent_w = os.dup(w)
+            self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+            with open(w, "wb", closefd=True) as f:
+                f.write(buf.getbuffer())
+            self.pid = forkserver.read_signed(self.sentinel)
+
+    class _WorkerProcess(context.ForkServerProcess):
+        @staticmethod
+        def _Popen(process_obj):
+            return _WorkerPopen(process_obj)
+
+    class _WorkerContext(context.ForkServerContext):
+        Process = _WorkerProcess
+
+def _mp_context():
+    if not _FORKSERVER:
+        return multiprocessing.get_context("spawn")
+    ctx = _WorkerContext()
+    # 子が使うのは extract_range だけなので、forkserver にはこのモジュールと pdfplumber だけを読み込ませる
+    ctx.set_forkserver_preload([__spec__.name if __spec__ else __name__, "pdfplumber"])
+    return ctx
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # fork はスレッド/OpenMP 使用中のプロセスで危険なので forkserver（親の __main__ は読み込ませない）
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+            _pool_workers = workers
+        return _pool
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+atexit.register(_reset_pool)
+
+
+def iter_pages(path: str, workers: Optional[int] = None) -> Iterator[str]:
+    """日本語：ページ順にテキストを返すジェネレータ（大きい PDF は並列抽出）"""
+    workers = PDF_WORKERS if workers is None else workers
+    n = page_count(path)
+    if workers <= 1 or n < PDF_PARALLEL_MIN_PAGES:
+        for s in range(0, n, PDF_SHARD_PAGES):
+            yield from extract_range(path, s, min(s + PDF_SHARD_PAGES, n))
+        return
+
+    pool = _get_pool(workers)
+    inflight = deque()  # (開始ページ, future)。投入順＝ページ順
+    done = 0            # 呼び出し側へ返し終えたページ数
+    try:
+        for s in range(0, n, PDF_SHARD_PAGES):
+            inflight.append((s, pool.submit(extract_range, path, s, min(s + PDF_SHARD_PAGES, n))))
+            if len(inflight) >= workers * 2:
+                texts = inflight.popleft()[1].result()  # 先頭（最も若いページ範囲）から順に返す
+                done += len(texts)
+                yield from texts
+        while inflight:
+            texts = inflight.popleft()[1].result()
+            done += len(texts)
+            yield from texts
+    except BrokenProcessPool as e:
+        # 子プロセスが落ちた（メモリ不足など）。プールを捨てて残りを逐次で続ける
+        print("[PDF] process pool broken, falling back to serial:", e)
+        _reset_pool()
+        inflight.clear()
+        for s in range(done, n, PDF_SHARD_PAGES):
+            yield from extract_range(path, s, min(s + PDF_SHARD_PAGES, n))
+    finally:
+        for _, f in inflight:
+            f.cancel()
+
+
+# =============================================================================
+# ベンチマーク：python -m backend.pdf_extract <file.pdf> [最大ワーカー数]
+# =============================================================================
+def bench(path: str, max_workers: Optional[int] = None) -> List[dict]:
+    """日本語：逐次(1) と 2,4,8... ワーカーでの抽出時間・速度向上率を測る"""
+    max_workers = max_workers or (os.cpu_count() or 1)
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+    n = page_count(path)
+    rows, base = [], None
+    for w in counts:
+        if w > 1:
+            _get_pool(w).submit(int).result()  # プールの起動時間は計測から除く
+        t0 = time.perf_counter()
+        for _ in _iter_forced(path, w):
+            pass
+        sec = time.perf_counter() - t0
+        base = base or sec
+        rows.append({"workers": w, "pages": n, "sec": round(sec, 3), "speedup": round(base / sec, 2)})
+    return rows
+
+def _iter_forced(path: str, workers: int) -> Iterator[str]:
+    # ベンチでは小さい PDF でも並列経路を通す
+    global PDF_PARALLEL_MIN_PAGES
+    saved, PDF_PARALLEL_MIN_PAGES = PDF_PARALLEL_MIN_PAGES, 0
+    try:
+        yield from iter_pages(path, workers=workers)
+    finally:
+        PDF_PARALLEL_MIN_PAGES = saved
+
+
+if __name__ == "__main__":
+    import importlib, json, sys
+    if len(sys.argv) < 2:
+        print("usage: python -m backend.pdf_extract <file.pdf> [max_workers]")
+        sys.exit(1)
+    mw = int(sys.argv[2]) if len(sys.argv) >= 3 else None
+    # ワーカーは __main__ を読み込まないので、子から import できる名前（backend.pdf_extract）の方の関数を使う
+    mod = importlib.import_module(__spec__.name)
+    for row in mod.bench(sys.argv[1], mw):
+        print(json.dumps(row))
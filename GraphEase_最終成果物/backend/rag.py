@@ -1,17 +1,46 @@
 # -*- coding: utf-8 -*-
 # rag.py — 配布資料RAGの最小実装（FAISS + sentence-transformers）
-import os, json, uuid
-from typing import List, Dict, Tuple
+import os, re, json, uuid, threading, time, atexit, codecs, unicodedata
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Dict, Tuple, Iterator, Optional, Set
 import numpy as np
 import faiss
 
 # ローカル埋め込み（軽量・無料）
 from sentence_transformers import SentenceTransformer
+from .emb_cache import EmbeddingCache, text_hash, file_hash
+from . import pdf_extract
+from .embedder import BatchEncoder
+from .lru import LRUCache
+from .chunker import SentenceChunker, estimate_tokens
+from .search import NgramIndex
+from .metastore import MetaStore, file_extent, read_legacy_current, remove_files
+from .locks import FileLock
+from . import tenants
 _EMB_NAME = os.getenv("RAG_EMB_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
-_model = SentenceTransformer(_EMB_NAME)
+# 推論ランタイム：torch（既定）/ onnx / openvino。RAG_EMB_FILE で量子化済みファイルを選べる
+#   例) RAG_EMB_BACKEND=onnx RAG_EMB_FILE=onnx/model_qint8_avx2.onnx
+#       （要 sentence-transformers>=3.2 と optimum[onnxruntime]）
+_EMB_BACKEND = os.getenv("RAG_EMB_BACKEND", "torch").lower()
+_EMB_FILE = os.getenv("RAG_EMB_FILE", "")
+
+def _load_model() -> Tuple[Any, str]:
+    """日本語：(モデル, 実際に使うランタイム)。指定のランタイムが使えなければ torch に戻す"""
+    if _EMB_BACKEND != "torch":
+        kw = {"model_kwargs": {"file_name": _EMB_FILE}} if _EMB_FILE else {}
+        try:
+            return SentenceTransformer(_EMB_NAME, backend=_EMB_BACKEND, **kw), _EMB_BACKEND
+        except (TypeError, ImportError, ValueError, OSError) as e:
+            print(f"[RAG] embedding backend {_EMB_BACKEND!r} unavailable, using torch:", e)
+    return SentenceTransformer(_EMB_NAME), "torch"
+
+_model, _emb_backend = _load_model()
 DIM = 384  # 上モデルの出力次元
+# 埋め込みキャッシュのキー（ランタイム/量子化でベクトルがわずかに変わるので分ける）
+_EMB_KEY = _EMB_NAME if _emb_backend == "torch" else f"{_EMB_NAME}|{_emb_backend}|{_EMB_FILE}"
 
-# 保存先（data/materials, data/rag）
+# 保存先（data/materials, data/rag）。既定テナント以外は data/tenants/<テナント>/materials, rag（tenants.py）
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 MATS_DIR = os.path.join(DATA_DIR, "materials")
@@ -19,117 +48,1745 @@ RAG_DIR  = os.path.join(DATA_DIR, "rag")
 os.makedirs(MATS_DIR, exist_ok=True)
 os.makedirs(RAG_DIR,  exist_ok=True)
 
-INDEX_PATH = os.path.join(RAG_DIR, "faiss.index")
-META_PATH  = os.path.join(RAG_DIR, "meta.jsonl")
+MANIFEST_PATH = os.path.join(RAG_DIR, "manifest.json")  # 確定済みの index ファイル・メタの範囲・世代番号
+WRITER_LOCK_PATH = os.path.join(RAG_DIR, "writer.lock")  # 書き込めるのはこのロックを持つ1プロセスだけ
+INDEX_PATH = os.path.join(RAG_DIR, "faiss.index")  # 旧形式（起動時に manifest 形式へ移行）
+META_PATH  = os.path.join(RAG_DIR, "meta.jsonl")   # 旧形式（同上）
+GEN_PATH   = os.path.join(RAG_DIR, "generation")   # 旧形式（同上）
+CACHE_PATH = os.path.join(RAG_DIR, "ingest_cache.db")  # 埋め込みキャッシュ + 取り込み済みファイル
 
-# ---------- 各拡張子 → テキスト抽出 ----------
-def extract_text_from_pdf(path: str) -> str:
-    import pdfplumber
-    out = []
-    with pdfplumber.open(path) as pdf:
-        for p in pdf.pages:
-            out.append(p.extract_text() or "")
-    return "\n".join(out).strip()
+# add 後、この秒数だけ待ってまとめて保存（連続アップロードで毎回書き出さない）
+PERSIST_DELAY_SEC = float(os.getenv("RAG_PERSIST_DELAY", "1.0"))
 
-def extract_text_from_docx(path: str) -> str:
+# 埋め込みを何チャンクずつまとめて計算するか（取り込み時）
+EMBED_BATCH = int(os.getenv("RAG_EMBED_BATCH", "64"))
+
+# 近似最近傍（ANN）への自動昇格
+# - 最初は IndexFlatIP（全件走査・厳密）。件数が RAG_ANN_THRESHOLD を超えたら IVF か HNSW に作り直す
+# - IVF は件数が増えて nlist が目標の半分を下回ったら再学習
+RAG_ANN = os.getenv("RAG_ANN", "ivf").lower()               # ivf / hnsw / flat（昇格しない）
+RAG_ANN_THRESHOLD = int(os.getenv("RAG_ANN_THRESHOLD", "50000"))
+RAG_PQ_M = int(os.getenv("RAG_PQ_M", "0"))                  # >0 なら IVF を PQ 圧縮（DIM を割り切る数: 8,16,32,48...）
+RAG_HNSW_M = int(os.getenv("RAG_HNSW_M", "32"))
+RAG_NPROBE = int(os.getenv("RAG_NPROBE", "16"))             # IVF: 探索するクラスタ数（大きいほど高再現率・低速）
+RAG_EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", "64"))       # HNSW: 探索候補数（同上）
+
+# ベクトルの格納形式（メモリ削減）
+# - flat: float32（既定・厳密）/ fp16: 半精度（1/2）/ sq8: 8bit スカラー量子化（1/4）
+#   / pq: 直積量子化（DIM*4/RAG_STORE_PQ_M 分の1）
+# - sq8 / pq は学習が要るので、RAG_STORE_TRAIN_MIN 件たまるまでは float32 で持ち、たまったら作り直す
+# - 圧縮した形式では上位 top_k×RAG_RERANK 件を取り、埋め込みキャッシュの float32 ベクトルで厳密に採点し直す
+# IVF / HNSW に昇格した後も同じ形式で持つ（IVF + RAG_PQ_M は従来どおり IVFPQ）
+RAG_STORE = os.getenv("RAG_STORE", "flat").lower()
+RAG_STORE_PQ_M = int(os.getenv("RAG_STORE_PQ_M", "48"))     # pq のサブ量子化器の数（DIM を割り切る数）
+RAG_STORE_TRAIN_MIN = int(os.getenv("RAG_STORE_TRAIN_MIN", "2000"))
+RAG_RERANK = int(os.getenv("RAG_RERANK", "4"))              # 0 なら再採点しない
+
+# ハイブリッド検索（ベクトル + 文字 bi-gram BM25 を RRF で統合）
+# MiniLM は日本語の科目コード・数式・固有の用語に弱いので、字面の一致で補う
+RAG_HYBRID = os.getenv("RAG_HYBRID", "1") != "0"
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))               # RRF の定数（大きいほど順位差をならす）
+RAG_HYBRID_FETCH = int(os.getenv("RAG_HYBRID_FETCH", "4"))  # 各方式で top_k の何倍の候補を取るか
+RAG_LEX_MAX_DF = float(os.getenv("RAG_LEX_MAX_DF", "0.3"))  # これより多くのチャンクに出る gram は BM25 で無視
+
+# 名前空間（"course:線形代数" / "owner:alice" / "mat:<mat_id>"）で絞った検索
+# 該当チャンクがこれ以下なら、そのベクトルだけを取り出して厳密に内積を取る（全体を走査しない）。
+# 多いときは IDSelector で FAISS 側に絞り込ませる
+RAG_NS_EXACT_MAX = int(os.getenv("RAG_NS_EXACT_MAX", "4096"))
+
+# 文字起こし全文での検索（transcript_search）：窓の大きさ（文字）・重なり・最大の窓数
+# MiniLM は約256トークン（日本語ではほぼ文字数）で切り捨てるので、それより短い窓にする
+RAG_QUERY_WINDOW = int(os.getenv("RAG_QUERY_WINDOW", "200"))
+RAG_QUERY_OVERLAP = int(os.getenv("RAG_QUERY_OVERLAP", "40"))
+RAG_QUERY_MAX_WINDOWS = int(os.getenv("RAG_QUERY_MAX_WINDOWS", "32"))
+
+# 検索のキャッシュ
+# - クエリ埋め込み：正規化した文字列 → ベクトル（LRU。索引が変わっても有効）
+# - 検索結果：(種類, 正規化したクエリ, top_k, namespace) → 結果（LRU + TTL 秒）。索引の世代が変われば使わない
+RAG_QCACHE_SIZE = int(os.getenv("RAG_QCACHE_SIZE", "2048"))
+RAG_RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "256"))
+RAG_RESULT_TTL = float(os.getenv("RAG_RESULT_TTL", "30"))   # 0 なら結果はキャッシュしない
+
+# ---------- 各拡張子 → テキスト抽出（ページ単位のジェネレータ） ----------
+# 日本語コメント：文書全体を1本の文字列にせず、「ページ」（PDF は1ページ、docx は段落 DOCX_PARAS 個、
+#   xlsx は ROWS_PER_PAGE 行、txt は TXT_BLOCK バイト）ずつ流す。後段のチャンク分割・埋め込みも
+#   バッチ単位で進むので、ピークメモリは文書サイズに比例しない。
+DOCX_PARAS = 50
+ROWS_PER_PAGE = 200
+TXT_BLOCK = 64 * 1024  # バイト
+
+def iter_pdf_pages(path: str) -> Iterator[str]:
+    # 大きい PDF はページ範囲ごとにプロセスプールで並列抽出（順序は保たれる。詳細は pdf_extract.py）
+    return pdf_extract.iter_pages(path)
+
+def iter_docx_pages(path: str) -> Iterator[str]:
     import docx
-    doc = docx.Document(path)
-    return "\n".join(p.text or "" for p in doc.paragraphs).strip()
+    doc = docx.Document(path)  # python-docx は XML 全体を読むので、ここは文書サイズ分のメモリを使う
+    buf = []
+    for p in doc.paragraphs:
+        buf.append(p.text or "")
+        if len(buf) >= DOCX_PARAS:
+            yield "\n".join(buf)
+            buf = []
+    if buf:
+        yield "\n".join(buf)
 
-def extract_text_from_xlsx(path: str) -> str:
+def iter_xlsx_pages(path: str) -> Iterator[str]:
+    if path.lower().endswith(".xls"):
+        yield from _iter_xls_pages(path)
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)  # 行を逐次読む
+    try:
+        for ws in wb.worksheets:
+            buf = [f"### Sheet: {ws.title}"]
+            for row in ws.iter_rows(values_only=True):
+                buf.append(" ".join("" if v is None else str(v) for v in row))
+                if len(buf) >= ROWS_PER_PAGE:
+                    yield "\n".join(buf)
+                    buf = []
+            if buf:
+                yield "\n".join(buf)
+    finally:
+        wb.close()
+
+def _iter_xls_pages(path: str) -> Iterator[str]:
+    # 旧形式 .xls は openpyxl 非対応のため pandas で読む（シート単位でメモリに載る）
     import pandas as pd
-    out = []
     xls = pd.ExcelFile(path)
     for sheet in xls.sheet_names:
         df = xls.parse(sheet, dtype=str).fillna("")
-        out.append(f"### Sheet: {sheet}")
-        out.append("\n".join(" ".join(map(str, row)) for _, row in df.iterrows()))
-    return "\n".join(out).strip()
+        rows = df.to_numpy().tolist()
+        for i in range(0, max(len(rows), 1), ROWS_PER_PAGE):
+            head = [f"### Sheet: {sheet}"] if i == 0 else []
+            yield "\n".join(head + [" ".join(map(str, r)) for r in rows[i:i + ROWS_PER_PAGE]])
 
-def extract_text_any(path: str) -> Tuple[str, str]:
-    """(kind, text) を返す"""
+def _sniff_txt_encoding(path: str) -> str:
+    with open(path, "rb") as f:
+        head = f.read(1 << 20)
+    # 末尾で多バイト文字が切れている場合に備え、最大3バイト削って試す
+    for cut in range(4):
+        try:
+            head[:len(head) - cut].decode("utf-8")
+            return "utf-8"
+        except UnicodeDecodeError:
+            continue
+    return "cp932"
+
+def iter_txt_pages(path: str) -> Iterator[str]:
+    # バイト単位で TXT_BLOCK ずつ読む（page_count と数を合わせるため）。多バイト文字の切れ目は増分デコーダが面倒を見る
+    dec = codecs.getincrementaldecoder(_sniff_txt_encoding(path))(errors="ignore")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(TXT_BLOCK), b""):
+            yield dec.decode(block)
+    tail = dec.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def extract_pages_any(path: str) -> Tuple[str, Iterator[str]]:
+    """日本語：(kind, ページ文字列のイテレータ) を返す"""
     low = path.lower()
-    if low.endswith(".pdf"):  return "pdf",  extract_text_from_pdf(path)
-    if low.endswith(".docx"): return "docx", extract_text_from_docx(path)
-    if low.endswith(".xlsx") or low.endswith(".xls"): return "xlsx", extract_text_from_xlsx(path)
-    if low.endswith(".txt"):
+    if low.endswith(".pdf"):  return "pdf",  iter_pdf_pages(path)
+    if low.endswith(".docx"): return "docx", iter_docx_pages(path)
+    if low.endswith(".xlsx") or low.endswith(".xls"): return "xlsx", iter_xlsx_pages(path)
+    if low.endswith(".txt"):  return "txt",  iter_txt_pages(path)
+    return "unknown", iter(())
+
+def page_count(path: str) -> Optional[int]:
+    """日本語：extract_pages_any が出すページ数の見込み（ETA 計算用。安く分からない形式は None）"""
+    low = path.lower()
+    if low.endswith(".pdf"):
+        return pdf_extract.page_count(path)
+    if low.endswith(".xlsx"):
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True)
         try:
-            with open(path, "r", encoding="utf-8") as f: return "txt", f.read()
-        except:
-            with open(path, "r", encoding="cp932", errors="ignore") as f: return "txt", f.read()
-    return "unknown", ""
+            return sum(max(1, -(-((ws.max_row or 0) + 1) // ROWS_PER_PAGE)) for ws in wb.worksheets)
+        finally:
+            wb.close()
+    if low.endswith(".txt"):
+        return max(1, -(-os.path.getsize(path) // TXT_BLOCK))
+    return None
+
+# 文字列で欲しい場合の互換関数
+def extract_text_from_pdf(path: str) -> str:
+    return "\n".join(iter_pdf_pages(path)).strip()
+
+def extract_text_from_docx(path: str) -> str:
+    return "\n".join(iter_docx_pages(path)).strip()
+
+def extract_text_from_xlsx(path: str) -> str:
+    return "\n".join(iter_xlsx_pages(path)).strip()
+
+def extract_text_any(path: str) -> Tuple[str, str]:
+    """(kind, text) を返す"""
+    kind, pages = extract_pages_any(path)
+    return kind, "".join(pages) if kind == "txt" else "\n".join(pages).strip()
 
 # ---------- チャンク分割（素朴） ----------
+class StreamChunker:
+    """
+    日本語：文字列を少しずつ受け取りながら chunk_text と同じ切り方でチャンクを出す。
+    feed() は確定したチャンクを返し、finish() で残りを吐き出す。
+    """
+
+    def __init__(self, size: int = 800, overlap: int = 120):
+        self.size = size
+        self.step = max(1, size - overlap)
+        self._buf = ""
+
+    def feed(self, text: str) -> List[str]:
+        self._buf += text.replace("\r\n", "\n")
+        out = []
+        while len(self._buf) >= self.size:
+            out.append(self._buf[:self.size])
+            self._buf = self._buf[self.step:]
+        return [c.strip() for c in out if c.strip()]
+
+    def finish(self) -> List[str]:
+        out = []
+        while self._buf:
+            out.append(self._buf[:self.size])
+            self._buf = self._buf[self.step:]
+        return [c.strip() for c in out if c.strip()]
+
 def chunk_text(text: str, size: int = 800, overlap: int = 120) -> List[str]:
-    text = text.replace("\r\n", "\n")
-    out, i, n = [], 0, len(text)
-    while i < n:
-        out.append(text[i:i+size])
-        i += max(1, size - overlap)
-    return [c.strip() for c in out if c.strip()]
-
-# ---------- FAISS の読み書き ----------
-def _load_or_new_index() -> faiss.IndexFlatIP:
-    if os.path.exists(INDEX_PATH):
-        return faiss.read_index(INDEX_PATH)
-    return faiss.IndexFlatIP(DIM)  # 内積類似度
-
-def _save_index(index: faiss.IndexFlatIP):
-    faiss.write_index(index, INDEX_PATH)
-
-def _append_meta(rows: List[Dict]):
-    with open(META_PATH, "a", encoding="utf-8") as f:
-        for r in rows:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
-
-def _load_all_meta() -> List[Dict]:
-    if not os.path.exists(META_PATH): return []
+    c = StreamChunker(size, overlap)
+    return c.feed(text) + c.finish()
+
+# ---------- チャンク分割（文の区切り + トークン数。資料の取り込みで使う。chunker.py） ----------
+# RAG_CHUNKER=fixed で従来の固定長（800 文字 + 重なり 120）に戻せる
+RAG_CHUNKER = os.getenv("RAG_CHUNKER", "sentence").lower()
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "32"))  # 長い1文を分割するときだけの重なり（トークン）
+
+def _token_counter() -> Tuple[Callable[[str], int], int]:
+    """日本語：(トークン数を数える関数, 1チャンクの上限)。上限はモデルの最大系列長 - 特殊トークン2個"""
+    tok = getattr(_model, "tokenizer", None)
+    max_len = int(getattr(_model, "max_seq_length", None) or 256)
+    limit = int(os.getenv("RAG_CHUNK_TOKENS", "0")) or max_len - 2
+    if tok is None or not callable(tok):
+        return estimate_tokens, limit
+    return (lambda text: len(tok(text, add_special_tokens=False, verbose=False)["input_ids"])), limit
+
+count_tokens, CHUNK_TOKENS = _token_counter()
+
+def new_chunker():
+    """日本語：資料の取り込み用のチャンク分割器（feed / finish）"""
+    if RAG_CHUNKER == "fixed":
+        return StreamChunker()
+    return SentenceChunker(CHUNK_TOKENS, count_tokens, RAG_CHUNK_OVERLAP)
+
+# ---------- FAISS / メタの読み書き ----------
+# 日本語コメント：インデックスは IndexIDMap2 で包み、各チャンクに安定した ID（int64）を振る。
+#   メタ（metastore.py）は ID 付きの追記ログ（行の追加/更新、{"id":..., "deleted": true} で削除）。
+#   削除はまずトゥームストーン（検索時に IDSelector で除外）にし、削除済みの割合が
+#   RAG_COMPACT_RATIO を超えたらバックグラウンドでインデックスとメタを作り直す（コンパクション）。
+RAG_COMPACT_RATIO = float(os.getenv("RAG_COMPACT_RATIO", "0.2"))
+RAG_COMPACT_MIN = int(os.getenv("RAG_COMPACT_MIN", "64"))  # これ未満の削除数ではコンパクションしない
+
+_SQ_TYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+def _new_flat(store: Optional[str] = None) -> faiss.Index:
+    """日本語：全件走査の空 index（内積類似度）。fp16 は学習不要なので最初から半精度で持つ"""
+    store = RAG_STORE if store is None else store
+    if store == "fp16":
+        return faiss.IndexIDMap2(faiss.IndexScalarQuantizer(DIM, _SQ_TYPES["fp16"], faiss.METRIC_INNER_PRODUCT))
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(DIM))
+
+def _new_compressed(xb: np.ndarray, store: Optional[str] = None, min_train: int = RAG_STORE_TRAIN_MIN) -> faiss.Index:
+    """日本語：xb で学習した全件走査の圧縮 index（sq8 / pq）。学習に足りなければ _new_flat"""
+    store = RAG_STORE if store is None else store
+    if store in ("sq8", "pq") and len(xb) >= max(min_train, 1):
+        if store == "sq8":
+            inner = faiss.IndexScalarQuantizer(DIM, _SQ_TYPES["sq8"], faiss.METRIC_INNER_PRODUCT)
+        else:
+            inner = faiss.IndexPQ(DIM, RAG_STORE_PQ_M, 8, faiss.METRIC_INNER_PRODUCT)
+        inner.train(xb)
+        return faiss.IndexIDMap2(inner)
+    return _new_flat(store)
+
+def _is_lossy(index: faiss.Index) -> bool:
+    """日本語：ベクトルを圧縮して持っているか（検索後に厳密な再採点が要る）"""
+    inner = _inner(index)
+    return not isinstance(inner, (faiss.IndexFlat, faiss.IndexIVFFlat, faiss.IndexHNSWFlat))
+
+def _load_index(path: Optional[str]) -> Tuple[faiss.Index, bool]:
+    """
+    日本語：(index, mmap で開いたか) を返す（path が None なら空の index）。ファイルが無ければ OSError。
+    ベクトル本体は mmap で開くので、複数ワーカーが同じファイルを開いてもページキャッシュを共有する。
+    mmap 中の index には追加できないため、書き込む前に _own_index_locked でメモリ上のコピーに切り替える。
+    """
+    if path is None:
+        return _new_flat(), False
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    try:
+        return _apply_search_params(faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC)), True
+    except RuntimeError:
+        return _apply_search_params(faiss.read_index(path)), False
+
+def _index_ids(index: faiss.Index) -> Set[int]:
+    return set(faiss.vector_to_array(index.id_map).tolist()) if index.ntotal else set()
+
+def _inner(index: faiss.Index) -> faiss.Index:
+    """IndexIDMap2 の中身（Flat / IVF / HNSW）"""
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+
+# ---------- ANN（IVF / HNSW）----------
+def _apply_search_params(index: faiss.Index) -> faiss.Index:
+    """日本語：再現率ノブ（nprobe / efSearch）を反映"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = RAG_NPROBE
+    inner = _inner(index)
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = RAG_EF_SEARCH
+    return index
+
+def _search_params(index: faiss.Index, sel) -> faiss.SearchParameters:
+    """日本語：IDSelector 付きの検索パラメータ（インデックス種別ごとに型が違う）"""
+    if faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(sel=sel, nprobe=RAG_NPROBE)
+    if hasattr(_inner(index), "hnsw"):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=RAG_EF_SEARCH)
+    return faiss.SearchParameters(sel=sel)
+
+def _target_nlist(n: int) -> int:
+    return int(min(65536, max(16, 4 * np.sqrt(n))))
+
+def _needs_rebuild(index: faiss.Index) -> bool:
+    n = index.ntotal
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return ivf.nlist * 2 < _target_nlist(n)
+    if hasattr(_inner(index), "hnsw"):
+        return False
+    # 全件走査：ANN への昇格か、sq8 / pq の学習
+    if RAG_ANN in ("ivf", "hnsw") and n >= RAG_ANN_THRESHOLD:
+        return True
+    return RAG_STORE in ("sq8", "pq") and isinstance(_inner(index), faiss.IndexFlat) and n >= RAG_STORE_TRAIN_MIN
+
+def _vectors(index: faiss.Index, i0: int, i1: int) -> np.ndarray:
+    """行 i0..i1-1 のベクトルを取り出す（PQ の場合は近似値）。index は IDMap の中身"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index.reconstruct_n(i0, i1 - i0)
+
+def _dump(index: faiss.Index, start: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """日本語：(ID 配列, ベクトル) を格納順に返す（start 行目以降）"""
+    n = index.ntotal
+    if n <= start:
+        return np.zeros(0, "int64"), np.zeros((0, DIM), "float32")
+    ids = faiss.vector_to_array(index.id_map)[start:n]
+    return ids, _vectors(_inner(index), start, n)
+
+def _build_ann(xb: np.ndarray, ids: np.ndarray) -> faiss.Index:
+    """日本語：xb と各行の ID から ANN インデックスを作る"""
+    n = len(xb)
+    pq_m = RAG_PQ_M or (RAG_STORE_PQ_M if RAG_STORE == "pq" else 0)
+    if RAG_ANN == "hnsw":
+        if RAG_STORE in _SQ_TYPES:
+            inner = faiss.IndexHNSWSQ(DIM, _SQ_TYPES[RAG_STORE], RAG_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            inner.train(xb[np.random.default_rng(0).choice(n, min(n, 100000), replace=False)])
+        else:
+            inner = faiss.IndexHNSWFlat(DIM, RAG_HNSW_M, faiss.METRIC_INNER_PRODUCT)  # pq は HNSW では使わない
+        inner.hnsw.efConstruction = 80
+    else:
+        nlist = _target_nlist(n)
+        quantizer = faiss.IndexFlatIP(DIM)
+        if pq_m:
+            inner = faiss.IndexIVFPQ(quantizer, DIM, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+        elif RAG_STORE in _SQ_TYPES:
+            inner = faiss.IndexIVFScalarQuantizer(quantizer, DIM, nlist, _SQ_TYPES[RAG_STORE],
+                                                  faiss.METRIC_INNER_PRODUCT)
+        else:
+            inner = faiss.IndexIVFFlat(quantizer, DIM, nlist, faiss.METRIC_INNER_PRODUCT)
+        sample = xb[np.random.default_rng(0).choice(n, min(n, max(nlist * 64, 256 * 39 if pq_m else 0)), replace=False)]
+        inner.train(sample)
+    index = faiss.IndexIDMap2(inner)
+    index.add_with_ids(xb, ids)
+    return _apply_search_params(index)
+
+def _build_index(xb: np.ndarray, ids: np.ndarray) -> faiss.Index:
+    """日本語：件数に応じて Flat か ANN を作る（コンパクション・旧形式の移行で使用）"""
+    if RAG_ANN in ("ivf", "hnsw") and len(xb) >= RAG_ANN_THRESHOLD:
+        return _build_ann(xb, ids)
+    index = _new_compressed(xb)
+    if len(xb):
+        index.add_with_ids(xb, ids)
+    return index
+
+def _load_all_meta(path: str = META_PATH) -> List[Dict]:
+    # 日本語：壊れた行も {} として残す（旧形式では行番号 = FAISS の行番号 なので崩さない）
+    if not os.path.exists(path): return []
     out = []
-    with open(META_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line: continue
             try: out.append(json.loads(line))
-            except: pass
+            except: out.append({})
     return out
 
-def _encode(texts: List[str]) -> np.ndarray:
+def _atomic_write(path: str, data: bytes):
+    """日本語：一時ファイルに書いて fsync → rename（途中で落ちても壊れたファイルを残さない）"""
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _read_legacy_generation(path: str = GEN_PATH) -> int:
+    try:
+        with open(path, "r", encoding="ascii") as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+# ---------- manifest（index とメタの2相コミット）----------
+# 日本語コメント：保存は
+#   1) 準備：新しい faiss-<世代>.index を書き、メタを確定済みの範囲の後ろへ追記
+#      （コンパクション時は meta-<n> を新しく書く）
+#   2) 確定：manifest.json（どの index ファイルか・meta-<n> の何レコード/何バイト目までか）を rename で差し替える
+#   3) 後片付け：前の世代の index / meta ファイルを消す
+# の順。読み手は manifest.json だけを見るので、index とメタは常に同じ世代の組で見える。
+# 1) の途中で落ちても manifest は前の世代を指したまま（書きかけは次の保存か起動時の check で消える）。
+_EMPTY_MANIFEST = {"version": 1, "generation": 0, "index": None, "meta": 0, "records": 0, "blob": 0, "next_id": 0}
+_MANIFEST_KEYS = tuple(_EMPTY_MANIFEST)
+_INDEX_FILE = re.compile(r"^faiss-(\d+)\.index$")
+_META_FILE = re.compile(r"^meta-(\d+)\.(rec|blob)$")
+
+def _read_manifest(path: str = MANIFEST_PATH) -> Optional[Dict]:
+    """日本語：manifest.json（無い・壊れているときは None）"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            m = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return m if isinstance(m, dict) and all(k in m for k in _MANIFEST_KEYS) else None
+
+def _manifest_sig(path: str) -> Optional[Tuple[int, int, int]]:
+    """日本語：manifest.json の (mtime_ns, サイズ, inode)。差し替えられると変わるので、読み直しの要否をこれで判断する"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+def _write_manifest(path: str, m: Dict):
+    """日本語：manifest を原子的に差し替える（ここがコミット点）。rename をディレクトリごと fsync する"""
+    _atomic_write(path, json.dumps(m).encode("utf-8"))
+    if os.name != "nt":
+        fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _remove_quiet(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # Windows では他プロセスが開いていると消せない（次の check で掃除）
+
+_OWNER_FIELDS = ("mat_id", "title", "filepath", "kind", "chunk_id", "ns")  # 行のうち「どの資料の何番目か」
+
+def _with_owner(row: Dict, own: Dict) -> Dict:
+    """日本語：行の主たる資料を own に置き換えた行"""
+    base = {k: v for k, v in row.items() if k not in _OWNER_FIELDS}
+    return {**base, **{k: own[k] for k in _OWNER_FIELDS if k in own}}
+
+def _owners(row: Dict) -> List[Dict]:
+    """日本語：このチャンクを含む資料（同一チャンクは1行にまとめ、2つ目以降の資料は also に持つ）"""
+    return [row] + list(row.get("also", ()))
+
+def make_namespaces(course: Optional[str] = None, owner: Optional[str] = None) -> List[str]:
+    """日本語：資料に付ける名前空間タグ（mat:<mat_id> は全資料に自動で付く）"""
+    out = []
+    if course:
+        out.append(f"course:{course.strip()}")
+    if owner:
+        out.append(f"owner:{owner.strip()}")
+    return out
+
+def _namespaces(row: Dict) -> Set[str]:
+    out = set()
+    for o in _owners(row):
+        out.add(f"mat:{o['mat_id']}")
+        out.update(o.get("ns", ()))
+    return out
+
+
+class IndexManager:
+    """
+    日本語：FAISS インデックスとメタ情報をメモリに常駐させる。
+    - 初回だけディスクから読み込み、以後の検索はメモリ上で完結（毎回の read_index / メタの全パースをやめる）
+    - メタ（本文など）は metastore.py の mmap ストアにあり、ヒットした行だけを読む。
+      未保存の変更は _overlay に持つ
+    - add / 削除はメモリに反映し、保存はバックグラウンドスレッドでまとめて行う（manifest.json による2相コミット）
+    - 他プロセスが保存して manifest の世代が進んだときだけ読み直す
+    - チャンクは ID で管理。ディスク上は「index にあってメタに無い ID」が削除済み（トゥームストーン）
+    - 書き込みはプロセス間の書き込みロック（writer.lock）を持って行う。最初の変更で取り、
+      変更がすべて保存されたら手放す。取った時点でディスクが進んでいれば読み直してから変更する
+      （複数ワーカーが同時に取り込んでも互いの追加を上書きしない・chunk ID が重ならない）
+    - 生成時（起動時）に書き込みロックが空いていれば、旧形式の移行と整合性の修復（check）を行う
+    """
+
+    def __init__(self, rag_dir: str = RAG_DIR,
+                 raw_vectors: Optional[Callable[[List[str]], Dict[str, np.ndarray]]] = None):
+        self.rag_dir = rag_dir
+        self._raw = raw_vectors            # 本文ハッシュ → float32 ベクトル（圧縮した index の再採点・作り直し用）
+        self.manifest_path = os.path.join(rag_dir, "manifest.json")
+        self.legacy_index_path = os.path.join(rag_dir, "faiss.index")  # 旧形式
+        self.meta_path = os.path.join(rag_dir, "meta.jsonl")  # 旧形式
+        self.legacy_gen_path = os.path.join(rag_dir, "generation")  # 旧形式
+        self._lock = threading.RLock()     # メモリ上の index / meta を守る
+        self._io_lock = threading.Lock()   # 保存処理どうしの直列化
+        self._wlock = FileLock(os.path.join(rag_dir, "writer.lock"))  # プロセス間の書き込みロック
+        self._lease = threading.Lock()     # _wlock の取得/解放と _writers を守る（順序：_io_lock → _lease → _lock）
+        self._writers = 0                  # 書き込みロックを使っている処理の数（0 かつ保存済みなら手放す）
+        self._index = None
+        self._mapped = False               # index を mmap で開いている（読み取り専用）
+        self._store: Optional[MetaStore] = None
+        self._manifest: Dict = dict(_EMPTY_MANIFEST)  # 最後に読み込んだ/書き出した manifest
+        self._overlay: Dict[int, Optional[Dict]] = {}  # 未保存の行（None は削除）
+        self._live: Set[int] = set()       # 生きている chunk ID
+        self._deleted: Set[int] = set()    # index に残っている削除済み ID
+        self._sel = None                   # 削除済みを除外する IDSelector（削除のたびに作り直す）
+        self._by_hash: Dict[str, int] = {} # チャンク本文の sha256 → ID（重複チャンクの除外用）
+        self._by_ns: Dict[str, Set[int]] = {}   # 名前空間 → その名前空間に属する行の ID（"mat:<id>" も含む）
+        self._ns_sel: Dict[str, Any] = {}  # 名前空間ごとの IDSelector（行が変わるたびに捨てる）
+        self._lex = NgramIndex()           # chunk ID → 本文の BM25 索引（ハイブリッド検索の字面側）
+        self._next_id = 0
+        self._log: List[Dict] = []         # メタストアへ未追記の変更
+        self._rewrite = False              # True ならメタストアを生きている行だけで書き直す
+        self.generation = 0                # メモリ上の世代（変更のたびに +1）
+        self._disk_generation = 0          # 最後に読み込んだ/書き出したディスク上の世代
+        self._manifest_sig = None          # 最後に見た manifest.json の _manifest_sig（変わったときだけ読み直す）
+        self._dirty = False
+        self._wake = threading.Event()
+        self._writer = None
+        self._rebuilding = False
+        self._holds = 0                    # deferred_commit() の入れ子数（>0 の間はバックグラウンド保存しない）
+        self._closed = False
+        # 他プロセスが書き込み中なら、そのプロセスが既に移行・修復を済ませている
+        if self._wlock.acquire(blocking=False):
+            try:
+                self._adopt_legacy()
+                report = self._check_files(repair=True)
+            finally:
+                self._wlock.release()
+            if not report["ok"]:
+                print("[RAG] repaired index files:", json.dumps(report, ensure_ascii=False))
+
+    # --- 読み込み ---
+    def _path(self, name: str) -> str:
+        return os.path.join(self.rag_dir, name)
+
+    def _open_committed(self) -> Tuple[Dict, faiss.Index, bool, MetaStore]:
+        """
+        日本語：manifest が指す (manifest, index, mmap か, メタストア) を開く。
+        開く間に他プロセスのコンパクションで古いファイルが消されたら、manifest を読み直して開き直す。
+        """
+        for attempt in range(5):
+            m = _read_manifest(self.manifest_path) or dict(_EMPTY_MANIFEST)
+            try:
+                index, mapped = _load_index(self._path(m["index"]) if m["index"] else None)
+                store = MetaStore(self.rag_dir, m["meta"], m["records"], m["blob"])
+                return m, index, mapped, store
+            except (OSError, ValueError):
+                if attempt == 4:
+                    raise
+                time.sleep(0.05)
+
+    def _load_locked(self):
+        self._manifest_sig = _manifest_sig(self.manifest_path)  # 読む前に取る（読んだ内容はこれ以降の版）
+        m, index, mapped, store = self._open_committed()
+        if self._store is not None:
+            self._store.close()
+        ids = _index_ids(index)
+        # manifest の範囲内なら index とメタは同じ世代。念のため ID を突き合わせ、ベクトルの無い行は使わない
+        live = store.ids() & ids
+        self._index, self._mapped, self._store, self._manifest = index, mapped, store, m
+        self._overlay, self._live = {}, live
+        self._deleted = ids - live
+        self._sel = None
+        self._by_hash, self._by_ns, self._ns_sel = {}, {}, {}
+        self._lex = NgramIndex()
+        for row in store.iter_rows():
+            if row["id"] in live:
+                self._register_locked(row["id"], row)
+                self._lex.add(row["id"], row["text"])
+        self._next_id = max(self._next_id, m["next_id"], max(ids, default=-1) + 1, store.max_id + 1)
+        self._log = []
+        self._disk_generation = m["generation"]
+        self.generation = max(self.generation + 1, self._disk_generation)
+        self._rewrite = False
+        self._dirty = False
+
+    # --- 旧形式の移行・整合性チェック（書き込みロック内）---
+    def _adopt_legacy(self):
+        """
+        日本語：manifest.json 導入前のファイル（faiss.index / generation / meta.current、
+        さらに古い meta.jsonl、ID の無い index）を manifest 形式に移す
+        """
+        legacy = [p for p in (self.legacy_index_path, self.meta_path, self._path("meta.current"),
+                              self._path("meta-0.rec")) if os.path.exists(p)]
+        if (not legacy or os.path.exists(self.manifest_path)
+                or any(_INDEX_FILE.match(name) for name in os.listdir(self.rag_dir))):
+            return  # 新形式（manifest が壊れていれば _check_files が直す）
+        index = faiss.read_index(self.legacy_index_path) if os.path.exists(self.legacy_index_path) else _new_flat()
+        if not isinstance(index, faiss.IndexIDMap2):
+            # 旧形式（meta の行番号 = FAISS の行番号）→ 行番号をそのまま chunk ID にする
+            n = index.ntotal
+            print(f"[RAG] migrating {n} vectors to an ID-mapped index")
+            index = _build_index(_vectors(index, 0, n), np.arange(n, dtype="int64")) if n else _new_flat()
+        n = read_legacy_current(self.rag_dir)
+        if os.path.exists(self.meta_path):
+            rows = self._legacy_jsonl_rows()
+            print(f"[RAG] migrating {len(rows)} rows from meta.jsonl to the binary metadata store")
+            n += 1
+            store = MetaStore.create(self.rag_dir, n, rows)
+        else:
+            store = MetaStore(self.rag_dir, n)
+        gen = _read_legacy_generation(self.legacy_gen_path) + 1
+        name = f"faiss-{gen}.index"
+        _atomic_write(self._path(name), faiss.serialize_index(index).tobytes())
+        records, blob = store.extent
+        ids = _index_ids(index)
+        _write_manifest(self.manifest_path, {
+            "version": 1, "generation": gen, "index": name, "meta": n, "records": records, "blob": blob,
+            "next_id": max(max(ids, default=-1), store.max_id) + 1})
+        store.close()
+        if os.path.exists(self.meta_path):
+            os.replace(self.meta_path, self.meta_path + ".bak")
+        for p in (self.legacy_index_path, self.legacy_gen_path, self._path("meta.current")):
+            _remove_quiet(p)
+
+    def _legacy_jsonl_rows(self) -> List[Dict]:
+        """日本語：旧 meta.jsonl（行番号形式 / ID 付きログ形式）の生きている行（ID 順）"""
+        entries = _load_all_meta(self.meta_path)
+        rows: Dict[int, Dict] = {}
+        if any("id" in e for e in entries):
+            for e in entries:
+                if "id" not in e:
+                    continue
+                if e.get("deleted"):
+                    rows.pop(e["id"], None)
+                else:
+                    rows[e["id"]] = e
+        else:
+            rows = {i: {**m, "id": i} for i, m in enumerate(entries) if m.get("text")}
+        return [rows[i] for i in sorted(rows)]
+
+    def _check_files(self, repair: bool) -> Dict:
+        """
+        日本語：ディスク上の manifest / index / メタの整合性を調べる
+        （repair=True なら直す。書き込みロック内で呼ぶこと）。
+        - manifest が無い・壊れている → 残っている最新の faiss-<g>.index と meta-<n> から作り直す
+        - manifest の指す index / メタが無い → 残っている最新のものに切り替える
+        - 確定済みの範囲より後ろのメタ（保存途中で落ちた書きかけ）→ 切り詰める
+        - ベクトルの無いメタ行 → 削除として追記する
+        - どこからも指されていないファイル・一時ファイル → 消す
+        """
+        d = self.rag_dir
+        problems: List[str] = []
+        index_files: Dict[int, str] = {}
+        meta_gens: Set[int] = set()
+        tmp_files: List[str] = []
+        for name in os.listdir(d):
+            if _INDEX_FILE.match(name):
+                index_files[int(_INDEX_FILE.match(name).group(1))] = name
+            elif _META_FILE.match(name):
+                meta_gens.add(int(_META_FILE.match(name).group(1)))
+            elif ".tmp." in name and os.path.isfile(os.path.join(d, name)):
+                tmp_files.append(name)
+        m = _read_manifest(self.manifest_path)
+        if m is None:
+            if os.path.exists(self.manifest_path) or index_files:
+                problems.append("manifest_corrupt" if os.path.exists(self.manifest_path) else "manifest_missing")
+            g = max(index_files, default=0)
+            n = max(meta_gens, default=0)
+            records, blob = file_extent(d, n)
+            m = {**_EMPTY_MANIFEST, "generation": g, "index": index_files.get(g), "meta": n,
+                 "records": records, "blob": blob}
+        m = dict(m)
+        if m["index"] and not os.path.exists(os.path.join(d, m["index"])):
+            problems.append("index_missing")
+            others = sorted(g for g, name in index_files.items() if name != m["index"])
+            m["index"] = index_files[others[-1]] if others else None
+        meta_files = (os.path.join(d, f"meta-{m['meta']}.rec"), os.path.join(d, f"meta-{m['meta']}.blob"))
+        if m["records"] and not all(os.path.exists(p) for p in meta_files):
+            problems.append("meta_missing")
+            others = sorted(meta_gens - {m["meta"]})
+            m["meta"] = others[-1] if others else 0
+            m["records"], m["blob"] = file_extent(d, m["meta"])
+        index, _ = _load_index(os.path.join(d, m["index"]) if m["index"] else None)
+        ids = _index_ids(index)
+        del index
+        store = MetaStore(d, m["meta"], m["records"], m["blob"])
+        try:
+            if store.extent != (m["records"], m["blob"]):
+                problems.append("meta_truncated")  # manifest より短い（外から壊された）。読める範囲だけ使う
+                m["records"], m["blob"] = store.extent
+            f_recs, f_blob = file_extent(d, m["meta"])
+            tail = (f_recs - m["records"], f_blob - m["blob"])
+            if tail != (0, 0):
+                problems.append("uncommitted_tail")
+            orphans = sorted(store.ids() - ids)
+            if orphans:
+                problems.append("orphan_rows")
+            invalid = store.invalid_records()
+            keep = {m["index"], f"meta-{m['meta']}.rec", f"meta-{m['meta']}.blob"}
+            stray = sorted(tmp_files + [x for x in index_files.values() if x not in keep]
+                           + [f"meta-{k}.{ext}" for k in meta_gens if k != m["meta"] for ext in ("rec", "blob")
+                              if os.path.exists(os.path.join(d, f"meta-{k}.{ext}"))])
+            if stray:
+                problems.append("stray_files")
+            next_id = max(m["next_id"], max(ids, default=-1) + 1, store.max_id + 1)
+            if next_id != m["next_id"]:
+                problems.append("next_id")
+            report = {
+                "ok": not problems, "problems": problems, "repaired": repair and bool(problems),
+                "generation": m["generation"], "vectors": len(ids), "rows": len(store),
+                "tombstones": len(ids - store.ids()), "orphan_rows": len(orphans), "invalid_records": invalid,
+                "uncommitted_records": max(0, tail[0]), "uncommitted_bytes": max(0, tail[1]), "stray_files": stray,
+            }
+            if not (repair and problems):
+                return report
+            store.truncate_uncommitted()
+            store.append([{"id": i, "deleted": True} for i in orphans])
+            m["records"], m["blob"] = store.extent
+        finally:
+            store.close()
+        m.update(generation=m["generation"] + 1, next_id=next_id)
+        _write_manifest(self.manifest_path, m)
+        for name in stray:
+            _remove_quiet(os.path.join(d, name))
+        return report
+
+    def check(self, repair: bool = False) -> Dict:
+        """日本語：整合性チェック（python -m backend.rag check [--repair]）。repair 時は未保存分を先に保存する"""
+        if repair:
+            self.flush()
+        with self._writing():
+            report = self._check_files(repair)
+            if report["repaired"]:
+                with self._lock:
+                    if not self._dirty:
+                        self._load_locked()
+        return report
+
+    def _own_index_locked(self):
+        """日本語：mmap で開いた index を、書き込める（メモリ上に持つ）コピーに切り替える"""
+        if self._mapped:
+            self._index = _apply_search_params(faiss.deserialize_index(faiss.serialize_index(self._index)))
+            self._mapped = False
+
+    def _ensure_fresh_locked(self):
+        if self._index is None:
+            self._load_locked()
+        elif not self._dirty:
+            # 読むたびに manifest を開いて JSON を解釈しないよう、ファイルが差し替えられたときだけ読む
+            sig = _manifest_sig(self.manifest_path)
+            if sig == self._manifest_sig:
+                return
+            self._manifest_sig = sig
+            if (_read_manifest(self.manifest_path) or _EMPTY_MANIFEST)["generation"] > self._disk_generation:
+                self._load_locked()  # 他プロセスが更新した
+
+    @contextmanager
+    def _writing(self):
+        """
+        日本語：プロセス間の書き込みロックを持った状態で変更する（変更系メソッドはすべてこの中で _lock を取る）。
+        ロックを新たに取ったときは、他プロセスの保存に追いついてから変更させる。
+        手放すのは、使っている処理が無く、変更がすべて保存済みになったとき（_release_if_idle）。
+        """
+        with self._lease:
+            if not self._wlock.locked:
+                self._wlock.acquire()  # 他プロセスが保存し終えるまで待つ
+                with self._lock:
+                    self._ensure_fresh_locked()
+            self._writers += 1
+        try:
+            yield
+        finally:
+            with self._lease:
+                self._writers -= 1
+            self._release_if_idle()
+
+    def _release_if_idle(self):
+        with self._lease:
+            with self._lock:
+                idle = self._writers == 0 and not self._dirty and not self._rebuilding
+            if idle and self._wlock.locked:
+                self._wlock.release()
+
+    # --- 行の出し入れ（ロック内） ---
+    def _row_locked(self, i: int) -> Optional[Dict]:
+        """日本語：chunk ID → 行。未保存の変更を優先し、無ければメタストア（mmap）から読む"""
+        if i not in self._live:
+            return None
+        if i in self._overlay:
+            return self._overlay[i]
+        return self._store.get(i)
+
+    def _hash_locked(self, i: int) -> Optional[str]:
+        row = self._row_locked(i)
+        return None if row is None else (row.get("h") or text_hash(row["text"]))
+
+    def _raw_fill(self, hashes: List[Optional[str]], xb: np.ndarray) -> np.ndarray:
+        """日本語：xb（index から復元した近似ベクトル）のうち、埋め込みキャッシュにある行を元の float32 に置き換える"""
+        if self._raw is None or not len(xb):
+            return xb
+        got = self._raw([h for h in hashes if h])
+        if not got:
+            return xb
+        xb = np.array(xb, dtype="float32", copy=True)
+        for k, h in enumerate(hashes):
+            v = got.get(h) if h else None
+            if v is not None:
+                xb[k] = v
+        return xb
+
+    def _register_locked(self, i: int, row: Dict):
+        self._by_hash[row.get("h") or text_hash(row["text"])] = i
+        for ns in _namespaces(row):
+            self._by_ns.setdefault(ns, set()).add(i)
+
+    def _unregister_locked(self, i: int, row: Dict):
+        h = row.get("h") or text_hash(row["text"])
+        if self._by_hash.get(h) == i:
+            del self._by_hash[h]
+        for ns in _namespaces(row):
+            s = self._by_ns.get(ns)
+            if s is not None:
+                s.discard(i)
+                if not s:
+                    del self._by_ns[ns]
+
+    def _put_locked(self, row: Dict):
+        old = self._row_locked(row["id"])
+        if old is not None:
+            self._unregister_locked(row["id"], old)
+        self._overlay[row["id"]] = row
+        self._live.add(row["id"])
+        self._register_locked(row["id"], row)
+        if old is None or old["text"] != row["text"]:
+            self._lex.add(row["id"], row["text"])
+        self._ns_sel.clear()
+        self._log.append(row)
+
+    def _delete_locked(self, i: int):
+        self._unregister_locked(i, self._row_locked(i))
+        self._overlay[i] = None
+        self._live.discard(i)
+        self._lex.remove(i)
+        self._deleted.add(i)
+        self._sel = None
+        self._ns_sel.clear()
+        self._log.append({"id": i, "deleted": True})
+
+    def _touch_locked(self) -> bool:
+        """日本語：変更を確定。ANN 昇格かコンパクションが必要なら True（呼び出し側でスレッド起動）"""
+        self.generation += 1
+        self._dirty = True
+        if self._rebuilding:
+            return False
+        n = self._index.ntotal
+        compact = len(self._deleted) >= RAG_COMPACT_MIN and len(self._deleted) >= RAG_COMPACT_RATIO * n
+        self._rebuilding = compact or _needs_rebuild(self._index)
+        return self._rebuilding
+
+    def _after_change(self, rebuild: bool):
+        if rebuild:
+            threading.Thread(target=self._rebuild, daemon=True).start()
+        self._schedule_persist()
+
+    # --- 参照 / 追加 / 削除 ---
+    def search(self, qv: np.ndarray, top_k: int, namespace: Optional[str] = None) -> List[Dict]:
+        """日本語：ベクトル検索。namespace を渡すとその名前空間のチャンクだけを対象にする"""
+        return self.search_many(qv[:1], top_k, namespace)[0]
+
+    def search_many(self, qvs: np.ndarray, top_k: int, namespace: Optional[str] = None) -> List[List[Dict]]:
+        """日本語：複数クエリ（qvs の各行）を1回の FAISS 検索で引き、クエリごとの結果を返す"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            if self._index.ntotal == 0 or len(qvs) == 0:
+                return [[] for _ in range(len(qvs))]
+            rerank = bool(RAG_RERANK and self._raw is not None and _is_lossy(self._index))
+            k = top_k * RAG_RERANK if rerank else top_k  # 圧縮形式では多めに取って後で厳密に採点し直す
+            if namespace is not None:
+                scores, idxs = self._search_ns_locked(qvs, k, namespace)
+            else:
+                params = None
+                if self._deleted:
+                    if self._sel is None:
+                        self._sel = faiss.IDSelectorNot(
+                            faiss.IDSelectorBatch(np.fromiter(self._deleted, dtype="int64")))
+                    params = _search_params(self._index, self._sel)
+                scores, idxs = self._index.search(qvs, k, params=params)
+            out = []
+            for srow, irow in zip(scores, idxs):
+                res = []
+                for score, idx in zip(srow, irow):
+                    row = self._row_locked(int(idx))
+                    if row:
+                        m = dict(row)
+                        m["_score"] = float(score)
+                        res.append(m)
+                out.append(res)
+        if rerank:
+            self._rerank(qvs, out, top_k)
+        return out
+
+    def _rerank(self, qvs: np.ndarray, out: List[List[Dict]], top_k: int):
+        """日本語：候補を埋め込みキャッシュの float32 ベクトルで採点し直し、上位 top_k に絞る（out を書き換える）"""
+        hashes = [h.get("h") or text_hash(h["text"]) for res in out for h in res]
+        got = self._raw(hashes) if hashes else {}
+        for q, res in zip(qvs, out):
+            for h in res:
+                v = got.get(h.get("h") or text_hash(h["text"]))
+                if v is not None:
+                    h["_score"] = float(np.dot(v, q))
+            res.sort(key=lambda h: h["_score"], reverse=True)
+            del res[top_k:]
+
+    def _search_ns_locked(self, qvs: np.ndarray, top_k: int, namespace: str) -> Tuple[np.ndarray, np.ndarray]:
+        ids = self._by_ns.get(namespace)
+        if not ids:
+            return np.zeros((len(qvs), 0), "float32"), np.zeros((len(qvs), 0), "int64")
+        if len(ids) <= RAG_NS_EXACT_MAX:
+            # 小さい名前空間：該当ベクトルだけ取り出して厳密に採点
+            idx = np.fromiter(ids, dtype="int64", count=len(ids))
+            ivf = faiss.try_extract_index_ivf(self._index)
+            if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+                ivf.make_direct_map()
+            scores = qvs @ self._index.reconstruct_batch(idx).T
+            order = np.argsort(-scores, axis=1)[:, :top_k]
+            return np.take_along_axis(scores, order, axis=1), idx[order]
+        sel = self._ns_sel.get(namespace)
+        if sel is None:
+            sel = self._ns_sel[namespace] = faiss.IDSelectorBatch(np.fromiter(ids, dtype="int64", count=len(ids)))
+        return self._index.search(qvs, top_k, params=_search_params(self._index, sel))
+
+    def lexical_search(self, query: str, top_k: int, namespace: Optional[str] = None) -> List[Dict]:
+        """日本語：BM25（文字 bi-gram）で上位 top_k 行。採点は NgramIndex 側のロックだけ（ベクトル検索と並行可）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            lex = self._lex
+            allowed = None
+            if namespace is not None:
+                allowed = frozenset(self._by_ns.get(namespace, ()))
+                if not allowed:
+                    return []
+        ranked = lex.search(query, top_k, max_df_ratio=RAG_LEX_MAX_DF, allowed=allowed)
+        res = []
+        with self._lock:
+            for i, sc in ranked:
+                row = self._row_locked(i)
+                if row:
+                    res.append({**row, "_bm25": float(sc)})
+        return res
+
+    def add(self, vecs: np.ndarray, rows: List[Dict]):
+        """日本語：rows に新しい chunk ID（"id"）を振って追加する"""
+        with self._writing():
+            with self._lock:
+                self._ensure_fresh_locked()
+                ids = np.arange(self._next_id, self._next_id + len(rows), dtype="int64")
+                self._next_id += len(rows)
+                self._own_index_locked()
+                self._index.add_with_ids(vecs, ids)
+                for i, r in zip(ids.tolist(), rows):
+                    r["id"] = i
+                    self._put_locked(r)
+                rebuild = self._touch_locked()
+            self._after_change(rebuild)
+
+    def add_owner(self, mat: Dict, refs: List[Tuple[int, str]]):
+        """
+        日本語：既に索引済みのチャンク（refs = [(chunk_id, sha256)]）を資料 mat にも含まれるものとして記録する。
+        ベクトルは共有し、資料を削除しても他の資料が参照している行は残す。
+        """
+        with self._writing():
+            with self._lock:
+                self._ensure_fresh_locked()
+                changed = False
+                for cid, h in refs:
+                    i = self._by_hash.get(h)
+                    if i is None:
+                        continue
+                    row = self._row_locked(i)
+                    own = {**mat, "chunk_id": cid}
+                    if row["mat_id"] == mat["mat_id"]:
+                        new = _with_owner(row, own)  # 差し替え：タイトル・ファイル・順番・名前空間を新しい版に
+                    else:
+                        also = [a for a in row.get("also", ()) if a["mat_id"] != mat["mat_id"]]
+                        new = {**row, "also": also + [own]}
+                    if new != row:
+                        self._put_locked(new)
+                        changed = True
+                rebuild = self._touch_locked() if changed else False
+            if changed:
+                self._after_change(rebuild)
+
+    def drop_material(self, mat_id: str, keep: Optional[Set[str]] = None) -> int:
+        """
+        日本語：資料 mat_id を索引から外す（keep に含まれるハッシュのチャンクは残す＝差し替え用）。
+        他の資料も含む行は所有者を付け替えるだけで、どこからも参照されなくなった行をトゥームストーンにする。
+        削除した行数を返す。
+        """
+        keep = keep or set()
+        with self._writing():
+            with self._lock:
+                self._ensure_fresh_locked()
+                removed = 0
+                for i in sorted(self._by_ns.get(f"mat:{mat_id}", ())):
+                    row = self._row_locked(i)
+                    if row.get("h") in keep:
+                        continue
+                    others = [a for a in row.get("also", ()) if a["mat_id"] != mat_id]
+                    if row["mat_id"] != mat_id:
+                        self._put_locked({**row, "also": others})
+                    elif others:
+                        self._put_locked({**_with_owner(row, others[0]), "also": others[1:]})
+                    else:
+                        self._delete_locked(i)
+                        removed += 1
+                rebuild = self._touch_locked()
+            self._after_change(rebuild)
+            return removed
+
+    def material_files(self, mat_id: str) -> Set[str]:
+        """日本語：資料 mat_id のチャンクが指している元ファイル"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            out = set()
+            for i in self._by_ns.get(f"mat:{mat_id}", ()):
+                out.update(o["filepath"] for o in _owners(self._row_locked(i)) if o["mat_id"] == mat_id)
+            return out
+
+    def material_hashes(self, mat_id: str) -> Set[str]:
+        """日本語：資料 mat_id に含まれるチャンク本文のハッシュ（差分更新で残す行の判定用）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            return {self._hash_locked(i) for i in self._by_ns.get(f"mat:{mat_id}", ())}
+
+    def material_namespaces(self, mat_id: str) -> List[str]:
+        """日本語：資料 mat_id に付いている名前空間タグ（mat:<id> を除く）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            for i in self._by_ns.get(f"mat:{mat_id}", ()):
+                for o in _owners(self._row_locked(i)):
+                    if o["mat_id"] == mat_id:
+                        return list(o.get("ns", ()))
+            return []
+
+    def tag_material(self, mat_id: str, namespaces: List[str]):
+        """日本語：資料 mat_id に名前空間タグを足す（同じファイルが別の講義で再アップロードされたとき）"""
+        with self._writing():
+            with self._lock:
+                self._ensure_fresh_locked()
+                changed = False
+                for i in sorted(self._by_ns.get(f"mat:{mat_id}", ())):
+                    row = self._row_locked(i)
+                    owners = _owners(row)
+                    for k, o in enumerate(owners):
+                        if o["mat_id"] == mat_id and not set(namespaces) <= set(o.get("ns", ())):
+                            owners[k] = {**o, "ns": list(dict.fromkeys([*o.get("ns", ()), *namespaces]))}
+                            changed = True
+                    if owners != _owners(row):
+                        self._put_locked({**_with_owner(row, owners[0]), "also": owners[1:]})
+                rebuild = self._touch_locked() if changed else False
+            if changed:
+                self._after_change(rebuild)
+
+    def has_material(self, mat_id: str) -> bool:
+        with self._lock:
+            self._ensure_fresh_locked()
+            return f"mat:{mat_id}" in self._by_ns
+
+    def namespaces(self) -> Dict[str, int]:
+        """日本語：名前空間ごとのチャンク数（mat:<id> を除く）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            return {ns: len(ids) for ns, ids in sorted(self._by_ns.items()) if not ns.startswith("mat:")}
+
+    def _rebuild(self):
+        """
+        日本語：Flat → IVF/HNSW への昇格、IVF の再学習、削除済みの掃除（コンパクション）をまとめて行う。
+        学習はロック外で行い、その間に追加された行は差し替え直前に追いつかせる。
+        書き込みロックは持ったまま行う（学習中に他プロセスが保存すると、差し替えた index がそれを上書きするため）。
+        """
+        with self._writing():
+            try:
+                with self._lock:
+                    self._own_index_locked()
+                    old = self._index
+                    n0 = old.ntotal
+                    ids, xb = _dump(old)
+                    dead = set(self._deleted)
+                    # 圧縮形式から復元したベクトルで作り直すと誤差が重なるので、元の float32 を使う
+                    hashes = [self._hash_locked(i) for i in ids.tolist()] if _is_lossy(old) else None
+                t0 = time.time()
+                if hashes is not None:
+                    xb = self._raw_fill(hashes, xb)
+                if dead:
+                    live = ~np.isin(ids, np.fromiter(dead, dtype="int64"))
+                    ids, xb = ids[live], xb[live]
+                new = _build_index(xb, ids)
+                with self._lock:
+                    if self._index is not old:
+                        return  # 途中で読み直しが入った
+                    if old.ntotal > n0:
+                        ids2, xb2 = _dump(old, n0)
+                        new.add_with_ids(xb2, ids2)
+                    self._index = new
+                    self._deleted -= dead  # 学習中に削除された行はトゥームストーンのまま残る
+                    self._sel = None
+                    self._rewrite = self._rewrite or bool(dead)  # meta も生きている行だけで書き直す
+                    self.generation += 1
+                    self._dirty = True
+                print(f"[RAG] index rebuilt as {type(_inner(new)).__name__} "
+                      f"({new.ntotal} vectors, {len(dead)} purged, {time.time() - t0:.1f}s)")
+                self._schedule_persist()
+            except Exception as e:
+                print("[RAG] index rebuild failed:", e)
+            finally:
+                with self._lock:
+                    self._rebuilding = False
+
+    def measure_recall(self, k: int = 10, n_queries: int = 200) -> Dict:
+        """
+        日本語：現在のインデックスの recall@k を厳密検索（IndexFlatIP）と比較して測る。
+        正解側は埋め込みキャッシュの元の float32 ベクトル（無い行だけ index からの復元値）。
+        クエリは格納済みベクトルにノイズを加えたもの。圧縮形式では再採点後（search_many）の値も出す。
+        """
+        with self._lock:
+            self._ensure_fresh_locked()
+            index = self._index
+            ids, xb = _dump(index)
+            keep = np.isin(ids, np.fromiter(self._live, dtype="int64", count=len(self._live)))
+            ids, xb = ids[keep], xb[keep]
+            hashes = [self._hash_locked(i) for i in ids.tolist()]
+        if len(xb) == 0:
+            return {"n": 0}
+        xb = self._raw_fill(hashes, xb)
+        rng = np.random.default_rng(0)
+        xq = xb[rng.choice(len(xb), min(n_queries, len(xb)), replace=False)]
+        xq = xq + rng.normal(scale=0.05, size=xq.shape).astype("float32")
+        faiss.normalize_L2(xq)
+        exact = faiss.IndexFlatIP(DIM)
+        exact.add(xb)
+        t0 = time.time(); _, gt = exact.search(xq, k); t_exact = time.time() - t0
+        with self._lock:
+            t0 = time.time(); _, got = index.search(xq, k); t_ann = time.time() - t0
+        t0 = time.time(); reranked = self.search_many(xq, k); t_rr = time.time() - t0
+        truth = [set(ids[g].tolist()) for g in gt]
+        hits = sum(len(t & set(a.tolist())) for t, a in zip(truth, got))
+        hits_rr = sum(len(t & {h["id"] for h in r}) for t, r in zip(truth, reranked))
+        return {
+            "index": type(_inner(index)).__name__, "lossy": _is_lossy(index), "n": len(ids), "k": k,
+            "queries": len(xq), "index_bytes": int(faiss.serialize_index(index).nbytes),
+            "recall_at_k": hits / (k * len(xq)),
+            "recall_at_k_search": hits_rr / (k * len(xq)),
+            "ms_per_query_exact": 1000 * t_exact / len(xq),
+            "ms_per_query_index": 1000 * t_ann / len(xq),
+            "ms_per_query_search": 1000 * t_rr / len(xq),
+        }
+
+    def current_generation(self) -> int:
+        """日本語：今の索引の世代（他プロセスの保存も反映する）。変更のたびに増える"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            return self.generation
+
+    def live_hashes(self) -> List[str]:
+        """日本語：生きている行の本文ハッシュ（ID 順）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            return [self._hash_locked(i) for i in sorted(self._live)]
+
+    def missing_chunks(self, hashes: List[str]) -> List[bool]:
+        """日本語：各ハッシュがまだ索引に無ければ True"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            return [h not in self._by_hash for h in hashes]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._ensure_fresh_locked()
+            return {"index": type(_inner(self._index)).__name__, "vectors": int(self._index.ntotal),
+                    "live": len(self._live), "mmap": self._mapped, "deleted": len(self._deleted),
+                    "materials": sum(ns.startswith("mat:") for ns in self._by_ns),
+                    "generation": self._disk_generation, "writer": self._wlock.locked}
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._ensure_fresh_locked()
+            return len(self._live)
+
+    # --- 保存 ---
+    def _schedule_persist(self):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+                self._writer.start()
+        self._wake.set()
+
+    def _writer_loop(self):
+        while True:
+            self._wake.wait()
+            if self._closed:
+                return
+            time.sleep(PERSIST_DELAY_SEC)  # 連続 add をまとめる
+            self._wake.clear()
+            with self._lock:
+                if self._holds:
+                    continue  # deferred_commit() を抜けるときにまとめて保存する
+            try:
+                self.flush()
+            except Exception as e:
+                print("[RAG] persist failed:", e)
+
+    @contextmanager
+    def deferred_commit(self):
+        """
+        日本語：この中の変更はバックグラウンドで保存せず、抜けるときに1回で保存する（一括取り込み用）。
+        間、書き込みロックを持ち続ける（他ワーカーの書き込みは抜けるまで待つ）。途中で保存したければ flush()。
+        """
+        with self._writing():
+            with self._lock:
+                self._holds += 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self._holds -= 1
+                self.flush()
+
+    def flush(self):
+        """日本語：未保存の変更を今すぐディスクへ（終了時にも呼ばれる）。書き込みロックを持って2相コミットする"""
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+            with self._writing():
+                self._commit()
+
+    def close(self):
+        """日本語：保存してから手放す（テナントをメモリから外すとき）。以後このオブジェクトは使わない"""
+        while self._rebuilding:  # ANN への作り直しが終わるのを待つ（終われば保存される）
+            time.sleep(0.1)
+        self.flush()
+        self._closed = True
+        self._wake.set()  # バックグラウンド保存のスレッドを終わらせる
+        self._release_if_idle()
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+            self._index = None
+
+    def _commit(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            buf = faiss.serialize_index(self._index)  # メモリ上でコピー（ロックは短時間）
+            rewrite = self._rewrite
+            rows = [self._row_locked(i) for i in sorted(self._live)] if rewrite else None
+            log, pending = self._log, dict(self._overlay)
+            self._log, self._rewrite = [], False
+            gen, next_id, old = self.generation, self._next_id, self._manifest
+            self._dirty = False
+        name = f"faiss-{gen}.index"
+        store = None
+        try:
+            # 1) 準備：manifest が指すまで誰からも使われないファイルを書く
+            _atomic_write(os.path.join(self.rag_dir, name), buf.tobytes())
+            if rewrite:
+                store = MetaStore.create(self.rag_dir, old["meta"] + 1, rows)
+            else:
+                self._store.append(log)
+            st = store or self._store
+            records, blob = st.extent
+            m = {"version": 1, "generation": gen, "index": name, "meta": st.n,
+                 "records": records, "blob": blob, "next_id": next_id}
+            # 2) 確定
+            _write_manifest(self.manifest_path, m)
+        except Exception:
+            if store is not None:
+                store.close()
+            with self._lock:  # 次回は全体を書き直す（未追記のログを失わないため）
+                self._rewrite = self._dirty = True
+            raise
+        # 3) 後片付け（読み手は manifest を読み直して新しいファイルを開く。mmap 済みの古いファイルは消しても読める）
+        if old["index"] and old["index"] != name:
+            _remove_quiet(os.path.join(self.rag_dir, old["index"]))
+        with self._lock:
+            if store is not None:
+                self._store.close()
+                self._store = store
+            for i, row in pending.items():  # ストアに書けた行は overlay から外す
+                if self._overlay.get(i, row) is row:
+                    self._overlay.pop(i, None)
+            self._disk_generation = gen
+            self._manifest = m
+            self._manifest_sig = _manifest_sig(self.manifest_path)  # 書き込みロック中なので自分の書いた版
+        if store is not None:
+            remove_files(self.rag_dir, old["meta"])
+
+
+def tenant_dir(name: str, tenant: Optional[str] = None) -> str:
+    """日本語：テナントの保存先 name（"rag" / "materials"）。既定テナントは RAG_DIR / MATS_DIR"""
+    t = tenants.validate(tenant or tenants.current())
+    path = os.path.join(DATA_DIR if t == tenants.DEFAULT_TENANT else tenants.data_dir(t), name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class _TenantRag:
+    """日本語：テナント1つ分の資料索引と埋め込みキャッシュ（取り込み済みファイルの記録もテナントごと）"""
+
+    def __init__(self, tenant: str):
+        self.rag_dir, self.mats_dir = tenant_dir("rag", tenant), tenant_dir("materials", tenant)
+        self.cache = EmbeddingCache(os.path.join(self.rag_dir, "ingest_cache.db"), _EMB_KEY)
+        self.manager = IndexManager(self.rag_dir, raw_vectors=self.cache.get_many)
+
+    def close(self):
+        self.manager.close()
+        self.cache.close()
+
+# 使われなくなったテナントの索引は保存してメモリから外す（次に使われたら manifest から読み直す）
+_rags = tenants.TenantMap(_TenantRag, close=_TenantRag.close, name="rag")
+_rags.get(tenants.DEFAULT_TENANT)  # 既定テナントは起動時に開く（旧形式の移行・整合性の修復もここで）
+atexit.register(_rags.close_all)
+
+def _mgr() -> IndexManager:
+    """日本語：今のテナントの資料索引"""
+    return _rags.get().manager
+
+def _ecache() -> EmbeddingCache:
+    return _rags.get().cache
+
+def embedding_cache(tenant: Optional[str] = None) -> EmbeddingCache:
+    """日本語：テナントの埋め込みキャッシュ（recindex の索引の再採点・作り直し用）"""
+    return _rags.get(tenant).cache
+
+def materials_dir() -> str:
+    """日本語：今のテナントのアップロード資料の保存先"""
+    return _rags.get().mats_dir
+
+def _encode_now(texts: List[str]) -> np.ndarray:
     vecs = _model.encode(texts, normalize_embeddings=True)
-    return np.array(vecs, dtype="float32")
+    return np.array(vecs, dtype="float32").reshape(len(texts), DIM)
+
+# 同時に来た検索クエリを数 ms 束ねて1回で埋め込む（RAG_ENCODE_MAX_BATCH / RAG_ENCODE_MAX_WAIT_MS）
+_encoder = BatchEncoder(_encode_now)
+
+def _encode(texts: List[str]) -> np.ndarray:
+    return _encoder.encode(texts)
+
+_qvec_cache = LRUCache(RAG_QCACHE_SIZE)
+_result_cache = LRUCache(RAG_RESULT_CACHE_SIZE, ttl=RAG_RESULT_TTL)
+
+def normalize_query(text: str) -> str:
+    """日本語：キャッシュのキー用（NFKC・空白の連続をまとめる・小文字化）"""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).lower()
+
+def _encode_queries(texts: List[str]) -> np.ndarray:
+    """日本語：検索クエリの埋め込み（キャッシュに無いものだけ1バッチで計算）"""
+    keys = [normalize_query(t) for t in texts]
+    vecs: List[Optional[np.ndarray]] = [_qvec_cache.get(k) for k in keys]
+    todo = [i for i, v in enumerate(vecs) if v is None]
+    if todo:
+        for i, v in zip(todo, _encode([texts[i] for i in todo])):
+            _qvec_cache.put(keys[i], v)
+            vecs[i] = v
+    return np.stack(vecs).astype("float32") if vecs else np.zeros((0, DIM), "float32")
+
+def _cached_result(kind: str, text: str, top_k: int, namespace: Optional[str], compute) -> Dict:
+    """日本語：同じ検索が TTL 内に来たら前回の結果を返す（索引の世代が変わっていれば計算し直す）"""
+    if RAG_RESULT_TTL <= 0:
+        return compute()
+    gen = _mgr().current_generation()
+    key = (tenants.current(), kind, text_hash(normalize_query(text)), top_k, namespace)
+    hit = _result_cache.get(key)
+    if hit is not None and hit[0] == gen:
+        res = hit[1]
+        return {**res, "hits": [dict(h) for h in res["hits"]], "cached": True}
+    res = compute()
+    _result_cache.put(key, (gen, {**res, "hits": [dict(h) for h in res["hits"]]}))
+    return res
+
+def _encode_cached(texts: List[str], hashes: List[str]) -> np.ndarray:
+    """日本語：埋め込みキャッシュを引き、無いものだけモデルで計算してキャッシュへ書き足す"""
+    got = _ecache().get_many(hashes)
+    todo = [i for i, h in enumerate(hashes) if h not in got]
+    if todo:
+        fresh = _encode([texts[i] for i in todo])
+        _ecache().put_many([(hashes[i], v) for i, v in zip(todo, fresh)])
+        for i, v in zip(todo, fresh):
+            got[hashes[i]] = v
+    return np.stack([got[h] for h in hashes]).astype("float32") if hashes else np.zeros((0, DIM), "float32")
+
+# ---------- 取り込みの各段（同期版 add_material_and_index と ingest.py のパイプラインで共用） ----------
+def find_ingested_file(filepath: str) -> Tuple[str, Optional[Dict]]:
+    """日本語：(ファイル sha256, 取り込み済みならその記録) を返す"""
+    fsha = file_hash(filepath)
+    prev = _ecache().lookup_file(fsha)
+    if prev and not _mgr().has_material(prev["mat_id"]):
+        prev = None  # 記録だけ残って索引に無い（保存前に落ちた）なら取り込み直す
+    return fsha, prev
+
+def remember_ingested_file(fsha: str, mat_id: str, title: str, kind: str, chunks: int):
+    _ecache().forget_material(mat_id)  # 差し替え時は旧ファイルの記録を消す
+    _ecache().remember_file(fsha, mat_id, title, kind, chunks)
+
+def _remove_material_files(paths: Set[str]):
+    # 日本語：アップロードで保存したコピー（テナントの資料フォルダ配下）だけ消す
+    mats = materials_dir()
+    for p in paths:
+        if os.path.dirname(os.path.abspath(p)) == mats:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+def has_material(mat_id: str) -> bool:
+    return _mgr().has_material(mat_id)
+
+def material_namespaces(mat_id: str) -> List[str]:
+    return _mgr().material_namespaces(mat_id)
+
+def tag_material(mat_id: str, namespaces: List[str]):
+    if namespaces:
+        _mgr().tag_material(mat_id, namespaces)
+
+def list_namespaces() -> Dict[str, int]:
+    return _mgr().namespaces()
+
+def delete_material(mat_id: str) -> Optional[Dict]:
+    """日本語：資料を索引から削除（トゥームストーン化）し、保存したファイルも消す。無ければ None"""
+    if not _mgr().has_material(mat_id):
+        return None
+    files = _mgr().material_files(mat_id)
+    removed = _mgr().drop_material(mat_id)
+    _ecache().forget_material(mat_id)
+    _remove_material_files(files)
+    return {"ok": True, "mat_id": mat_id, "removed_chunks": removed}
+
+def finish_replace(mat_id: str, filepath: str, keep: Set[str]) -> int:
+    """
+    日本語：差し替え（同じ mat_id で新しいファイルを取り込み済み）の仕上げ。
+    新しい版に無いチャンク（keep 外）を削除し、旧ファイルを消す。削除した行数を返す。
+    """
+    old_files = _mgr().material_files(mat_id) - {filepath}
+    removed = _mgr().drop_material(mat_id, keep=keep)
+    _remove_material_files(old_files)
+    return removed
+
+def index_stats() -> Dict:
+    return {**_mgr().stats(), "tenant": tenants.current(), "tenants": _rags.stats(), "encoder": _encoder.stats(),
+            "query_cache": _qvec_cache.stats(), "result_cache": _result_cache.stats()}
+
+def check_index(repair: bool = False) -> Dict:
+    """日本語：index / メタ / manifest の整合性チェック（repair=True なら修復）"""
+    return _mgr().check(repair)
+
+def new_chunk_rows(mat: Dict, numbered: List[Tuple[int, str]], seen: Set[str]) -> List[Dict]:
+    """
+    日本語：(chunk_id, 本文) のリストからメタ行を作る。
+    同じ資料内で既出（seen）のチャンクは除外し、既に索引済みのチャンクは行を作らず
+    「この資料にも含まれる」とだけ記録する（資料削除時に他の資料の分まで消さないため）。
+    seen には資料内の全チャンクのハッシュがたまる（差し替え時に残す行の判定に使う）。
+    mat = {"mat_id","title","filepath","kind","ns"}（ns は名前空間タグのリスト。無くてもよい）
+    """
+    hashes = [text_hash(ch) for _, ch in numbered]
+    rows, shared = [], []
+    for (i, ch), h, missing in zip(numbered, hashes, _mgr().missing_chunks(hashes)):
+        if h in seen:
+            continue
+        seen.add(h)
+        if missing:
+            rows.append({**mat, "chunk_id": i, "h": h, "text": ch})
+        else:
+            shared.append((i, h))
+    if shared:
+        _mgr().add_owner(mat, shared)
+    return rows
+
+def share_chunks(mat: Dict, refs: List[Tuple[int, str]]):
+    """日本語：索引済みのチャンク refs = [(chunk_id, sha256)] を資料 mat にも含まれるものとして記録する"""
+    if refs:
+        _mgr().add_owner(mat, refs)
+
+def bulk_commit():
+    """日本語：with rag.bulk_commit(): の中の追加・削除を最後に1回で保存する（ingest.bulk_ingest 用）"""
+    return _mgr().deferred_commit()
+
+def flush_index():
+    _mgr().flush()
+
+def embed_rows(rows: List[Dict]) -> np.ndarray:
+    return _encode_cached([r["text"] for r in rows], [r["h"] for r in rows])
+
+def check_chunk_quota(adding: int = 1):
+    """日本語：今のテナントの資料チャンク数が上限（TENANT_MAX_CHUNKS）を超えるなら tenants.QuotaExceeded"""
+    if tenants.TENANT_MAX_CHUNKS:
+        tenants.check_quota("chunks", len(_mgr()), tenants.TENANT_MAX_CHUNKS, adding)
+
+def index_rows(vecs: np.ndarray, rows: List[Dict]):
+    if rows:
+        check_chunk_quota(len(rows))
+        _mgr().add(vecs, rows)  # メモリ上で追加、保存はバックグラウンド
+
+def iter_chunks(pages: Iterator[str], chunker=None) -> Iterator[str]:
+    """日本語：ページのイテレータからチャンクを逐次取り出す（文書全体を連結しない）"""
+    c = chunker or new_chunker()
+    for page in pages:
+        yield from c.feed(page + "\n")
+    yield from c.finish()
+
+def iter_batches(items: Iterator, n: int) -> Iterator[List]:
+    buf = []
+    for x in items:
+        buf.append(x)
+        if len(buf) >= n:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
 
 # ---------- 追加 & 検索 ----------
-def add_material_and_index(title: str, filepath: str) -> Dict:
-    """ファイルから抽出→分割→埋め込み→FAISS 追加"""
-    kind, text = extract_text_any(filepath)
-    if not text:
+def add_material_and_index(title: str, filepath: str, namespaces: Optional[List[str]] = None) -> Dict:
+    """
+    ファイルから抽出→分割→埋め込み→FAISS 追加（同期版。API では ingest.py のパイプラインを使う）
+    - ページ → チャンク → EMBED_BATCH 件ずつの埋め込み、と逐次流すのでメモリは文書サイズに比例しない
+    - 内容が同じファイルは再処理せず already_indexed=True を返す
+    - 既に索引済みの同一チャンクは追加しない（改訂版の共通ページなど）
+    - 埋め込みはキャッシュ優先
+    """
+    fsha, prev = find_ingested_file(filepath)
+    if prev:
+        tag_material(prev["mat_id"], list(namespaces or []))
+        return {"ok": True, "already_indexed": True, "mat_id": prev["mat_id"],
+                "chunks": prev["chunks"], "kind": prev["kind"]}
+
+    kind, pages = extract_pages_any(filepath)
+    if kind == "unknown":
         return {"ok": False, "error": "テキスト抽出に失敗", "kind": kind}
-    chunks = chunk_text(text)
-    if not chunks:
+    mat = {"mat_id": str(uuid.uuid4()), "title": title, "filepath": filepath, "kind": kind,
+           "ns": list(namespaces or [])}
+    seen: Set[str] = set()
+    n_chunks = n_new = 0
+    for batch in iter_batches(enumerate(iter_chunks(pages)), EMBED_BATCH):
+        rows = new_chunk_rows(mat, batch, seen)
+        index_rows(embed_rows(rows), rows)
+        n_chunks += len(batch)
+        n_new += len(rows)
+    if not n_chunks:
         return {"ok": False, "error": "有効なテキストなし", "kind": kind}
+    remember_ingested_file(fsha, mat["mat_id"], title, kind, n_chunks)
+    return {"ok": True, "mat_id": mat["mat_id"], "chunks": n_chunks, "new_chunks": n_new, "kind": kind}
+
+_search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-search")
+
+def _vector_leg(query: str, n: int, namespace: Optional[str]) -> Tuple[List[Dict], float]:
+    t0 = time.perf_counter()
+    hits = _mgr().search(_encode_queries([query]), n, namespace)
+    return hits, 1000 * (time.perf_counter() - t0)
+
+def _lexical_leg(query: str, n: int, namespace: Optional[str]) -> Tuple[List[Dict], float]:
+    t0 = time.perf_counter()
+    hits = _mgr().lexical_search(query, n, namespace)
+    return hits, 1000 * (time.perf_counter() - t0)
 
-    vecs = _encode(chunks)
-    index = _load_or_new_index()
-    index.add(vecs)
-    _save_index(index)
+def rrf_fuse(legs: List[List[Dict]], top_k: int, k: int = RAG_RRF_K) -> List[Dict]:
+    """
+    日本語：Reciprocal Rank Fusion。各方式での順位 r から 1/(k + r) を足し合わせて並べ直す。
+    スコアの尺度（内積 / BM25）が違っても順位だけで統合できる。
+    """
+    fused: Dict[int, Dict] = {}
+    for hits in legs:
+        for rank, h in enumerate(hits, start=1):
+            cur = fused.setdefault(h["id"], {**h, "_score": 0.0})
+            cur.update({key: v for key, v in h.items() if key.startswith("_") and key != "_score"})
+            cur["_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda h: h["_score"], reverse=True)[:top_k]
 
-    mat_id = str(uuid.uuid4())
+def query_windows(text: str, size: int = RAG_QUERY_WINDOW, overlap: int = RAG_QUERY_OVERLAP,
+                  max_windows: int = RAG_QUERY_MAX_WINDOWS) -> List[str]:
+    """日本語：長い文章（講義の文字起こし）を検索用の窓に分ける。多すぎるときは全体から等間隔に選ぶ"""
+    wins = chunk_text(text, size, overlap)
+    if len(wins) > max_windows:
+        pick = np.linspace(0, len(wins) - 1, max_windows).round().astype(int)
+        wins = [wins[i] for i in sorted(set(pick.tolist()))]
+    return wins
+
+def _windows_leg(windows: List[str], n: int, namespace: Optional[str]) -> Tuple[List[Dict], float]:
+    """
+    日本語：全窓を1バッチで埋め込み、1回の FAISS 検索で引いて、チャンクごとに最高スコアでまとめる
+    （重なった窓が同じチャンクを引いても1件。"_windows" はそのチャンクを引いた窓の数）
+    """
+    t0 = time.perf_counter()
+    merged: Dict[int, Dict] = {}
+    for hits in _mgr().search_many(_encode_queries(windows), n, namespace):
+        for h in hits:
+            cur = merged.get(h["id"])
+            if cur is None:
+                merged[h["id"]] = {**h, "_windows": 1}
+            else:
+                cur["_windows"] += 1
+                cur["_score"] = max(cur["_score"], h["_score"])
+    hits = sorted(merged.values(), key=lambda h: h["_score"], reverse=True)[:n]
+    return hits, 1000 * (time.perf_counter() - t0)
+
+def _hybrid(vector_leg, query: str, top_k: int, namespace: Optional[str]) -> Dict:
+    t0 = time.perf_counter()
+    if len(_mgr()) == 0:
+        return {"hits": [], "latency_ms": {"total": 0.0}}
+    n = top_k * RAG_HYBRID_FETCH if RAG_HYBRID else top_k
+    f_vec = _search_pool.submit(tenants.bind(vector_leg), n)
+    f_lex = _search_pool.submit(tenants.bind(_lexical_leg), query, n, namespace) if RAG_HYBRID else None
+    vec, t_vec = f_vec.result()
+    for h in vec:
+        h["_vec_score"] = h.pop("_score")
+    latency = {"vector": round(t_vec, 2)}
+    if f_lex is None:
+        hits = [{**h, "_score": h["_vec_score"]} for h in vec[:top_k]]
+    else:
+        lex, t_lex = f_lex.result()
+        t1 = time.perf_counter()
+        hits = rrf_fuse([vec, lex], top_k)
+        latency.update(lexical=round(t_lex, 2), fuse=round(1000 * (time.perf_counter() - t1), 2))
+    latency["total"] = round(1000 * (time.perf_counter() - t0), 2)
+    return {"hits": hits, "latency_ms": latency}
+
+def hybrid_search(query: str, top_k: int = 5, namespace: Optional[str] = None) -> Dict:
+    """
+    日本語：ベクトル検索と BM25 を並行に走らせ、RRF で統合した上位 top_k を返す。
+    namespace（"course:..." / "owner:..." / "mat:<mat_id>"）を渡すと、その名前空間の資料だけから探す。
+    戻り値：{"hits": [...], "latency_ms": {"vector", "lexical", "fuse", "total"}}
+    hits の "_score" は RRF スコア、"_vec_score"（内積）/ "_bm25" はそれぞれの素点（その方式で候補に入った場合）
+    直近（RAG_RESULT_TTL 秒以内・索引の変更なし）に同じ検索があればその結果を返す（"cached": True）
+    """
+    return _cached_result("q", query, top_k, namespace,
+                          lambda: _hybrid(lambda n: _vector_leg(query, n, namespace), query, top_k, namespace))
+
+def transcript_search(transcript: str, top_k: int = 5, namespace: Optional[str] = None) -> Dict:
+    """
+    日本語：講義の文字起こし全体を手がかりに資料を探す（要約の参考資料用）。
+    MiniLM は約256トークンで入力を切り捨てるため、全文を1クエリにすると冒頭の1分ほどしか効かない。
+    窓（RAG_QUERY_WINDOW 文字）に分けて一括で埋め込み・検索し、BM25（全文）と RRF で統合する。
+    戻り値は hybrid_search と同じ形 + "windows"（使った窓の数）
+    """
+    def compute() -> Dict:
+        windows = query_windows(transcript)
+        if not windows:
+            return {"hits": [], "latency_ms": {"total": 0.0}, "windows": 0}
+        res = _hybrid(lambda n: _windows_leg(windows, n, namespace), transcript, top_k, namespace)
+        res["windows"] = len(windows)
+        return res
+    return _cached_result("t", transcript, top_k, namespace, compute)
+
+def search_similar(query: str, top_k: int = 5, namespace: Optional[str] = None) -> List[Dict]:
+    return hybrid_search(query, top_k, namespace)["hits"]
+
+
+# =============================================================================
+# ベンチマーク：python -m backend.rag recall [k]
+#               python -m backend.rag storage [k]（格納形式ごとのメモリと recall）
+#               python -m backend.rag chunking <資料ファイル...>（チャンク分割の比較）
+# 整合性チェック：python -m backend.rag check [--repair]
+# =============================================================================
+def bench_storage(k: int = 10, n_queries: int = 200, n_random: int = 20000) -> List[Dict]:
+    """
+    日本語：格納形式（flat / fp16 / sq8 / pq）ごとに、1ベクトルあたりのバイト数と
+    recall@k（そのまま / 上位 k×RAG_RERANK 件を float32 で再採点）を厳密検索と比べて測る。
+    索引済みチャンクの元のベクトル（埋め込みキャッシュ）を使い、1000 件未満なら乱数ベクトルで代用する
+    （乱数は構造が無いので pq には不利。実データでの値を見ること）。
+    """
+    got = _ecache().get_many(_mgr().live_hashes())
+    if len(got) >= 1000:
+        xb, source = np.stack(list(got.values())).astype("float32"), "index"
+    else:
+        xb = np.random.default_rng(1).standard_normal((n_random, DIM)).astype("float32")
+        faiss.normalize_L2(xb)
+        source = "random"
+    ids = np.arange(len(xb), dtype="int64")
+    rng = np.random.default_rng(0)
+    xq = xb[rng.choice(len(xb), min(n_queries, len(xb)), replace=False)]
+    xq = xq + rng.normal(scale=0.05, size=xq.shape).astype("float32")
+    faiss.normalize_L2(xq)
+    exact = faiss.IndexFlatIP(DIM)
+    exact.add(xb)
+    _, gt = exact.search(xq, k)
+    truth = [set(g.tolist()) for g in gt]
+    kk = k * max(RAG_RERANK, 1)
     rows = []
-    for i, ch in enumerate(chunks):
-        rows.append({"mat_id": mat_id, "title": title, "filepath": filepath, "kind": kind, "chunk_id": i, "text": ch})
-    _append_meta(rows)
-    return {"ok": True, "mat_id": mat_id, "chunks": len(chunks), "kind": kind}
-
-def search_similar(query: str, top_k: int = 5) -> List[Dict]:
-    meta = _load_all_meta()
-    if not meta: return []
-    index = _load_or_new_index()
-    if index.ntotal == 0: return []
-    qv = _encode([query])
-    scores, idxs = index.search(qv, top_k)
-    res = []
-    for score, idx in zip(scores[0], idxs[0]):
-        if 0 <= idx < len(meta):
-            m = dict(meta[idx])
-            m["_score"] = float(score)
-            res.append(m)
-    return res
+    for store in ("flat", "fp16", "sq8", "pq"):
+        t0 = time.time()
+        index = _new_compressed(xb, store, min_train=0)
+        index.add_with_ids(xb, ids)
+        t_build = time.time() - t0
+        t0 = time.time(); _, cand = index.search(xq, kk); t_search = time.time() - t0
+        t0 = time.time()
+        reranked = [c[np.argsort(-(xb[c] @ q))[:k]] for q, c in zip(xq, cand)]
+        t_rr = time.time() - t0
+        rows.append({
+            "store": store, "source": source, "n": len(xb), "k": k,
+            "bytes_per_vector": round(faiss.serialize_index(index).nbytes / len(xb), 1),
+            "recall_at_k": sum(len(t & set(c[:k].tolist())) for t, c in zip(truth, cand)) / (k * len(xq)),
+            "recall_at_k_reranked": sum(len(t & set(r.tolist())) for t, r in zip(truth, reranked)) / (k * len(xq)),
+            "build_sec": round(t_build, 2),
+            "ms_per_query": round(1000 * (t_search + t_rr) / len(xq), 3),
+        })
+    return rows
+
+def bench_chunking(paths: List[str], embed: bool = True) -> List[Dict]:
+    """
+    日本語：資料ファイル群を固定長（fixed）と文区切り（sentence）で分割し、チャンク数・トークン数・
+    上限超え（モデルが後ろを切り捨てる）チャンク数・分割と埋め込みの時間を比べる（埋め込みキャッシュは使わない）。
+    """
+    rows = []
+    for name, make in (("fixed", StreamChunker),
+                       ("sentence", lambda: SentenceChunker(CHUNK_TOKENS, count_tokens, RAG_CHUNK_OVERLAP))):
+        t0 = time.time()
+        chunks = []
+        for p in paths:
+            _, pages = extract_pages_any(p)
+            chunks += list(iter_chunks(pages, make()))
+        t_chunk = time.time() - t0
+        toks = [count_tokens(c) for c in chunks]
+        t0 = time.time()
+        for batch in iter_batches(iter(chunks), EMBED_BATCH):
+            if embed:
+                _encode_now(batch)
+        rows.append({
+            "chunker": name, "files": len(paths), "chunks": len(chunks),
+            "mean_tokens": round(float(np.mean(toks)), 1) if toks else 0.0,
+            "tokens_total": int(sum(toks)), "tokens_embedded": int(sum(min(t, CHUNK_TOKENS) for t in toks)),
+            "over_limit": sum(t > CHUNK_TOKENS for t in toks), "token_limit": CHUNK_TOKENS,
+            "chunk_sec": round(t_chunk, 2), "embed_sec": round(time.time() - t0, 2) if embed else None,
+        })
+    return rows
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "recall":
+        k = int(sys.argv[2]) if len(sys.argv) >= 3 else 10
+        print(json.dumps(_mgr().measure_recall(k=k), ensure_ascii=False, indent=2))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "storage":
+        k = int(sys.argv[2]) if len(sys.argv) >= 3 else 10
+        for row in bench_storage(k=k):
+            print(json.dumps(row, ensure_ascii=False))
+    elif len(sys.argv) >= 3 and sys.argv[1] == "chunking":
+        for row in bench_chunking(sys.argv[2:]):
+            print(json.dumps(row, ensure_ascii=False))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "check":
+        report = check_index(repair="--repair" in sys.argv[2:])
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        sys.exit(0 if report["ok"] or report["repaired"] else 1)
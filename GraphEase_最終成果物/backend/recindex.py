@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# recindex.py — 講義録音の区間を意味で検索するための索引（配布資料とは別の FAISS 索引）
+# 日本語コメント：
+#   録音の segments を RAG_REC_UNIT 文字程度のまとまりに束ね、1まとまり = 1行（start/end 付き）として埋め込む。
+#   storage.add_record / update_fields から録音 ID が通知され、バックグラウンドスレッドが差分だけ反映する
+#     - 本文が変わっていないまとまりは行もベクトルもそのまま（本文ハッシュで判定）
+#     - 消えた/変わったまとまりだけ削除し、新しいものだけ埋め込む（埋め込みキャッシュも効く）
+#   転写が編集されても segments は元のままなので、segments のまとまりを転写の中から先頭側から順に探し、
+#   見つからなかった部分（編集された箇所）は、その位置にあったまとまりの時間帯を割り当てる。
+#   索引・保存の仕組み（manifest.json・書き込みロック・複数ワーカー）は rag.IndexManager と同じ。
+#   索引はテナントごと（<テナントのデータフォルダ>/rag_rec）。予約はテナントごとに区別して処理する。
+import os, threading, time, atexit
+from typing import Dict, Iterable, List, Optional, Tuple
+from . import rag, tenants
+from .emb_cache import text_hash
+from .segments import compact
+from .storage import get_record
+
+REC_DIR = os.path.join(rag.DATA_DIR, "rag_rec")  # 既定テナント
+os.makedirs(REC_DIR, exist_ok=True)
+
+RAG_REC_UNIT = int(os.getenv("RAG_REC_UNIT", "240"))  # 1行にまとめる区間テキストの目安（文字）
+
+def _open_index(tenant: str) -> rag.IndexManager:
+    d = REC_DIR if tenant == tenants.DEFAULT_TENANT else os.path.join(tenants.data_dir(tenant), "rag_rec")
+    os.makedirs(d, exist_ok=True)
+    # 埋め込みキャッシュは rag 側でテナントごとに閉じられることがあるので、使うたびに引き直す
+    return rag.IndexManager(d, raw_vectors=lambda hs: rag.embedding_cache(tenant).get_many(hs))
+
+_managers = tenants.TenantMap(_open_index, close=rag.IndexManager.close, name="recindex")
+atexit.register(_managers.close_all)
+
+def _mgr() -> rag.IndexManager:
+    return _managers.get()
+
+
+# ---------- 区間 → 索引の行 ----------
+def _group_segments(segs) -> List[Dict]:
+    """日本語：連続する区間を RAG_REC_UNIT 文字程度ずつ束ねる（text は区間テキストをそのまま連結）"""
+    out: List[Dict] = []
+    cur: Optional[Dict] = None
+    for s in segs:
+        if cur is not None and len(cur["text"]) + len(s["text"]) > RAG_REC_UNIT:
+            out.append(cur)
+            cur = None
+        if cur is None:
+            cur = {"text": "", "start": s["start"], "end": s["end"]}
+        cur["text"] += s["text"]
+        cur["end"] = s["end"]
+    if cur is not None:
+        out.append(cur)
+    return out
+
+def _gap_units(text: str, start: Optional[float], end: Optional[float]) -> List[Dict]:
+    """日本語：segments と一致しない部分（編集箇所）を分割し、start〜end を文字位置で按分する"""
+    chunks = [c for c in rag.chunk_text(text, RAG_REC_UNIT, 0) if c.strip()]
+    if start is None or end is None:
+        return [{"text": c, "start": start, "end": end} for c in chunks]
+    out, pos, n = [], 0, max(1, len(text))
+    for c in chunks:
+        t0 = start + (end - start) * pos / n
+        pos += len(c)
+        out.append({"text": c, "start": round(t0, 3), "end": round(start + (end - start) * pos / n, 3)})
+    return out
+
+def recording_units(rec: Dict) -> List[Dict]:
+    """日本語：録音の転写を [{"text", "start", "end"}] に分ける（時刻が分からない部分は None）"""
+    transcript = rec.get("transcript") or ""
+    groups = _group_segments(compact(rec.get("segments")))
+    if not groups:
+        return _gap_units(transcript, None, None)
+    out: List[Dict] = []
+    pos = 0
+    prev_end: Optional[float] = None
+    missing: List[Dict] = []  # 転写の中に見つからなかったまとまり（編集された）
+    for g in groups:
+        j = transcript.find(g["text"], pos) if g["text"] else -1
+        if j < 0:
+            missing.append(g)
+            continue
+        out += _gap_units(transcript[pos:j], missing[0]["start"] if missing else prev_end,
+                          missing[-1]["end"] if missing else g["start"])
+        out.append(g)
+        pos, prev_end, missing = j + len(g["text"]), g["end"], []
+    out += _gap_units(transcript[pos:], missing[0]["start"] if missing else prev_end,
+                      missing[-1]["end"] if missing else prev_end)
+    return [{**u, "text": u["text"].strip()} for u in out if u["text"].strip()]
+
+def index_recording(rid: str) -> Dict:
+    """日本語：録音 rid の行を今の転写に合わせる（差分だけ削除・追加）。録音が無ければ全行を消す"""
+    rec = get_record(rid)
+    rows, keep = [], set()
+    for k, u in enumerate(recording_units(rec) if rec else []):
+        h = text_hash(u["text"])
+        if h in keep:
+            continue
+        keep.add(h)
+        rows.append({"mat_id": rid, "kind": "recording", "chunk_id": k,
+                     "start": u["start"], "end": u["end"], "h": h, "text": u["text"]})
+    have = _mgr().material_hashes(rid)
+    removed = _mgr().drop_material(rid, keep=keep) if have - keep else 0
+    new = [r for r in rows if r["h"] not in have]
+    if new:
+        _mgr().add(rag.embed_rows(new), new)
+    return {"id": rid, "units": len(rows), "added": len(new), "removed": removed}
+
+
+# ---------- バックグラウンド反映 ----------
+# 同じ録音が反映待ちの間に何度更新されても1回にまとめる（処理時に最新の録音を読む）
+_pending: Dict[Tuple[str, str], None] = {}  # (テナント, 録音 ID)
+_cv = threading.Condition()
+_thread: Optional[threading.Thread] = None
+_busy = 0
+_stats = {"indexed": 0, "errors": 0, "last_error": None}
+
+def enqueue(rid: str):
+    """日本語：今のテナントの録音 rid の区間索引の更新を予約する（storage の録音リスナーとして登録する）"""
+    global _thread
+    with _cv:
+        _pending[(tenants.current(), rid)] = None
+        _cv.notify()
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_loop, daemon=True, name="rec-index")
+            _thread.start()
+
+def backfill(rids: Iterable[str]) -> int:
+    """日本語：まだ索引に無い録音を予約する（起動時。共有ストレージの既存録音用）。予約数を返す"""
+    n = 0
+    for rid in rids:
+        if not _mgr().has_material(rid):
+            enqueue(rid)
+            n += 1
+    return n
+
+def _loop():
+    global _busy
+    while True:
+        with _cv:
+            while not _pending:
+                _cv.wait()
+            tenant, rid = next(iter(_pending))
+            del _pending[(tenant, rid)]
+            _busy += 1
+        try:
+            with tenants.scope(tenant):
+                index_recording(rid)
+            _stats["indexed"] += 1
+        except Exception as e:
+            _stats["errors"] += 1
+            _stats["last_error"] = f"{tenant}/{rid}: {e}"
+            print("[WARN] recording index failed:", tenant, rid, e)
+        finally:
+            with _cv:
+                _busy -= 1
+                _cv.notify_all()
+
+def wait_idle(timeout: Optional[float] = None) -> bool:
+    """日本語：予約がすべて反映されるまで待つ（CLI・動作確認用）"""
+    with _cv:
+        return _cv.wait_for(lambda: not _pending and not _busy, timeout)
+
+
+# ---------- 検索 ----------
+def search(query: str, top_k: int = 10) -> Dict:
+    """
+    日本語：今のテナントの全録音の区間から query に意味の近いものを探す。
+    戻り値：{"hits": [{"id", "start", "end", "text", "score"}], "latency_ms": {"total"}}
+    """
+    t0 = time.perf_counter()
+    hits = []
+    if len(_mgr()):
+        for h in _mgr().search(rag._encode_queries([query]), top_k):
+            hits.append({"id": h["mat_id"], "start": h.get("start"), "end": h.get("end"),
+                         "text": h["text"], "score": h["_score"]})
+    return {"hits": hits, "latency_ms": {"total": round(1000 * (time.perf_counter() - t0), 2)}}
+
+def stats() -> Dict:
+    with _cv:
+        pending = len(_pending) + _busy
+    return {**_mgr().stats(), "pending": pending, **_stats}
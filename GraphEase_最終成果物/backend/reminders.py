@@ -1,28 +1,46 @@
 # -*- coding: utf-8 -*-
 # reminders.py — リマインド送信ループ（30秒間隔）
-import threading, time
+# 日本語コメント：STORAGE_BACKEND=sqlite（複数ワーカー共有）のときは、ファイルロックで
+#   リーダーを1つだけ選び、そのプロセスだけが送信する（メールの重複送信を防ぐ）。
+#   リーダーのプロセスが落ちるとロックが解放され、別のワーカーが次の周回で引き継ぐ。
+#   リマインドはテナントごとのストアにあるので、全テナント分をまとめて送る（storage.iter_due_reminders）。
+import os, threading, time
 from datetime import datetime
 from . import storage
+from .locks import FileLock
 from .mailer import send_email
 
+INTERVAL_SEC = 30
+LEADER_LOCK_PATH = os.path.join(storage.DATA_DIR, "reminders.lock")
+
 _started = False
+_leader = FileLock(LEADER_LOCK_PATH)
+
+def _send_due():
+    now = datetime.utcnow()
+    for r in storage.iter_due_reminders(now):
+        ok = True
+        if r.get("email"):
+            ok = send_email(
+                r["email"],
+                subject=f"[PrepPal] 復習リマインド: {r['title']}",
+                body=f"次回復習の時間です。\nタイトル: {r['title']}\n時刻(UTC): {r['due_at'].isoformat()}",
+            )
+        storage.mark_reminder_sent(r["id"], ok, tenant=r["tenant"])
 
 def _loop():
     while True:
         try:
-            now = datetime.utcnow()
-            for r in storage.iter_due_reminders(now):
-                ok = True
-                if r.get("email"):
-                    ok = send_email(
-                        r["email"],
-                        subject=f"[PrepPal] 復習リマインド: {r['title']}",
-                        body=f"次回復習の時間です。\nタイトル: {r['title']}\n時刻(UTC): {r['due_at'].isoformat()}",
-                    )
-                r["sent"] = True if ok else False
+            # 共有ストレージでは、リーダー（ロック保持者）だけが送る
+            if not storage.SHARED or _leader.acquire(blocking=False):
+                _send_due()
         except Exception as e:
             print("[REMINDER] loop error:", e)
-        time.sleep(30)
+        time.sleep(INTERVAL_SEC)
+
+def is_leader() -> bool:
+    """日本語：このプロセスがリマインド送信を担当しているか"""
+    return (not storage.SHARED) or _leader.locked
 
 def start():
     """日本語：多重起動を避けつつバックグラウンドスレッド開始"""
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# search.py — 録音の全文検索（文字 n-gram 転置インデックス + BM25）
+# 日本語コメント：形態素解析器なしでも日本語を検索できるよう、文字 bi-gram で索引します。
+#   - add / remove は差分更新（全件スキャンしない）
+#   - スコアは BM25（k1=1.2, b=0.75）
+import math, re, threading, unicodedata
+from collections import Counter
+from typing import AbstractSet, Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+NGRAM = 2
+BM25_K1 = 1.2
+BM25_B = 0.75
+MIN_DOCS_FOR_DF_CUT = 20  # 文書数がこれ未満なら max_df_ratio は効かせない（小さい索引で全 gram が飛ぶのを防ぐ）
+
+_SPACE_RE = re.compile(r"\s+")
+
+def normalize(text: str) -> str:
+    """日本語：全角/半角・大文字/小文字を揃え、空白を除去（日本語は空白で区切らないため）"""
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return _SPACE_RE.sub("", t)
+
+def ngrams(text: str, n: int = NGRAM) -> List[str]:
+    """正規化済みテキストを n 文字ずつずらして切り出す（n 未満なら丸ごと1個）"""
+    if not text:
+        return []
+    if len(text) < n:
+        return [text]
+    return [text[i:i+n] for i in range(len(text) - n + 1)]
+
+
+class NgramIndex:
+    """
+    日本語：文字 n-gram の転置インデックス。
+    postings[gram][doc_id] = 出現回数。doc ごとの gram 集計を持つので削除/更新も差分で済む。
+    """
+
+    def __init__(self, n: int = NGRAM):
+        self.n = n
+        self.postings: Dict[str, Dict[Hashable, int]] = {}
+        self.doc_grams: Dict[Hashable, Counter] = {}
+        self.doc_len: Dict[Hashable, int] = {}
+        self.total_len = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, doc_id: Hashable, text: str) -> None:
+        """文書を追加（既にあれば置き換え）"""
+        grams = Counter(ngrams(normalize(text), self.n))
+        with self._lock:
+            self._remove_locked(doc_id)
+            if not grams:
+                return
+            for g, tf in grams.items():
+                self.postings.setdefault(g, {})[doc_id] = tf
+            self.doc_grams[doc_id] = grams
+            dl = sum(grams.values())
+            self.doc_len[doc_id] = dl
+            self.total_len += dl
+
+    def remove(self, doc_id: Hashable) -> None:
+        with self._lock:
+            self._remove_locked(doc_id)
+
+    def _remove_locked(self, doc_id: Hashable) -> None:
+        grams = self.doc_grams.pop(doc_id, None)
+        if grams is None:
+            return
+        for g in grams:
+            plist = self.postings.get(g)
+            if plist is None:
+                continue
+            plist.pop(doc_id, None)
+            if not plist:
+                del self.postings[g]
+        self.total_len -= self.doc_len.pop(doc_id, 0)
+
+    def _query_grams(self, q: str) -> List[str]:
+        if len(q) >= self.n:
+            return list(dict.fromkeys(ngrams(q, self.n)))
+        # 1文字クエリ：その文字を含む gram をすべて対象にする（語彙サイズ分の走査）
+        return [g for g in self.postings if q in g]
+
+    def search(self, query: str, top_k: int = 10, max_df_ratio: float = 1.0,
+               allowed: Optional[AbstractSet[Hashable]] = None) -> List[Tuple[Hashable, float]]:
+        """
+        BM25 スコア順に (doc_id, score) を返す。
+        max_df_ratio < 1 なら、文書の大半に出る gram（「ます」「した」など）を飛ばす（長いクエリの高速化）
+        allowed を渡すとその doc_id だけを採点する（idf は全体で計算）
+        """
+        q = normalize(query)
+        if not q:
+            return []
+        with self._lock:
+            N = len(self.doc_len)
+            if N == 0:
+                return []
+            avgdl = self.total_len / N
+            max_df = max_df_ratio * N if N >= MIN_DOCS_FOR_DF_CUT else N
+            scores: Dict[Hashable, float] = {}
+            for g in self._query_grams(q):
+                plist = self.postings.get(g)
+                if not plist:
+                    continue
+                df = len(plist)
+                if df > max_df:
+                    continue
+                idf = math.log(1.0 + (N - df + 0.5) / (df + 0.5))
+                for doc_id, tf in plist.items():
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_len[doc_id] / avgdl)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked[:max(0, top_k)]
+
+
+# =============================================================================
+# 録音（transcript / summary / title）用のインデックス
+# =============================================================================
+# 日本語：インデックスはテナントごとのストアが持つ（storage.py の search_index）
+def _record_text(rec: Dict[str, Any]) -> str:
+    return "\n".join(str(rec.get(k) or "") for k in ("title", "summary", "transcript"))
+
+def index_record(index: NgramIndex, rec: Dict[str, Any]) -> None:
+    """日本語：add_record / 更新時に呼ぶ。該当録音だけ差し替える"""
+    if rec.get("id"):
+        index.add(rec["id"], _record_text(rec))
+
+def unindex_record(index: NgramIndex, rid: str) -> None:
+    index.remove(rid)
+
+def match_segments(segments: Iterable[Dict[str, Any]], query: str,
+                   limit: int = 5, min_overlap: float = 0.6) -> List[Dict[str, Any]]:
+    """
+    日本語：クエリに一致する区間（segments）を返す。プレイヤーのジャンプ先に使う。
+    - 完全一致（部分文字列）を優先、次に n-gram 一致率が min_overlap 以上のもの
+    """
+    q = normalize(query)
+    if not q:
+        return []
+    qg = set(ngrams(q))
+    hits = []
+    for s in segments or []:
+        t = normalize(s.get("text", ""))
+        if not t:
+            continue
+        if q in t:
+            score = 1.0
+        else:
+            score = len(qg & set(ngrams(t))) / len(qg) if qg else 0.0
+            if score < min_overlap:
+                continue
+        hits.append((score, s))
+    hits.sort(key=lambda x: (-x[0], x[1].get("start", 0.0)))
+    return [{"start": s.get("start"), "end": s.get("end"), "text": s.get("text", ""), "score": round(sc, 3)}
+            for sc, s in hits[:limit]]
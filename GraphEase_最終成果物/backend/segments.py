@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# segments.py — 転写区間（segments）のコンパクト保持
+# 日本語コメント：
+#   区間ごとに {"start","end","text"} の dict を持つと 1 区間あたり数百バイトのオーバーヘッドになる。
+#   ここでは start/end をミリ秒の int32 配列、テキストを 1 本の連結文字列 + オフセット配列で持つ。
+#   時刻は API と同じミリ秒（小数3桁）に丸めて持つので、API が返した start/end をそのまま
+#   segment_at に渡しても同じ区間が引ける（float32 だと 0.1 → 0.10000000149 のように境界がずれる）。
+#   JSON（dict のリスト）への変換は API の出口でだけ行う。
+from array import array
+from bisect import bisect_right
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+
+def _ms(t: float) -> int:
+    return int(round(t * 1000))
+
+
+class SegmentArray:
+    """日本語：start 昇順に並んだ区間列。時刻 t を含む区間は二分探索で引ける"""
+
+    __slots__ = ("starts", "ends", "_text", "_offsets")
+
+    def __init__(self) -> None:
+        self.starts = array("i")   # ミリ秒（int32）
+        self.ends = array("i")     # ミリ秒（int32）
+        self._text = ""            # 全区間テキストの連結
+        self._offsets = array("I", [0])  # i 番目のテキスト = _text[_offsets[i]:_offsets[i+1]]
+
+    @classmethod
+    def from_list(cls, segs: Iterable[Dict[str, Any]]) -> "SegmentArray":
+        """stt.transcribe_file() の segments（dict のリスト）から作る"""
+        rows = sorted(
+            ((float(s.get("start", 0.0) or 0.0), float(s.get("end", 0.0) or 0.0), str(s.get("text", "") or ""))
+             for s in (segs or [])),
+            key=lambda x: x[0],
+        )
+        out = cls()
+        texts = []
+        pos = 0
+        for st, en, tx in rows:
+            out.starts.append(_ms(st))
+            out.ends.append(_ms(en))
+            texts.append(tx)
+            pos += len(tx)
+            out._offsets.append(pos)
+        out._text = "".join(texts)
+        return out
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def text(self, i: int) -> str:
+        return self._text[self._offsets[i]:self._offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return {"start": self.starts[i] / 1000, "end": self.ends[i] / 1000, "text": self.text(i)}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        """API 出口用：dict のリストに戻す"""
+        return list(self)
+
+    def index_at(self, t: float) -> int:
+        """時刻 t（秒）を含む区間の番号。区間の隙間なら -1（t はミリ秒に丸めて比べる）"""
+        ms = _ms(t)
+        i = bisect_right(self.starts, ms) - 1
+        if i >= 0 and ms <= self.ends[i]:
+            return i
+        return -1
+
+    def segment_at(self, t: float) -> Optional[Dict[str, Any]]:
+        i = self.index_at(t)
+        return self[i] if i >= 0 else None
+
+
+def compact(segs: Any) -> SegmentArray:
+    """日本語：list/SegmentArray/None のどれでも SegmentArray にそろえる"""
+    if isinstance(segs, SegmentArray):
+        return segs
+    return SegmentArray.from_list(segs or [])
+
+def to_jsonable(segs: Any) -> List[Dict[str, Any]]:
+    if isinstance(segs, SegmentArray):
+        return segs.to_list()
+    return list(segs or [])
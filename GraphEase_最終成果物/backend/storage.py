@@ -1,89 +1,610 @@
 # -*- coding: utf-8 -*-
-# storage.py — 簡易ストア（MVP：メモリ上の配列）
+# storage.py — 簡易ストア
+# 日本語コメント：2種類のバックエンドを環境変数 STORAGE_BACKEND で切り替えます。
+#   - memory（既定）: プロセス内メモリ。サーバ再起動で消える。単一ワーカー向け。
+#   - sqlite        : 1つの SQLite ファイル（WAL）を全ワーカーで共有。uvicorn --workers N 向け。
+# どちらもスレッドセーフ。
+#   - memory はコレクションごとのロック + ストライプ化した録音ロック、dict はコピーオンライトで差し替える
+#     → get_record() で受け取った dict は以後書き換わらないスナップショットとして読める
+#   - sqlite は BEGIN IMMEDIATE のトランザクションでプロセスをまたいで直列化する
+# summary / transcript は更新のたびに版履歴（versions.py の差分 + キーフレーム）を残す。
+# ストア（と全文検索インデックス）はテナントごとに別（tenants.py）。sqlite ではテナントごとに別の DB ファイル
+#   （既定テナントは STORAGE_DB、他は data/tenants/<テナント>/preppal.db）で、しばらく使われなければ閉じる。
 from __future__ import annotations
-from typing import Dict, Any, List, Optional
+import os, json, sqlite3, tempfile, threading, time
+import multiprocessing as mp
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from . import search, tenants
+from .segments import compact as compact_segments, to_jsonable as segments_to_jsonable
+from .versions import KEYFRAME_EVERY, VersionLog, make_delta, replay, describe
 
-# 日本語コメント：サーバ再起動で消えます。永続化したい場合はSQLite等に置き換え。
-RECORDS: List[Dict[str, Any]] = []   # [{id,title,created_at,transcript,summary,duration_sec}]
-REMINDERS: List[Dict[str, Any]] = [] # [{id,email,due_at,recording_id,title,sent}]
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
 
-def add_record(rec: Dict[str, Any]) -> None:
-    RECORDS.insert(0, rec)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory").lower()  # memory / sqlite
+STORAGE_DB = os.getenv("STORAGE_DB", os.path.join(DATA_DIR, "preppal.db"))
 
-def list_records() -> List[Dict[str, Any]]:
-    return [{"id": r["id"], "title": r["title"], "created_at": r["created_at"], "duration_sec": r["duration_sec"]} for r in RECORDS]
+_TEXT_FIELDS = {"title", "summary", "transcript"}
+VERSIONED_FIELDS = ("summary", "transcript")
 
-def get_record(rid: str) -> Optional[Dict[str, Any]]:
-    for r in RECORDS:
-        if r["id"] == rid:
-            return r
-    return None
 
-def update_title(rid: str, title: str) -> bool:
-    for r in RECORDS:
-        if r["id"] == rid:
-            r["title"] = title
-            return True
-    return False
+def export_record(rec: dict) -> dict:
+    """日本語：API 返却用の浅いコピー（segments を dict のリストに戻す）"""
+    out = dict(rec)
+    out["segments"] = segments_to_jsonable(rec.get("segments"))
+    return out
 
-def add_reminder(rem: Dict[str, Any]) -> None:
-    REMINDERS.append(rem)
+def _light(r: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": r.get("id"),
+        "title": r.get("title"),
+        "created_at": r.get("created_at"),
+        "duration_sec": r.get("duration_sec"),
+    }
 
-def iter_due_reminders(now) -> List[Dict[str, Any]]:
-    return [r for r in REMINDERS if not r.get("sent") and r["due_at"] <= now]
+def _quiz_light(q: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": q["id"],
+        "title": q.get("title", "quiz"),
+        "category": q.get("category", "general"),
+        "difficulty": q.get("difficulty", "normal"),
+        "num_questions": len(q.get("questions", [])),
+        "created_at": q.get("created_at"),
+    }
+
+
+# =============================================================================
+# memory バックエンド（単一プロセス）
+# =============================================================================
+class MemoryStore:
+    shared = False  # 他プロセスとは共有しない
+    _N_STRIPES = 64
+
+    def __init__(self):
+        # 日本語コメント：サーバ再起動で消えます。
+        # id -> {id,title,created_at,transcript,summary,...}（挿入順 = 古い順）
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.reminders: List[Dict[str, Any]] = []     # [{id,email,due_at,recording_id,title,sent}]
+        self.quizzes: List[Dict[str, Any]] = []       # {id, title, category, created_at, questions:[...]}
+        self.versions: Dict[Tuple[str, str], VersionLog] = {}  # (録音id, フィールド) -> 版履歴
+        self._records_lock = threading.RLock()
+        self._versions_lock = threading.Lock()
+        self._reminders_lock = threading.Lock()
+        self._quizzes_lock = threading.Lock()
+        # 録音単位のロック（ストライプ化：録音数に関係なく固定個数）
+        self._record_stripes = [threading.Lock() for _ in range(self._N_STRIPES)]
+        self.search_index = search.NgramIndex()  # このテナントの録音の全文検索
+
+    def _record_lock(self, rid: str) -> threading.Lock:
+        return self._record_stripes[hash(rid) % self._N_STRIPES]
+
+    # --- 録音 ---
+    def get_record(self, rid: str):
+        with self._records_lock:
+            return self.records.get(rid)
+
+    def list_records_light(self):
+        with self._records_lock:
+            snapshot = list(self.records.values())
+        return [_light(r) for r in reversed(snapshot)]
+
+    def count_records(self) -> int:
+        with self._records_lock:
+            return len(self.records)
+
+    def add_record(self, rec: dict):
+        with self._record_lock(rec["id"]):
+            with self._records_lock:
+                tenants.check_quota("records", len(self.records), tenants.TENANT_MAX_RECORDS)
+                self.records[rec["id"]] = rec
+            self._add_versions(rec["id"], {}, rec)  # 初版（キーフレーム）
+            search.index_record(self.search_index, rec)  # 全文検索インデックスへ差分追加
+
+    def update_fields(self, rid: str, changed: dict):
+        with self._record_lock(rid):
+            with self._records_lock:
+                cur = self.records.get(rid)
+            if cur is None:
+                return None
+            new = {**cur, **changed}
+            with self._records_lock:
+                self.records[rid] = new
+            self._add_versions(rid, cur, changed)
+            if changed.keys() & _TEXT_FIELDS:
+                search.index_record(self.search_index, new)
+        return new
+
+    # --- 版履歴（録音ロックの内側から呼ぶ） ---
+    def _add_versions(self, rid: str, cur: dict, changed: dict):
+        for f in VERSIONED_FIELDS:
+            if f not in changed or (cur and changed[f] == cur.get(f)):
+                continue
+            with self._versions_lock:
+                log = self.versions.setdefault((rid, f), VersionLog())
+            if not len(log) and cur:
+                log.append(cur.get(f) or "")  # 履歴導入前の録音は現在値を初版にする
+            log.append(changed[f] or "")
+
+    def list_versions(self, rid: str):
+        with self._versions_lock:
+            logs = {f: self.versions.get((rid, f)) for f in VERSIONED_FIELDS}
+        return {f: (log.summary() if log else []) for f, log in logs.items()}
+
+    def get_version(self, rid: str, field: str, v: int):
+        with self._versions_lock:
+            log = self.versions.get((rid, field))
+        return log.get(v) if log else None
+
+    def sync_search_index(self):
+        pass  # 書き込み時に索引済み
+
+    def close(self):
+        pass
+
+    # --- リマインド ---
+    def add_reminder(self, rem: Dict[str, Any]) -> None:
+        with self._reminders_lock:
+            self.reminders.append(rem)
+
+    def iter_due_reminders(self, now) -> List[Dict[str, Any]]:
+        with self._reminders_lock:
+            return [dict(r) for r in self.reminders if not r.get("sent") and r["due_at"] <= now]
+
+    def mark_reminder_sent(self, rem_id: str, sent: bool = True) -> None:
+        with self._reminders_lock:
+            for r in self.reminders:
+                if r["id"] == rem_id:
+                    r["sent"] = sent
+                    return
+
+    # --- クイズ ---
+    def add_quiz(self, quiz: dict):
+        with self._quizzes_lock:
+            self.quizzes.append(quiz)
+
+    def list_quizzes_light(self):
+        with self._quizzes_lock:
+            snapshot = list(self.quizzes)
+        return [_quiz_light(q) for q in snapshot]
+
+    def get_quiz(self, qid: str):
+        with self._quizzes_lock:
+            for q in self.quizzes:
+                if q["id"] == qid:
+                    return q
+        return None
+
+
+# =============================================================================
+# sqlite バックエンド（複数ワーカーで共有）
+# =============================================================================
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    title TEXT, created_at TEXT, duration_sec REAL,
+    rev INTEGER NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_rev ON records(rev);
+CREATE TABLE IF NOT EXISTS reminders (
+    id TEXT PRIMARY KEY,
+    due_at TEXT NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reminders_due ON reminders(sent, due_at);
+CREATE TABLE IF NOT EXISTS quizzes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    rid TEXT NOT NULL, field TEXT NOT NULL, v INTEGER NOT NULL,
+    at TEXT NOT NULL,
+    key INTEGER NOT NULL,   -- 1: data は全文 / 0: data は差分（JSON）
+    data TEXT NOT NULL,
+    PRIMARY KEY (rid, field, v)
+);
+CREATE TABLE IF NOT EXISTS counters (k TEXT PRIMARY KEY, v INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters (k, v) VALUES ('rev', 0);
+"""
+
+class SqliteStore:
+    """
+    日本語：1つの SQLite ファイルを全ワーカーで共有するストア。
+    - 接続はスレッドごと（sqlite3 の接続はスレッド間共有しない）
+    - 録音は更新のたびに rev（全体で単調増加）を振り、各ワーカーの検索インデックスは
+      sync_search_index() で「前回以降に変わった録音」だけを取り込む
+    """
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []  # close() で閉じるため（スレッドごとの接続すべて）
+        self._conns_lock = threading.Lock()
+        self.search_index = search.NgramIndex()
+        self._search_rev = 0
+        self._search_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def close(self):
+        """日本語：全スレッドの接続を閉じる（使われなくなったテナントをメモリから外すとき）"""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    @contextmanager
+    def _tx(self):
+        """日本語：書き込みトランザクション（他プロセスの書き込みとも直列化される）"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _next_rev(conn: sqlite3.Connection) -> int:
+        conn.execute("UPDATE counters SET v = v + 1 WHERE k = 'rev'")
+        return conn.execute("SELECT v FROM counters WHERE k = 'rev'").fetchone()[0]
+
+    @staticmethod
+    def _decode_record(body: str) -> Dict[str, Any]:
+        rec = json.loads(body)
+        rec["segments"] = compact_segments(rec.get("segments"))
+        return rec
+
+    # --- 録音 ---
+    def get_record(self, rid: str):
+        row = self._conn().execute("SELECT body FROM records WHERE id = ?", (rid,)).fetchone()
+        return self._decode_record(row[0]) if row else None
+
+    def list_records_light(self):
+        rows = self._conn().execute(
+            "SELECT id, title, created_at, duration_sec FROM records ORDER BY rowid DESC"
+        ).fetchall()
+        return [{"id": r[0], "title": r[1], "created_at": r[2], "duration_sec": r[3]} for r in rows]
+
+    def count_records(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def _write_record(self, conn, rec: dict, insert: bool):
+        body = json.dumps(export_record(rec), ensure_ascii=False)
+        rev = self._next_rev(conn)
+        if insert:
+            conn.execute(
+                "INSERT INTO records (id, title, created_at, duration_sec, rev, body) VALUES (?, ?, ?, ?, ?, ?)",
+                (rec["id"], rec.get("title"), rec.get("created_at"), rec.get("duration_sec"), rev, body),
+            )
+        else:
+            conn.execute(
+                "UPDATE records SET title = ?, duration_sec = ?, rev = ?, body = ? WHERE id = ?",
+                (rec.get("title"), rec.get("duration_sec"), rev, body, rec["id"]),
+            )
+
+    def add_record(self, rec: dict):
+        with self._tx() as conn:
+            if tenants.TENANT_MAX_RECORDS:
+                used = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+                tenants.check_quota("records", used, tenants.TENANT_MAX_RECORDS)
+            self._write_record(conn, rec, insert=True)
+            self._add_versions(conn, rec["id"], {}, rec)
+
+    def update_fields(self, rid: str, changed: dict):
+        with self._tx() as conn:
+            row = conn.execute("SELECT body FROM records WHERE id = ?", (rid,)).fetchone()
+            if not row:
+                return None
+            cur = self._decode_record(row[0])
+            new = {**cur, **changed}
+            self._write_record(conn, new, insert=False)
+            self._add_versions(conn, rid, cur, changed)
+        return new
 
+    # --- 版履歴 ---
+    def _add_versions(self, conn, rid: str, cur: dict, changed: dict):
+        for f in VERSIONED_FIELDS:
+            if f not in changed or (cur and changed[f] == cur.get(f)):
+                continue
+            prev = cur.get(f) or ""
+            last = conn.execute("SELECT MAX(v) FROM versions WHERE rid = ? AND field = ?", (rid, f)).fetchone()[0]
+            if last is None and cur:
+                self._insert_version(conn, rid, f, 0, prev, prev)  # 履歴導入前の録音は現在値を初版にする
+                last = 0
+            v = 0 if last is None else last + 1
+            self._insert_version(conn, rid, f, v, prev, changed[f] or "")
 
-# 既にあるはずの全体リスト
-RECORDS = []  # [{id,title,created_at,transcript,summary,...}]
+    @staticmethod
+    def _insert_version(conn, rid: str, field: str, v: int, prev: str, text: str):
+        key = v % KEYFRAME_EVERY == 0
+        data = text if key else json.dumps(make_delta(prev, text), ensure_ascii=False)
+        conn.execute("INSERT INTO versions (rid, field, v, at, key, data) VALUES (?, ?, ?, ?, ?, ?)",
+                     (rid, field, v, datetime.utcnow().isoformat(), int(key), data))
 
+    @staticmethod
+    def _version_entry(row) -> Dict[str, Any]:
+        v, at, key, data = row
+        return {"v": v, "at": at, "key": bool(key), "data": data if key else json.loads(data)}
+
+    def list_versions(self, rid: str):
+        out = {}
+        for f in VERSIONED_FIELDS:
+            rows = self._conn().execute(
+                "SELECT v, at, key, data FROM versions WHERE rid = ? AND field = ? ORDER BY v", (rid, f)
+            ).fetchall()
+            out[f] = [describe(self._version_entry(r)) for r in rows]
+        return out
+
+    def get_version(self, rid: str, field: str, v: int):
+        conn = self._conn()
+        # v 以前で最も近いキーフレーム（主キーの範囲検索なので O(log n)）
+        k = conn.execute(
+            "SELECT MAX(v) FROM versions WHERE rid = ? AND field = ? AND key = 1 AND v <= ?", (rid, field, v)
+        ).fetchone()[0]
+        if k is None:
+            return None
+        rows = conn.execute(
+            "SELECT v, at, key, data FROM versions WHERE rid = ? AND field = ? AND v BETWEEN ? AND ? ORDER BY v",
+            (rid, field, k, v),
+        ).fetchall()
+        if not rows or rows[-1][0] != v:
+            return None
+        return replay([self._version_entry(r) for r in rows])
+
+    def sync_search_index(self):
+        """日本語：他ワーカーを含め、前回以降に更新された録音だけを検索インデックスへ反映"""
+        with self._search_lock:
+            rows = self._conn().execute(
+                "SELECT rev, body FROM records WHERE rev > ? ORDER BY rev", (self._search_rev,)
+            ).fetchall()
+            for rev, body in rows:
+                search.index_record(self.search_index, json.loads(body))
+                self._search_rev = rev
+
+    # --- リマインド ---
+    def add_reminder(self, rem: Dict[str, Any]) -> None:
+        body = json.dumps({**rem, "due_at": rem["due_at"].isoformat()}, ensure_ascii=False)
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT INTO reminders (id, due_at, sent, body) VALUES (?, ?, ?, ?)",
+                (rem["id"], rem["due_at"].isoformat(), int(bool(rem.get("sent"))), body),
+            )
+
+    def iter_due_reminders(self, now) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT body FROM reminders WHERE sent = 0 AND due_at <= ? ORDER BY due_at", (now.isoformat(),)
+        ).fetchall()
+        out = []
+        for (body,) in rows:
+            r = json.loads(body)
+            r["due_at"] = datetime.fromisoformat(r["due_at"])
+            r["sent"] = False
+            out.append(r)
+        return out
+
+    def mark_reminder_sent(self, rem_id: str, sent: bool = True) -> None:
+        with self._tx() as conn:
+            conn.execute("UPDATE reminders SET sent = ? WHERE id = ?", (int(bool(sent)), rem_id))
+
+    # --- クイズ ---
+    def add_quiz(self, quiz: dict):
+        with self._tx() as conn:
+            conn.execute("INSERT INTO quizzes (id, body) VALUES (?, ?)",
+                         (quiz["id"], json.dumps(quiz, ensure_ascii=False)))
+
+    def list_quizzes_light(self):
+        rows = self._conn().execute("SELECT body FROM quizzes ORDER BY seq").fetchall()
+        return [_quiz_light(json.loads(b)) for (b,) in rows]
+
+    def get_quiz(self, qid: str):
+        row = self._conn().execute("SELECT body FROM quizzes WHERE id = ?", (qid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def _db_path(tenant: str) -> str:
+    if tenant == tenants.DEFAULT_TENANT:
+        return STORAGE_DB
+    return os.path.join(tenants.TENANTS_DIR, tenant, "preppal.db")
+
+def _open_store(tenant: str):
+    return SqliteStore(_db_path(tenant)) if STORAGE_BACKEND == "sqlite" else MemoryStore()
+
+# memory はメモリにしか無いので外さない。sqlite は閉じても DB ファイルから読み直せる
+_stores = tenants.TenantMap(_open_store, close=lambda s: s.close(),
+                            idle_sec=tenants.TENANT_IDLE_SEC if STORAGE_BACKEND == "sqlite" else None,
+                            name="storage")
+
+def _store():
+    """日本語：今のテナントのストア"""
+    return _stores.get()
+
+SHARED = STORAGE_BACKEND == "sqlite"  # True なら複数プロセスで状態を共有している
+
+# 録音の追加・転写の変更を知らせる先（例：recindex.enqueue。重い処理はリスナー側で非同期に行う）
+_record_listeners: List[Callable[[str], None]] = []
+_LISTEN_FIELDS = {"transcript", "segments"}
+
+def add_record_listener(fn: Callable[[str], None]) -> None:
+    """日本語：録音の追加時と transcript / segments の更新時に fn(録音id) を呼ぶ"""
+    _record_listeners.append(fn)
+
+def _notify(rid: str) -> None:
+    for fn in _record_listeners:
+        try:
+            fn(rid)
+        except Exception as e:
+            print("[WARN] record listener failed:", e)
+
+
+# =============================================================================
+# 公開関数（main.py / reminders.py から使う）
+# =============================================================================
 def get_record(rid: str):
-    """IDから1件取得。見つからなければ None"""
-    return next((r for r in RECORDS if r.get("id") == rid), None)
+    """IDから1件取得。見つからなければ None（返り値は読み取り専用として扱う）"""
+    return _store().get_record(rid)
 
 def list_records_light():
-    """一覧用(軽量)の形にして返す"""
-    return [
-        {
-            "id": r.get("id"),
-            "title": r.get("title"),
-            "created_at": r.get("created_at"),
-            "duration_sec": r.get("duration_sec"),
-        }
-        for r in RECORDS
-    ]
+    """一覧用(軽量)の形にして返す（新しい順）"""
+    return _store().list_records_light()
 
 def add_record(rec: dict):
-    RECORDS.insert(0, rec)
+    # segments は配列ベースのコンパクト表現で保持（JSON 化は export_record で）
+    rec["segments"] = compact_segments(rec.get("segments"))
+    _store().add_record(rec)
+    _notify(rec["id"])
 
 def update_title(rid: str, title: str) -> bool:
-    rec = get_record(rid)
-    if not rec:
-        return False
-    rec["title"] = title
-    return True
+    return update_fields(rid, {"title": title}) is not None
+
+def update_fields(rid: str, fields: dict):
+    """
+    日本語：任意フィールドを部分更新し、更新後の録音を返す（無ければ None）。
+    None の値は「変更なし」として無視する。
+    - 同じ録音への更新は直列化される（読み→書きの間に割り込まれない）
+    - 新しい dict を作って差し替えるので、読み手が持っている古い dict は壊れない
+    """
+    changed = {k: v for k, v in fields.items() if v is not None}
+    new = _store().update_fields(rid, changed)
+    if new is not None and changed.keys() & _LISTEN_FIELDS:
+        _notify(rid)
+    return new
+
+def list_versions(rid: str):
+    """日本語：{"summary": [{v, at, keyframe, stored_chars}], "transcript": [...]}"""
+    return _store().list_versions(rid)
+
+def get_version(rid: str, field: str, v: int) -> Optional[str]:
+    """日本語：指定フィールドの v 版の全文（無ければ None）"""
+    if field not in VERSIONED_FIELDS:
+        return None
+    return _store().get_version(rid, field, v)
+
+def sync_search_index():
+    """日本語：検索前に呼ぶ。sqlite では他ワーカーの更新を取り込む（memory では何もしない）"""
+    _store().sync_search_index()
+
+def search_records(q: str, top_k: int = 20) -> List[Tuple[str, float]]:
+    """日本語：今のテナントの録音を全文検索して [(録音id, スコア)]（他ワーカーの更新も取り込んでから）"""
+    st = _store()
+    st.sync_search_index()
+    return st.search_index.search(q, top_k=top_k)
+
+def count_records() -> int:
+    return _store().count_records()
+
+def check_record_quota() -> None:
+    """日本語：今のテナントの録音が TENANT_MAX_RECORDS 件に達していれば tenants.QuotaExceeded（重い処理の前に呼ぶ）"""
+    if tenants.TENANT_MAX_RECORDS:
+        tenants.check_quota("records", count_records(), tenants.TENANT_MAX_RECORDS)
+
+def stored_tenants() -> List[str]:
+    """日本語：データのあるテナント（sqlite は DB ファイルのあるテナント、memory はこのプロセスで使ったテナント）"""
+    if SHARED:
+        return [t for t in tenants.known() if os.path.exists(_db_path(t))]
+    return [t for t, _ in _stores.items()]
 
-# === ここからクイズ保存（超シンプルなインメモリ） ===
-QUIZZES = []  # {id, title, category, created_at, questions:[{q,a,choices?,difficulty}]}
+def add_reminder(rem: Dict[str, Any]) -> None:
+    _store().add_reminder(rem)
+
+def iter_due_reminders(now) -> List[Dict[str, Any]]:
+    """
+    日本語：全テナントの期限到来・未送信のリマインドのコピーを返す（送信結果は mark_reminder_sent で反映）。
+    各リマインドの "tenant" にテナントが入る
+    （見るだけではテナントの使用時刻を更新しないので、使われていないテナントは外れる）
+    """
+    out = []
+    for t in stored_tenants():
+        with tenants.scope(t):  # 読んでいる間にメモリから外されて閉じられないように
+            for r in _stores.get(t, touch=False).iter_due_reminders(now):
+                out.append({**r, "tenant": t})
+    return out
+
+def mark_reminder_sent(rem_id: str, sent: bool = True, tenant: Optional[str] = None) -> None:
+    with tenants.scope(tenant or tenants.current()) as t:
+        _stores.get(t, touch=False).mark_reminder_sent(rem_id, sent)
 
 def add_quiz(quiz: dict):
-    QUIZZES.append(quiz)
+    _store().add_quiz(quiz)
 
 def list_quizzes_light():
     # 一覧用の軽量データ
-    return [
-        {
-            "id": q["id"],
-            "title": q.get("title", "quiz"),
-            "category": q.get("category", "general"),
-            "difficulty": q.get("difficulty", "normal"),
-            "num_questions": len(q.get("questions", [])),
-            "created_at": q.get("created_at"),
-        }
-        for q in QUIZZES
-    ]
+    return _store().list_quizzes_light()
 
 def get_quiz(qid: str):
-    for q in QUIZZES:
-        if q["id"] == qid:
-            return q
-    return None
+    return _store().get_quiz(qid)
+
+
+# =============================================================================
+# ベンチマーク：python -m backend.storage bench [最大ワーカー数] [1ワーカーあたりの回数]
+# =============================================================================
+# 日本語：uvicorn --workers N 相当として N プロセスが 1 つの SQLite を同時に読み書きする。
+#   各プロセスは「録音を追加 → 共有の録音を更新 → 読む」を繰り返す（1回 = 3操作）。
+#   lost_updates は共有の録音で最後の更新が残っていないワーカーの数（0 でなければ不具合）。
+def _bench_worker(path: str, wid: int, ops: int, barrier) -> None:
+    st = SqliteStore(path)
+    barrier.wait()
+    for j in range(ops):
+        rid = f"w{wid}-{j}"
+        st.add_record({"id": rid, "title": rid, "summary": "", "transcript": "", "segments": []})
+        st.update_fields("shared", {f"w{wid}": j})
+        st.get_record(rid)
+    st.close()
+
+def bench(max_workers: int = 4, ops: int = 200, root: Optional[str] = None) -> List[Dict[str, Any]]:
+    ctx = mp.get_context("spawn")
+    rows = []
+    n = 1
+    while n <= max_workers:
+        with tempfile.TemporaryDirectory(dir=root) as d:
+            path = os.path.join(d, "bench.db")
+            st = SqliteStore(path)
+            st.add_record({"id": "shared", "title": "shared", "summary": "", "transcript": "", "segments": []})
+            barrier = ctx.Barrier(n + 1)
+            procs = [ctx.Process(target=_bench_worker, args=(path, i, ops, barrier)) for i in range(n)]
+            for p in procs:
+                p.start()
+            barrier.wait()
+            t0 = time.perf_counter()
+            for p in procs:
+                p.join()
+            sec = time.perf_counter() - t0
+            shared = st.get_record("shared")
+            rows.append({"workers": n, "ops": 3 * n * ops, "ops_per_sec": round(3 * n * ops / sec, 1),
+                         "records": st.count_records() - 1,
+                         "lost_updates": sum(shared.get(f"w{i}") != ops - 1 for i in range(n)),
+                         "exitcodes": sorted({p.exitcode for p in procs})})
+            st.close()
+        n *= 2
+    return rows
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        mw = int(sys.argv[2]) if len(sys.argv) >= 3 else 4
+        n_ops = int(sys.argv[3]) if len(sys.argv) >= 4 else 200
+        for row in bench(mw, n_ops):
+            print(json.dumps(row, ensure_ascii=False))
+    else:
+        print("usage: python -m backend.storage bench [max_workers] [ops_per_worker]")
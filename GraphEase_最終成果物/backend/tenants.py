@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# tenants.py — テナント（学校）ごとのデータ分割
+# 日本語コメント：
+#   リクエストの X-Tenant ヘッダ（無ければ DEFAULT_TENANT）でテナントを決め、ContextVar で持ち回る。
+#   録音ストア・全文検索・資料の FAISS 索引・録音区間の索引はテナントごとに別ファイル・別オブジェクト
+#     - DEFAULT_TENANT は従来どおり data/ 直下（既存のデータはそのまま既定テナントになる）
+#     - それ以外は data/tenants/<テナント>/ の下
+#   テナントごとのオブジェクトは TenantMap が初回アクセスで作り、TENANT_IDLE_SEC 使われなければ閉じて捨てる
+#   （既定テナントは捨てない）。使用中（scope() の中）のテナントは捨てない。
+#   上限（0 は無制限）はテナントごとに数えるので、大きな学校が上限に達しても他の学校には影響しない。
+#     - TENANT_MAX_INFLIGHT：同時に処理するリクエスト数（超えたら 429）
+#     - TENANT_MAX_RECORDS：録音の件数 / TENANT_MAX_CHUNKS：資料のチャンク数 / TENANT_MAX_JOBS：取り込み待ちのジョブ数
+#   バックグラウンドのスレッドには ContextVar が引き継がれないので、ジョブにテナントを持たせて scope() で入るか、
+#   bind() で包んでから渡す。
+import os, re, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Generic, Iterator, List, Optional, TypeVar
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+TENANTS_DIR = os.path.join(DATA_DIR, "tenants")
+
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant")
+TENANT_IDLE_SEC = float(os.getenv("TENANT_IDLE_SEC", "600"))  # これだけ使われなければメモリから外す（0 なら外さない）
+TENANT_MAX_INFLIGHT = int(os.getenv("TENANT_MAX_INFLIGHT", "16"))
+TENANT_MAX_RECORDS = int(os.getenv("TENANT_MAX_RECORDS", "0"))
+TENANT_MAX_CHUNKS = int(os.getenv("TENANT_MAX_CHUNKS", "0"))
+TENANT_MAX_JOBS = int(os.getenv("TENANT_MAX_JOBS", "8"))
+
+_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+_current: ContextVar[str] = ContextVar("tenant", default=DEFAULT_TENANT)
+
+
+class InvalidTenant(ValueError):
+    """日本語：テナント名が不正（英数字・_・- の 64 文字まで）"""
+
+class QuotaExceeded(Exception):
+    """日本語：テナントの上限を超えた（API では 429 で返す）"""
+
+
+def validate(name: Optional[str]) -> str:
+    name = (name or "").strip() or DEFAULT_TENANT
+    if not _NAME.match(name):
+        raise InvalidTenant(f"invalid tenant: {name!r}")
+    return name
+
+def current() -> str:
+    """日本語：いま処理しているテナント"""
+    return _current.get()
+
+
+# ---------- 使用中のテナント ----------
+_active: Dict[str, int] = {}    # テナント → scope() の中にいる処理の数（>0 の間はメモリから外さない）
+_inflight: Dict[str, int] = {}  # テナント → 処理中のリクエスト数（TENANT_MAX_INFLIGHT 用）
+_active_lock = threading.Lock()
+
+@contextmanager
+def scope(tenant: Optional[str]) -> Iterator[str]:
+    """日本語：この中ではテナント tenant として読み書きする（ジョブ・バックグラウンド処理用）"""
+    t = validate(tenant)
+    token = _current.set(t)
+    with _active_lock:
+        _active[t] = _active.get(t, 0) + 1
+    try:
+        yield t
+    finally:
+        with _active_lock:
+            _active[t] -= 1
+            if not _active[t]:
+                del _active[t]
+        _current.reset(token)
+
+def in_use(tenant: str) -> bool:
+    with _active_lock:
+        return tenant in _active
+
+def bind(fn: Callable) -> Callable:
+    """日本語：今のテナントで fn を実行する関数を返す（スレッドプールに渡す前に包む）"""
+    t = current()
+    def run(*args, **kw):
+        with scope(t):
+            return fn(*args, **kw)
+    return run
+
+def admit(tenant: str) -> bool:
+    """日本語：リクエストを受け付けてよいか（同時処理数が上限未満なら数えて True。終わったら leave()）"""
+    with _active_lock:
+        n = _inflight.get(tenant, 0)
+        if TENANT_MAX_INFLIGHT and n >= TENANT_MAX_INFLIGHT:
+            return False
+        _inflight[tenant] = n + 1
+        return True
+
+def leave(tenant: str) -> None:
+    with _active_lock:
+        _inflight[tenant] -= 1
+        if not _inflight[tenant]:
+            del _inflight[tenant]
+
+def check_quota(what: str, used: int, limit: int, adding: int = 1) -> None:
+    """日本語：used + adding が limit を超えるなら QuotaExceeded（limit が 0 なら無制限）"""
+    if limit and used + adding > limit:
+        raise QuotaExceeded(f"tenant {current()!r}: {what} quota exceeded ({used} + {adding} > {limit})")
+
+
+# ---------- HTTP（main.py で FastAPI に登録する。starlette はここでは必須にしない） ----------
+async def http_middleware(request, call_next):
+    """
+    日本語：TENANT_HEADER のテナントの中でリクエストを処理する。
+    不正なテナント名は 400、同じテナントの同時処理が TENANT_MAX_INFLIGHT を超えたら 429（他のテナントは待たされない）
+    """
+    from starlette.responses import JSONResponse
+    try:
+        tenant = validate(request.headers.get(TENANT_HEADER))
+    except InvalidTenant as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    if not admit(tenant):
+        return JSONResponse({"ok": False, "error": "too many concurrent requests for this tenant"},
+                            status_code=429, headers={"Retry-After": "1"})
+    try:
+        with scope(tenant):
+            return await call_next(request)
+    finally:
+        leave(tenant)
+
+async def quota_response(request, exc: QuotaExceeded):
+    """日本語：QuotaExceeded の例外ハンドラ（429）"""
+    from starlette.responses import JSONResponse
+    return JSONResponse({"ok": False, "error": str(exc)}, status_code=429)
+
+
+# ---------- 保存先 ----------
+def data_dir(tenant: Optional[str] = None) -> str:
+    """日本語：テナントのデータフォルダ（既定テナントは data/ 直下）"""
+    t = validate(tenant or current())
+    path = DATA_DIR if t == DEFAULT_TENANT else os.path.join(TENANTS_DIR, t)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def known() -> List[str]:
+    """日本語：データのあるテナント（既定テナントを先頭に）"""
+    try:
+        names = sorted(n for n in os.listdir(TENANTS_DIR)
+                       if _NAME.match(n) and os.path.isdir(os.path.join(TENANTS_DIR, n)))
+    except OSError:
+        names = []
+    return [DEFAULT_TENANT] + [n for n in names if n != DEFAULT_TENANT]
+
+
+# ---------- テナントごとのオブジェクト ----------
+T = TypeVar("T")
+
+class TenantMap(Generic[T]):
+    """
+    日本語：テナント → オブジェクト（ストア・索引など）。初回の get() で factory(テナント) から作る。
+    idle_sec 秒 get() されず、使用中でもなければ evict_idle() で close して捨てる（次の get() で作り直す）。
+    idle_sec=None なら捨てない（メモリにしか無いストアなど）。既定テナントは捨てない。
+    """
+
+    def __init__(self, factory: Callable[[str], T], close: Optional[Callable[[T], None]] = None,
+                 idle_sec: Optional[float] = TENANT_IDLE_SEC, name: str = ""):
+        self.name = name
+        self._factory = factory
+        self._close = close
+        self._idle = idle_sec
+        self._items: Dict[str, T] = {}
+        self._used: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._creating: Dict[str, threading.Lock] = {}  # 同じテナントを2回作らない（作成中は他テナントを待たせない）
+        self.loads = 0
+        self.evictions = 0
+        if idle_sec:
+            _register(self)
+
+    def get(self, tenant: Optional[str] = None, touch: bool = True) -> T:
+        t = validate(tenant or current())
+        with self._lock:
+            obj = self._items.get(t)
+            if obj is not None:
+                if touch:
+                    self._used[t] = time.monotonic()
+                return obj
+            creating = self._creating.setdefault(t, threading.Lock())
+        with creating:
+            with self._lock:
+                obj = self._items.get(t)
+            if obj is None:
+                obj = self._factory(t)
+                with self._lock:
+                    self._items[t] = obj
+                    self.loads += 1
+            with self._lock:
+                self._used[t] = time.monotonic()
+                self._creating.pop(t, None)
+        return obj
+
+    def peek(self, tenant: str) -> Optional[T]:
+        """日本語：読み込み済みなら返す（作らない・使用時刻も更新しない）"""
+        with self._lock:
+            return self._items.get(tenant)
+
+    def items(self) -> List[tuple]:
+        with self._lock:
+            return list(self._items.items())
+
+    def evict_idle(self, now: Optional[float] = None) -> List[str]:
+        """日本語：idle_sec 使われていないテナントを閉じて捨てる。捨てたテナントを返す"""
+        if not self._idle:
+            return []
+        now = time.monotonic() if now is None else now
+        out = []
+        with self._lock:
+            for t, used in list(self._used.items()):
+                if t == DEFAULT_TENANT or now - used < self._idle or in_use(t) or t in self._creating:
+                    continue
+                out.append((t, self._items.pop(t)))
+                del self._used[t]
+                self.evictions += 1
+        for t, obj in out:
+            self._close_one(t, obj)
+        return [t for t, _ in out]
+
+    def close_all(self) -> None:
+        """日本語：すべて閉じる（終了時）"""
+        with self._lock:
+            items = list(self._items.items())
+        for t, obj in items:
+            self._close_one(t, obj)
+
+    def _close_one(self, t: str, obj: T) -> None:
+        if self._close:
+            try:
+                self._close(obj)
+            except Exception as e:
+                print(f"[TENANT] failed to close {self.name or 'object'} of {t}:", e)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"loaded": sorted(self._items), "loads": self.loads, "evictions": self.evictions}
+
+
+# 使われなくなったテナントを定期的に外すスレッド（TenantMap を作ったときに始める）
+_maps: List[TenantMap] = []
+_janitor: Optional[threading.Thread] = None
+
+def _register(m: TenantMap) -> None:
+    global _janitor
+    with _active_lock:
+        _maps.append(m)
+        if _janitor is None:
+            _janitor = threading.Thread(target=_janitor_loop, daemon=True, name="tenant-janitor")
+            _janitor.start()
+
+def _janitor_loop():
+    while True:
+        time.sleep(max(1.0, min(60.0, TENANT_IDLE_SEC / 4)))
+        for m in list(_maps):
+            try:
+                gone = m.evict_idle()
+                if gone:
+                    print(f"[TENANT] unloaded {m.name}:", ", ".join(gone))
+            except Exception as e:
+                print("[TENANT] eviction failed:", e)
@@ -1,17 +1,175 @@
 # backend/tts.py
-import os, tempfile, hashlib
+# 日本語コメント：
+#   読み上げ MP3 のキャッシュは data/tts_cache/（TTS_CACHE_DIR）に置き、再起動しても消えない。
+#   キーは (エンジン, 言語, 声, 本文の sha256)。言語や声を変えれば別のファイルになる。
+#   メタ情報（サイズ・最終アクセス時刻）は同じフォルダの SQLite（index.db）にあり、全ワーカーで共有する。
+#     - 合計が TTS_CACHE_MAX_MB を超えたら、最終アクセスの古いものから消す（LRU）
+#       直近 TTS_CACHE_MIN_AGE 秒に使われたものは消さない（他ワーカーが返している途中かもしれないため）
+#     - MP3 は一時ファイルに書いて rename するので、書きかけのファイルを返すことはない
+#     - 同じキーの合成はプロセス内で1回にまとめる
+#   ヒット・ミス・削除の回数は cache_stats() で見られる。
+import os, hashlib, sqlite3, threading, time
+from typing import Dict, Optional
 from gtts import gTTS
 
-def _tts_cache_path(text: str) -> str:
-    h = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
-    out_dir = os.path.join(tempfile.gettempdir(), "preppal_tts")
-    os.makedirs(out_dir, exist_ok=True)
-    return os.path.join(out_dir, f"{h}.mp3")
-
-def synthesize_to_file(text: str) -> str:
-    """textをMP3にして一時フォルダへ保存し、そのパスを返す"""
-    path = _tts_cache_path(text)
-    if not os.path.exists(path):
-        tts = gTTS(text=text, lang="ja")
-        tts.save(path)
-    return path
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+TTS_ENGINE = "gtts"
+TTS_LANG = os.getenv("TTS_LANG", "ja")
+TTS_VOICE = os.getenv("TTS_VOICE", "com")  # gTTS では Google のドメイン（tld）で声（なまり）が変わる
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(BASE_DIR, "data", "tts_cache"))
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "512"))
+TTS_CACHE_MIN_AGE = float(os.getenv("TTS_CACHE_MIN_AGE", "60"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    engine TEXT NOT NULL, lang TEXT NOT NULL, voice TEXT NOT NULL, text_hash TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access);
+"""
+
+
+class TTSCache:
+    """日本語：(エンジン, 言語, 声, 本文) → MP3 ファイルの LRU キャッシュ（サイズ上限付き・複数プロセスで共有）"""
+
+    def __init__(self, root: str = TTS_CACHE_DIR, max_bytes: int = int(TTS_CACHE_MAX_MB * 1024 * 1024),
+                 min_age: float = TTS_CACHE_MIN_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        os.makedirs(root, exist_ok=True)
+        self._local = threading.local()
+        self._keys_lock = threading.Lock()
+        self._key_locks: Dict[str, list] = {}  # 合成中のキー → [ロック, 待っている数]（同じキーの合成を待たせる）
+        self._stats_lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(engine: str, lang: str, voice: str, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{engine}|{lang}|{voice}|{text_hash}".encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.mp3")
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """日本語：キャッシュ済みならファイルパス（最終アクセス時刻を更新）。無ければ None"""
+        path = self._path(key)
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is None:
+            return None
+        if not os.path.exists(path):  # 手で消された等。記録だけ消して作り直させる
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return path
+
+    def get_or_create(self, engine: str, lang: str, voice: str, text: str, write) -> str:
+        """
+        日本語：キャッシュにあればそのパス、無ければ write(ファイルオブジェクト) で MP3 を書いて登録したパスを返す。
+        書き込みは一時ファイル → fsync → rename。登録後に上限を超えていれば古いものから消す。
+        """
+        key = self.make_key(engine, lang, voice, text)
+        with self._keys_lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                path = self.lookup(key)
+                if path:
+                    self._count("hits")
+                    return path
+                self._count("misses")
+                path = self._path(key)
+                tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+                try:
+                    with open(tmp, "wb") as f:
+                        write(f)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, path)
+                except BaseException:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+                    raise
+                now = time.time()
+                text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                self._conn().execute(
+                    "INSERT OR REPLACE INTO entries"
+                    " (key, engine, lang, voice, text_hash, bytes, created_at, last_access)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, engine, lang, voice, text_hash, os.path.getsize(path), now, now),
+                )
+        finally:
+            with self._keys_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._key_locks.pop(key, None)
+        self.evict()
+        return path
+
+    def evict(self) -> int:
+        """日本語：合計が max_bytes 以下になるまで最終アクセスの古いものから消す。消した件数を返す"""
+        conn = self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        rows = conn.execute("SELECT key, bytes FROM entries WHERE last_access < ? ORDER BY last_access",
+                            (time.time() - self.min_age,)).fetchall()
+        n = 0
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            # 他ワーカーが同時に消していても、記録を消せた方だけがファイルを消す
+            if conn.execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+                n += 1
+            total -= size
+        with self._stats_lock:
+            self.evictions += n
+        return n
+
+    def stats(self) -> Dict:
+        entries, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries").fetchone()
+        with self._stats_lock:
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        lookups = hits + misses
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes,
+                "hits": hits, "misses": misses, "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "evictions": evictions}
+
+
+_cache = TTSCache()
+
+def synthesize_to_file(text: str, lang: str = TTS_LANG, voice: str = TTS_VOICE) -> str:
+    """textをMP3にしてキャッシュ（data/tts_cache）へ保存し、そのパスを返す（同じ本文・言語・声なら再合成しない）"""
+    return _cache.get_or_create(TTS_ENGINE, lang, voice, text,
+                                lambda f: gTTS(text=text, lang=lang, tld=voice).write_to_fp(f))
+
+def cache_stats() -> Dict:
+    """日本語：TTS キャッシュの件数・合計バイト数・ヒット率など"""
+    return _cache.stats()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# versions.py — 要約/転写の版管理（差分保存 + 定期キーフレーム）
+# 日本語コメント：
+#   全文コピーを毎回持つとメモリが版数倍になるので、直前版との差分（delta）だけを保存する。
+#   KEYFRAME_EVERY 版ごとに全文（キーフレーム）を置き、任意の版は
+#     「その版以前で最も近いキーフレーム（二分探索）」＋「最大 KEYFRAME_EVERY-1 個の差分適用」
+#   で復元する（O(log n + K)）。
+import re
+from bisect import bisect_right
+from datetime import datetime
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Optional
+
+KEYFRAME_EVERY = 8
+
+# 文（。！？ や改行の直後）単位で比較する。1文字単位の比較は長い転写で遅すぎるため。
+_UNIT_RE = re.compile(r"[^。！？!?\n]*[。！？!?\n]|[^。！？!?\n]+")
+
+def _units(text: str) -> List[str]:
+    return _UNIT_RE.findall(text or "")
+
+def make_delta(old: str, new: str) -> List[list]:
+    """
+    日本語：old → new の差分を JSON にできる命令列で返す。
+      ["=", n]    … old から n 文字そのまま
+      ["-", n]    … old の n 文字を捨てる
+      ["+", text] … text を挿入
+    """
+    a, b = _units(old), _units(new)
+    ops: List[list] = []
+
+    def emit(op, val):
+        if ops and ops[-1][0] == op:
+            ops[-1][1] += val
+        else:
+            ops.append([op, val])
+
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            emit("=", sum(len(u) for u in a[i1:i2]))
+            continue
+        if i2 > i1:
+            emit("-", sum(len(u) for u in a[i1:i2]))
+        if j2 > j1:
+            emit("+", "".join(b[j1:j2]))
+    return ops
+
+def apply_delta(old: str, ops: List[list]) -> str:
+    out, pos = [], 0
+    for op, val in ops:
+        if op == "=":
+            out.append(old[pos:pos + val])
+            pos += val
+        elif op == "-":
+            pos += val
+        else:
+            out.append(val)
+    return "".join(out)
+
+
+class VersionLog:
+    """
+    日本語：1つの録音の1フィールド分の版履歴（メモリ保持用）。
+    entries[v] = {"v", "at", "key", "data"}（key=True なら data は全文、False なら差分）
+    """
+
+    def __init__(self):
+        self.entries: List[Dict[str, Any]] = []
+        self._keyframes: List[int] = []  # キーフレームの版番号（昇順）
+        self._latest = ""
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, text: str) -> int:
+        """新しい版を追加して版番号を返す"""
+        v = len(self.entries)
+        key = v % KEYFRAME_EVERY == 0
+        self.entries.append({
+            "v": v,
+            "at": datetime.utcnow().isoformat(),
+            "key": key,
+            "data": text if key else make_delta(self._latest, text),
+        })
+        if key:
+            self._keyframes.append(v)
+        self._latest = text
+        return v
+
+    def get(self, v: int) -> Optional[str]:
+        if not 0 <= v < len(self.entries):
+            return None
+        k = self._keyframes[bisect_right(self._keyframes, v) - 1]
+        return replay(self.entries[k:v + 1])
+
+    def summary(self) -> List[Dict[str, Any]]:
+        return [describe(e) for e in self.entries]
+
+
+def replay(entries: List[Dict[str, Any]]) -> str:
+    """日本語：キーフレーム1つ + 後続の差分列から最後の版の全文を作る"""
+    text = entries[0]["data"]
+    for e in entries[1:]:
+        text = apply_delta(text, e["data"])
+    return text
+
+def describe(e: Dict[str, Any]) -> Dict[str, Any]:
+    """一覧用：本文は含めず、保存サイズの目安だけ返す"""
+    data = e["data"]
+    size = len(data) if e["key"] else sum(len(val) if op == "+" else 0 for op, val in data)
+    return {"v": e["v"], "at": e["at"], "keyframe": e["key"], "stored_chars": size}
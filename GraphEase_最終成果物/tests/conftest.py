@@ -0,0 +1,38 @@
+import hashlib
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+# リポジトリ直下から pytest を実行しても `import backend` できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def hash_encode(texts):
+    """埋め込みモデルの代わり：文字 bi-gram のハッシュ（同じ語を含む文ほど内積が大きい）"""
+    out = np.zeros((len(texts), 384), dtype="float32")
+    for row, t in zip(out, texts):
+        for i in range(max(1, len(t) - 1)):
+            row[int(hashlib.md5(t[i:i + 2].encode("utf-8")).hexdigest(), 16) % 384] += 1
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    return out / np.where(norms == 0, 1, norms)
+
+
+@pytest.fixture
+def rag_tenant(tmp_path, monkeypatch):
+    """rag のモジュール関数を tmp_path 下の新しいテナントで使う（埋め込みは hash_encode）"""
+    pytest.importorskip("sentence_transformers")  # rag は起動時に埋め込みモデルを読む
+    from backend import rag, tenants
+    from backend.embedder import BatchEncoder
+
+    monkeypatch.setattr(tenants, "TENANTS_DIR", str(tmp_path / "tenants"))
+    monkeypatch.setattr(rag, "PERSIST_DELAY_SEC", 0.01)
+    monkeypatch.setattr(rag, "_encoder", BatchEncoder(hash_encode, enabled=False))
+    rag._qvec_cache.clear()
+    rag._result_cache.clear()
+    with tenants.scope("t" + uuid.uuid4().hex[:12]) as t:
+        yield t
+    rag._rags.evict_idle(now=time.monotonic() + 1e9)  # 索引を保存して閉じる
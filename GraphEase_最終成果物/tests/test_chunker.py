@@ -0,0 +1,120 @@
+import random
+import time
+
+import pytest
+from backend.chunker import SentenceChunker, chunk_sentences, estimate_tokens, is_heading
+
+
+def sentences(text: str):
+    # 1文 = 上限ちょうどと数えれば、文ごとに1チャンクになる
+    return chunk_sentences(text, max_tokens=8, count_tokens=lambda s: 8)
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("フーリエ変換を導入する。例題を解く！質問は？", ["フーリエ変換を導入する。", "例題を解く！", "質問は？"]),
+    ("「これが定義です。」と述べた。次へ", ["「これが定義です。」", "と述べた。", "次へ"]),
+    ("Pi is 3.14 here. Next we move on.", ["Pi is 3.14 here.", "Next we move on."]),
+    ("Wait... Really?! Yes.", ["Wait...", "Really?!", "Yes."]),
+    ('He said "stop." Then left.', ['He said "stop."', "Then left."]),
+    ("Version 2.0.1 is out.\nEnd", ["Version 2.0.1 is out.", "End"]),
+    ("値は 0.5 と 1.25 です。", ["値は 0.5 と 1.25 です。"]),
+    ("Ends without a period", ["Ends without a period"]),
+])
+def test_sentence_boundaries(text, expected):
+    assert sentences(text) == expected
+
+
+def test_numbered_heading_is_not_a_sentence_end():
+    out = chunk_sentences("前の本文。\n1. 導入\n本文の1文目。本文の2文目。", max_tokens=64)
+    assert out == ["前の本文。", "1. 導入\n本文の1文目。本文の2文目。"]
+
+
+def test_streaming_matches_one_shot():
+    text = "Pi is 3.14 here. Next we move on. 固有値を求める。\n第2章 応用\nThe end."
+    one = sentences(text)
+    for cut in range(1, len(text)):
+        c = SentenceChunker(max_tokens=8, count_tokens=lambda s: 8)
+        assert c.feed(text[:cut]) + c.feed(text[cut:]) + c.finish() == one, cut  # "3." で途切れても切らない
+
+
+@pytest.mark.parametrize("text", [
+    "表" * 65536,                        # 文末の無い 64KB（rag.iter_txt_pages の1ブロック）
+    "cell value " * 6000,                # 空白はあるがピリオドが無い
+    "第1章 " + "." * 65536 + " 5\n",     # 目次のリーダー
+])
+def test_unterminated_input_is_linear(text):
+    t0 = time.perf_counter()
+    c = SentenceChunker(max_tokens=254)
+    chunks = [ch for i in range(0, len(text), 4096) for ch in c.feed(text[i:i + 4096])] + c.finish()
+    one = chunk_sentences(text, max_tokens=254)
+    assert time.perf_counter() - t0 < 2.0  # 以前は文末を探し直して O(n²)（64KB で 120 秒以上）
+    assert chunks and max(estimate_tokens(ch) for ch in chunks) <= 254
+    assert max(estimate_tokens(ch) for ch in one) <= 254
+
+
+def _notes(n: int, seed: int = 0, long: bool = True) -> str:
+    # 見出し・段落・英文・長い1文を含む講義ノート
+    rnd = random.Random(seed)
+    words = ["行列", "固有値", "ベクトル", "線形写像", "基底", "次元", "rank", "kernel", "3.14", "例えば"]
+    parts = []
+    for i in range(n):
+        if i % 15 == 0:
+            parts.append(f"\n第{i // 15 + 1}章 まとめと例題\n")
+        if long and i % 40 == 39:
+            parts.append("、".join(rnd.choice(words) for _ in range(300)) + "。")  # 上限を超える1文
+        elif i % 7 == 0:
+            parts.append(f"The {rnd.choice(words)} is {rnd.randint(1, 99)}.{rnd.randint(0, 9)} here. ")
+        else:
+            parts.append("".join(rnd.choice(words) for _ in range(rnd.randint(3, 12))) + rnd.choice("。！？"))
+        if i % 5 == 4:
+            parts.append("\n\n")
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("long", [False, True])
+def test_token_budget(long):
+    text = _notes(200, long=long)
+    limit = 64
+    chunks = chunk_sentences(text, max_tokens=limit, overlap=8)
+    toks = [estimate_tokens(c) for c in chunks]
+    assert max(toks) <= limit  # 上限を超えるチャンクが無い（モデルに切り捨てられない）
+    assert sum(toks) >= estimate_tokens(text)  # 落ちた本文が無い
+    assert sum(t >= limit // 2 for t in toks) >= 0.6 * len(toks)  # 小さな断片ばかりにならない
+    if not long:
+        assert sum(toks) == estimate_tokens(text)  # 文の間では重ねない（重複して埋め込むトークンが無い）
+
+
+def test_headings_start_a_chunk():
+    text = _notes(60, seed=1)
+    chunks = chunk_sentences(text, max_tokens=64)
+    headings = [line.strip() for line in text.splitlines() if is_heading(line)]
+    assert len(headings) == 4
+    starts = [c.splitlines()[0] for c in chunks]
+    assert all(h in starts for h in headings)
+
+
+def test_long_sentence_split_with_overlap():
+    s = "".join(f"{i:03d}番" for i in range(200)) + "。"
+    pieces = chunk_sentences("短い前文。" + s + "短い後文。", max_tokens=40, overlap=8)
+    assert pieces[0] == "短い前文。" and pieces[-1] == "短い後文。"
+    body = pieces[1:-1]
+    assert len(body) > 1 and all(estimate_tokens(p) <= 40 for p in body)
+    for a, b in zip(body, body[1:]):
+        assert b[:4] in a  # 隣どうしが重なる
+    assert body[0].startswith("000番") and body[-1].endswith("199番。")
+
+
+def test_bench_chunking_sentence_vs_fixed(tmp_path):
+    pytest.importorskip("sentence_transformers")  # rag は起動時に埋め込みモデルを読む
+    from backend import rag
+
+    paths = []
+    for seed in range(3):
+        p = tmp_path / f"notes{seed}.txt"
+        p.write_text(_notes(300, seed=seed), encoding="utf-8")
+        paths.append(str(p))
+    fixed, sent = rag.bench_chunking(paths, embed=False)
+    assert (fixed["chunker"], sent["chunker"]) == ("fixed", "sentence")
+    assert sent["over_limit"] == 0 and sent["tokens_embedded"] == sent["tokens_total"]
+    # 固定長 800 文字は上限を超え、後ろが切り捨てられる分だけ埋め込まれないトークンがある
+    assert fixed["over_limit"] > 0 and fixed["tokens_embedded"] < sent["tokens_embedded"]
@@ -0,0 +1,108 @@
+import threading
+import time
+import zlib
+
+import numpy as np
+from backend.embedder import BatchEncoder, bench
+
+DIM = 4
+
+
+class FakeModel:
+    """1回の呼び出しに 8ms + 1文 0.3ms かかり、同時には1本しか動かない（共有モデル相当）"""
+
+    def __init__(self, fail: bool = False):
+        self.calls = []
+        self.threads = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls.append(len(texts))
+            self.threads.append(threading.current_thread().name)
+            time.sleep(0.008 + 0.0003 * len(texts))
+            if self.fail:
+                raise RuntimeError("model failed")
+            return np.array([embed(t) for t in texts], dtype="float32").reshape(len(texts), DIM)
+
+
+def embed(text: str) -> np.ndarray:
+    h = zlib.crc32(text.encode("utf-8"))
+    return np.array([h % 997, len(text), h % 13, 1.0], dtype="float32")
+
+
+def _concurrently(n, fn):
+    out = [None] * n
+    errors = []
+    start = threading.Barrier(n)
+
+    def run(k):
+        start.wait()
+        try:
+            out[k] = fn(k)
+        except Exception as e:
+            errors.append(e)
+
+    ts = [threading.Thread(target=run, args=(k,)) for k in range(n)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return out, errors
+
+
+def test_results_fan_out_to_each_caller():
+    model = FakeModel()
+    enc = BatchEncoder(model, max_batch=32, max_wait_ms=5, enabled=True)
+    texts = [[f"クエリ {k}-{j}" for j in range(1 + k % 3)] for k in range(16)]
+    out, errors = _concurrently(16, lambda k: enc.encode(texts[k]))
+    assert not errors
+    for k, vecs in enumerate(out):
+        np.testing.assert_array_equal(vecs, np.array([embed(t) for t in texts[k]]))
+    st = enc.stats()
+    assert st["items"] == sum(len(t) for t in texts)
+    assert st["batches"] < 16 and st["mean_batch"] > 1  # まとめて計算された
+    assert max(model.calls) <= 32 + 2  # 最後に足した要求の分だけ max_batch を超えうる
+    assert set(model.threads) == {"embed-batcher"}
+
+
+def test_large_calls_bypass_the_queue():
+    model = FakeModel()
+    enc = BatchEncoder(model, max_batch=4, max_wait_ms=50, enabled=True)
+    t0 = time.perf_counter()
+    vecs = enc.encode([f"チャンク {i}" for i in range(4)])
+    assert vecs.shape == (4, DIM)
+    assert time.perf_counter() - t0 < 0.05  # 待ち時間なし
+    assert model.threads == [threading.current_thread().name]
+    assert enc.stats()["batches"] == 0
+
+
+def test_disabled_and_empty():
+    model = FakeModel()
+    enc = BatchEncoder(model, max_batch=32, enabled=False)
+    assert enc.encode(["a"]).shape == (1, DIM)
+    assert model.threads == [threading.current_thread().name]
+    assert BatchEncoder(model, max_batch=1, enabled=True).enabled is False
+
+
+def test_model_error_reaches_every_caller():
+    enc = BatchEncoder(FakeModel(fail=True), max_batch=32, max_wait_ms=20, enabled=True)
+    out, errors = _concurrently(4, lambda k: enc.encode([f"q{k}"]))
+    assert len(errors) == 4 and all(isinstance(e, RuntimeError) for e in errors)
+    # 失敗の後も使える
+    enc._fn = FakeModel()
+    assert enc.encode(["ok"]).shape == (1, DIM)
+
+
+def test_batching_raises_throughput_under_concurrency():
+    concurrency = 8
+    rows = bench(FakeModel(), max_concurrency=concurrency, per_thread=10, waits_ms=(2.0,))
+    direct = next(r for r in rows if r["mode"] == "direct" and r["concurrency"] == concurrency)
+    batched = next(r for r in rows if r["mode"] == "batched" and r["concurrency"] == concurrency)
+    assert batched["mean_batch"] > 2
+    assert batched["qps"] >= 2 * direct["qps"]
+    assert batched["p95_ms"] < direct["p95_ms"]
+    # 1本だけなら待ち時間（2ms）の分しか遅くならない
+    single = [r for r in rows if r["concurrency"] == 1]
+    assert single[1]["p50_ms"] < single[0]["p50_ms"] + 5
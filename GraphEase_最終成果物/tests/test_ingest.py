@@ -0,0 +1,135 @@
+import time
+
+import pytest
+
+pytest.importorskip("sentence_transformers")  # ingest は rag（埋め込みモデル）を使う
+
+from backend import ingest, rag  # noqa: E402
+
+FILES = 6
+
+
+def _folder(tmp_path):
+    root = tmp_path / "semester"
+    (root / "week2").mkdir(parents=True)
+    for i in range(FILES):
+        sub = root / ("week2" if i % 2 else "")
+        text = "".join(f"第{i}回の資料 {j} 行目。固有値{i}と対角化{j}の説明。\n" for j in range(40))
+        (sub / f"lec{i}.txt").write_text(text, encoding="utf-8")
+    (root / "copy_of_lec0.txt").write_text((root / "lec0.txt").read_text(encoding="utf-8"), encoding="utf-8")
+    (root / "empty.txt").write_text("   \n", encoding="utf-8")
+    (root / "notes.md").write_text("対象外", encoding="utf-8")
+    return root
+
+
+def _run(root, **kw):
+    paths = ingest.list_material_files(str(root))
+    return ingest.create_bulk_run(paths, run_id=ingest.dir_run_id(str(root)), source=str(root), **kw)
+
+
+def test_bulk_ingest_folder(rag_tenant, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "BULK_EMBED_BATCH", 16)
+    root = _folder(tmp_path)
+    run = _run(root, namespaces=["course:線形代数"])
+    assert len(run["files"]) == FILES + 2  # .md は対象外
+    res = ingest.bulk_ingest(run["id"])
+
+    assert res["state"] == "done" and res["commits"] == 1  # 索引の保存は最後の1回だけ
+    assert res["counts"] == {"done": FILES, "skipped": 1, "error": 1}
+    by_name = {f["path"].rsplit("/", 1)[-1]: f for f in res["files"]}
+    assert by_name["copy_of_lec0.txt"]["mat_id"] == by_name["lec0.txt"]["mat_id"]  # 同じ内容は1回だけ
+    assert by_name["empty.txt"]["error"]
+    chunks = sum(f["chunks"] for f in res["files"] if f["state"] == "done")
+    assert rag.index_stats()["live"] == chunks
+    hit = rag.hybrid_search("第3回の資料 固有値3", top_k=1, namespace="course:線形代数")["hits"][0]
+    assert hit["mat_id"] == by_name["lec3.txt"]["mat_id"]
+    assert not ingest.bulk_running(run["id"])
+
+    again = ingest.bulk_ingest(_run(root)["id"])  # 同じフォルダをもう一度：何もしない
+    assert again["counts"] == res["counts"] and rag.index_stats()["live"] == chunks
+
+
+def test_interrupted_run_resumes(rag_tenant, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "BULK_WORKERS", 1)
+    monkeypatch.setattr(ingest, "BULK_CHECKPOINT_FILES", 2)  # 2ファイルごとに保存
+    root = _folder(tmp_path)
+    run = _run(root)
+    real = ingest._extract_file
+    extracted = []
+
+    def crash_on_fifth(path):
+        extracted.append(path)
+        if len(extracted) == 5:
+            raise KeyboardInterrupt  # 5 ファイル目の抽出中に止められた
+        return real(path)
+
+    monkeypatch.setattr(ingest, "_extract_file", crash_on_fifth)
+    with pytest.raises(KeyboardInterrupt):
+        ingest.bulk_ingest(run["id"])
+    st = ingest.get_bulk_status(run["id"])
+    assert st["state"] == "error"
+    done = {f["path"] for f in st["files"] if f["state"] in ("done", "skipped")}
+    assert len(done) >= 2
+
+    extracted.clear()
+    monkeypatch.setattr(ingest, "_extract_file", lambda p: extracted.append(p) or real(p))
+    res = ingest.bulk_ingest(run["id"])  # 続きから
+    assert res["state"] == "done"
+    assert res["counts"] == {"done": FILES, "skipped": 1, "error": 1}
+    assert not done & set(extracted)  # 保存済みのファイルは読み直さない
+    chunks = sum(f["chunks"] for f in res["files"] if f["state"] == "done")
+    live = rag._mgr().live_hashes()
+    assert len(live) == len(set(live)) == chunks  # やり直したファイルの行も重複しない
+    assert len({f["mat_id"] for f in res["files"] if f["state"] == "done"}) == FILES
+
+
+def test_create_bulk_run_adds_only_new_files(rag_tenant, tmp_path):
+    root = _folder(tmp_path)
+    run = _run(root)
+    (root / "lec9.txt").write_text("追加の資料。", encoding="utf-8")
+    again = _run(root)
+    assert again["id"] == run["id"]
+    assert [f["path"] for f in again["files"][:-1]] == [f["path"] for f in run["files"]]
+    assert again["files"][-1]["path"].endswith("lec9.txt") and again["files"][-1]["state"] == "pending"
+
+
+def test_failed_batch_does_not_mark_file_done(rag_tenant, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "BULK_EMBED_BATCH", 6)  # 1ファイル 4 チャンク：2回目の埋め込みは前のファイルの行を含む
+    root = _folder(tmp_path)
+    real, calls = rag.index_rows, []
+
+    def fail_second_batch(vecs, rows):
+        calls.append(len(rows))
+        if len(calls) == 2:
+            raise RuntimeError("索引に入れられない")
+        return real(vecs, rows)
+
+    monkeypatch.setattr(rag, "index_rows", fail_second_batch)
+    res = ingest.bulk_ingest(_run(root)["id"])
+    assert res["state"] == "done"
+    failed = [f for f in res["files"] if f["error"] == "索引に入れられない"]
+    assert len(failed) == 1 and failed[0]["state"] == "error"
+    assert rag.find_ingested_file(failed[0]["path"])[1] is None  # 取り込み済みとして記録しない
+    done = [f for f in res["files"] if f["state"] == "done"]
+    assert all(rag.find_ingested_file(f["path"])[1] for f in done)
+    assert len(rag._mgr().live_hashes()) == sum(f["chunks"] for f in done)  # 前のファイルの行は失われない
+
+
+def _wait_dropped(job_id):
+    for _ in range(500):
+        if job_id not in ingest._jobs:  # 終わったジョブは一覧から外れる
+            return ingest.get_status(job_id)  # 状態は jobs/<id>.json から返す
+        time.sleep(0.02)
+    raise AssertionError("job was not dropped")
+
+
+def test_finished_jobs_are_dropped(rag_tenant, tmp_path):
+    root = _folder(tmp_path)
+    ok = ingest.submit("lec1", str(root / "week2" / "lec1.txt"))
+    bad = ingest.submit("empty", str(root / "empty.txt"))
+    assert _wait_dropped(ok.id)["state"] == "done" and _wait_dropped(bad.id)["state"] == "error"
+    assert not ingest.is_active(ok.id)
+    assert ok.seen == set() and bad.seen == set()
+    assert ingest.get_status(ok.id)["result"]["chunks"] == ok.chunks_total > 0
+    with ingest._jobs_lock:
+        assert ingest._active_jobs_locked(rag_tenant) == 0
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from backend.lru import LRUCache
+
+
+def test_evicts_least_recently_used():
+    c = LRUCache(3)
+    for k in "abc":
+        c.put(k, k.upper())
+    assert c.get("a") == "A"  # a を使ったので、次に捨てられるのは b
+    c.put("d", "D")
+    assert c.get("b") is None
+    assert [c.get(k) for k in "acd"] == ["A", "C", "D"]
+    c.put("a", "A2")  # 上書きも「使った」扱い
+    c.put("e", "E")
+    assert c.get("c") is None and c.get("a") == "A2"
+    assert len(c) == 3
+
+
+def test_ttl_expires_entries():
+    c = LRUCache(10, ttl=0.05)
+    c.put("q", 1)
+    assert c.get("q") == 1
+    time.sleep(0.08)
+    assert c.get("q", "miss") == "miss"
+    assert len(c) == 0  # 期限切れは読んだときに捨てる
+    c.put("q", 2)
+    assert c.get("q") == 2
+
+
+def test_stats_and_clear():
+    c = LRUCache(2, ttl=30)
+    c.put("a", 1)
+    c.get("a")
+    c.get("b")
+    assert c.stats() == {"size": 1, "maxsize": 2, "ttl": 30, "hits": 1, "misses": 1}
+    c.clear()
+    assert len(c) == 0 and c.get("a") is None
+
+
+def test_zero_size_stores_nothing():
+    c = LRUCache(0)
+    c.put("a", 1)
+    assert c.get("a") is None and len(c) == 0
+
+
+def test_concurrent_access_keeps_bound():
+    c = LRUCache(50)
+
+    def work(k):
+        for i in range(2000):
+            c.put((k, i % 80), i)
+            c.get((k, (i * 7) % 80))
+
+    ts = [threading.Thread(target=work, args=(k,)) for k in range(4)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    st = c.stats()
+    assert len(c) == 50
+    assert st["hits"] + st["misses"] == 4 * 2000
@@ -0,0 +1,74 @@
+import multiprocessing as mp
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import backend.storage as storage
+from backend.locks import FileLock
+
+PROCS = 3
+REMINDERS = 60
+
+
+def test_sqlite_bench_no_lost_updates(tmp_path):
+    rows = storage.bench(max_workers=4, ops=30, root=str(tmp_path))
+    assert [r["workers"] for r in rows] == [1, 2, 4]
+    for r in rows:
+        assert r["exitcodes"] == [0]
+        assert r["records"] == r["workers"] * 30
+        assert r["lost_updates"] == 0
+
+
+def _reminder_process(lock_path: str, out_path: str, stop_path: str) -> None:
+    # 1ワーカー分：reminders のループと同じく、リーダーになれた周だけ送る（毎周手放して交代させる）
+    from backend import reminders, tenants
+
+    tenants.TENANTS_DIR = os.path.join(os.path.dirname(lock_path), "tenants")
+    leader = FileLock(lock_path)
+
+    def send(to, subject, body):
+        with open(out_path, "a", encoding="utf-8") as f:
+            f.write(f"{os.getpid()} {to}\n")
+        return True
+
+    reminders.send_email = send
+    while True:
+        stop = os.path.exists(stop_path)
+        if leader.acquire(blocking=False):
+            try:
+                reminders._send_due()
+            finally:
+                leader.release()
+        if stop:
+            return
+        time.sleep(0.002)
+
+
+def test_reminders_sent_once_across_processes(tmp_path, monkeypatch):
+    db = str(tmp_path / "preppal.db")
+    monkeypatch.setenv("STORAGE_BACKEND", "sqlite")  # 子プロセスは環境変数から共有ストアを開く
+    monkeypatch.setenv("STORAGE_DB", db)
+    lock_path, out_path, stop_path = (str(tmp_path / n) for n in ("reminders.lock", "sent.txt", "stop"))
+    st = storage.SqliteStore(db)
+
+    ctx = mp.get_context("spawn")
+    procs = [ctx.Process(target=_reminder_process, args=(lock_path, out_path, stop_path)) for _ in range(PROCS)]
+    for p in procs:
+        p.start()
+    due = datetime.utcnow() - timedelta(seconds=1)
+    for i in range(REMINDERS):
+        st.add_reminder({"id": uuid.uuid4().hex, "email": f"{i}@example.com", "due_at": due,
+                         "recording_id": "r", "title": "t", "sent": False})
+        time.sleep(0.005)
+    open(stop_path, "w").close()
+    for p in procs:
+        p.join(timeout=60)
+    assert [p.exitcode for p in procs] == [0] * PROCS
+
+    with open(out_path, encoding="utf-8") as f:
+        sent = [line.split() for line in f]
+    emails = [to for _, to in sent]
+    assert sorted(emails) == sorted(f"{i}@example.com" for i in range(REMINDERS))  # 漏れも重複もない
+    assert st.iter_due_reminders(datetime.utcnow()) == []
+    st.close()
@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = 12
+
+
+def write_pdf(path: str, pages: int) -> None:
+    """テスト用の最小の PDF（1ページに1行 "page <番号>"）"""
+    objs = ["<< /Type /Catalog /Pages 2 0 R >>",
+            "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{4 + 2 * i} 0 R" for i in range(pages)), pages),
+            "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i in range(pages):
+        stream = f"BT /F1 24 Tf 72 720 Td (page {i}) Tj ET"
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                    f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objs.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for n, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+# python -m <重いモジュール> で起動した親の代わり。import されるたびに印を残し、起動に時間がかかる
+HEAVY_MAIN = """
+import os, sys, time
+with open(os.environ["IMPORT_LOG"], "a") as f:
+    f.write(f"{os.getpid()}\\n")
+time.sleep(float(os.environ.get("HEAVY_IMPORT_SEC", "0")))  # Whisper / 埋め込みモデルの読み込みの代わり
+
+if __name__ == "__main__":
+    from backend import pdf_extract
+    pdf_extract.PDF_PARALLEL_MIN_PAGES = 0
+    t0 = time.perf_counter()
+    pages = list(pdf_extract.iter_pages(sys.argv[1], workers=2))
+    print(round(time.perf_counter() - t0, 3))
+    assert [p.strip() for p in pages] == [f"page {i}" for i in range(len(pages))], pages
+"""
+
+
+def _run_heavy_main(tmp_path, heavy_sec: float):
+    pytest.importorskip("pdfplumber")
+    pdf = str(tmp_path / "doc.pdf")
+    write_pdf(pdf, PAGES)
+    pkg = tmp_path / "heavyapp"
+    pkg.mkdir(exist_ok=True)
+    (pkg / "__init__.py").write_text("")
+    (pkg / "main.py").write_text(textwrap.dedent(HEAVY_MAIN))
+    log = tmp_path / "imports.log"
+    env = {**os.environ, "IMPORT_LOG": str(log), "HEAVY_IMPORT_SEC": str(heavy_sec),
+           "PYTHONPATH": os.pathsep.join([str(tmp_path), ROOT])}
+    out = subprocess.run([sys.executable, "-m", "heavyapp.main", pdf], env=env, cwd=str(tmp_path),
+                         capture_output=True, text=True, timeout=120)
+    assert out.returncode == 0, out.stderr
+    return log.read_text().split(), float(out.stdout.strip().splitlines()[-1])
+
+
+def test_workers_do_not_reimport_main_module(tmp_path):
+    imported, _ = _run_heavy_main(tmp_path, 0)
+    assert len(imported) == 1  # 親だけ（ワーカーは __main__ を読み込まない）
+
+
+def test_heavy_main_does_not_delay_extraction(tmp_path):
+    # 親の __main__ の読み込みに 3 秒かかっても、ワーカーの起動を含む抽出はそれを待たない
+    t0 = time.perf_counter()
+    _, sec = _run_heavy_main(tmp_path, 3.0)
+    assert time.perf_counter() - t0 >= 3.0
+    assert sec < 3.0
+
+
+def test_iter_pages_serial_and_parallel_match(tmp_path):
+    pytest.importorskip("pdfplumber")
+    from backend import pdf_extract
+
+    pdf = str(tmp_path / "doc.pdf")
+    write_pdf(pdf, PAGES)
+    assert pdf_extract.page_count(pdf) == PAGES
+    serial = list(pdf_extract.iter_pages(pdf, workers=1))
+    assert [p.strip() for p in serial] == [f"page {i}" for i in range(PAGES)]
+    assert list(pdf_extract._iter_forced(pdf, 2)) == serial
+
+
+def test_starting_workers_leaves_main_module_alone(tmp_path):
+    pytest.importorskip("pdfplumber")
+    from backend import pdf_extract
+
+    pdf = str(tmp_path / "doc.pdf")
+    write_pdf(pdf, PAGES)
+    pdf_extract._reset_pool()
+    main, seen, stop = sys.modules["__main__"], set(), threading.Event()
+
+    def watch():  # ワーカーの起動中も他のスレッドからは同じ __main__ が見える
+        while not stop.is_set():
+            seen.add(id(sys.modules["__main__"]))
+
+    th = threading.Thread(target=watch)
+    th.start()
+    try:
+        out = [list(pdf_extract._iter_forced(pdf, 3)) for _ in range(2)]
+    finally:
+        stop.set()
+        th.join()
+    assert out[0] == out[1] and [p.strip() for p in out[0]] == [f"page {i}" for i in range(PAGES)]
+    assert seen == {id(main)}
@@ -0,0 +1,292 @@
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")  # rag は起動時に埋め込みモデルを読む
+
+from backend import rag, tenants  # noqa: E402
+from backend.rag import DIM, IndexManager, text_hash  # noqa: E402
+
+
+def _vecs(n: int, seed: int = 0) -> np.ndarray:
+    x = np.random.default_rng(seed).standard_normal((n, DIM)).astype("float32")
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def _rows(mat_id: str, texts, ns=()):
+    return [{"mat_id": mat_id, "title": mat_id, "filepath": f"/tmp/{mat_id}.txt", "kind": "txt",
+             "chunk_id": i, "ns": list(ns), "h": text_hash(t), "text": t} for i, t in enumerate(texts)]
+
+
+@pytest.fixture
+def rag_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag, "PERSIST_DELAY_SEC", 0.01)
+    return str(tmp_path / "rag")
+
+
+@pytest.fixture
+def mgr(rag_dir):
+    m = IndexManager(rag_dir)
+    yield m
+    m.close()
+
+
+def test_manifest_read_only_when_replaced(rag_dir, mgr, monkeypatch):
+    mgr.add(_vecs(5), _rows("a", [f"資料A-{i}" for i in range(5)]))
+    mgr.flush()
+    reads = []
+    real = rag._read_manifest
+    monkeypatch.setattr(rag, "_read_manifest", lambda *a, **kw: reads.append(1) or real(*a, **kw))
+
+    for _ in range(50):
+        assert len(mgr) == 5
+        mgr.search(_vecs(1, seed=9), 3)
+    assert reads == []  # 変わっていない manifest は開かない
+
+    other = IndexManager(rag_dir)  # 別ワーカー相当
+    other.add(_vecs(3, seed=1), _rows("b", [f"資料B-{i}" for i in range(3)]))
+    other.close()
+    assert len(mgr) == 8  # 差し替えられた manifest は読み直す
+    n = len(reads)
+    assert n >= 1
+    for _ in range(20):
+        assert len(mgr) == 8
+    assert len(reads) == n
+
+
+# ---------- ANN への昇格と recall ----------
+RECALL_N = 4000
+
+
+def _clustered(n: int, seed: int = 0, centers: int = 64, spread: float = 0.35) -> np.ndarray:
+    # 埋め込みに近い（話題ごとにまとまった）単位ベクトル
+    rng = np.random.default_rng(seed)
+    c = rng.standard_normal((centers, DIM)).astype("float32")
+    c /= np.linalg.norm(c, axis=1, keepdims=True)
+    x = c[rng.integers(0, centers, n)] + spread * rng.standard_normal((n, DIM)).astype("float32") / np.sqrt(DIM)
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype("float32")
+
+
+def _recall(rag_dir, monkeypatch, ann: str, store: str) -> dict:
+    monkeypatch.setattr(rag, "RAG_ANN", ann)
+    monkeypatch.setattr(rag, "RAG_STORE", store)
+    monkeypatch.setattr(rag, "RAG_ANN_THRESHOLD", RECALL_N // 2)
+    monkeypatch.setattr(rag, "RAG_STORE_TRAIN_MIN", RECALL_N // 2)
+    x = _clustered(RECALL_N)
+    rows = _rows("m", [f"chunk {i}" for i in range(RECALL_N)])
+    raw = {r["h"]: v for r, v in zip(rows, x)}  # 埋め込みキャッシュの代わり（再採点に使う元の float32）
+    m = IndexManager(rag_dir, raw_vectors=lambda hs: {h: raw[h] for h in hs if h in raw})
+    try:
+        m.add(x, rows)
+        while m._rebuilding:
+            time.sleep(0.05)
+        return m.measure_recall(k=10)
+    finally:
+        m.close()
+
+
+@pytest.mark.parametrize("ann,index_type", [("ivf", "IndexIVFFlat"), ("hnsw", "IndexHNSWFlat")])
+def test_ann_promotion_recall(rag_dir, monkeypatch, ann, index_type):
+    r = _recall(rag_dir, monkeypatch, ann, "flat")
+    assert r["index"] == index_type
+    assert r["n"] == RECALL_N
+    assert r["recall_at_k"] >= 0.95
+    assert r["recall_at_k_search"] >= 0.95
+
+
+# 圧縮形式：再採点（上位 k×RAG_RERANK 件を元の float32 で採点し直す）で recall が戻る
+# n=4000・RAG_RERANK=4 で測った値（そのまま → 再採点）：
+#   flat+sq8 0.98 → 1.0 / flat+pq 0.39 → 0.86 / ivf+sq8 0.99 → 1.0 / ivf+pq 0.63 → 0.98
+@pytest.mark.parametrize("ann,store,index_type,min_recall", [
+    ("flat", "sq8", "IndexScalarQuantizer", 0.95),
+    ("flat", "pq", "IndexPQ", 0.8),
+    ("ivf", "sq8", "IndexIVFScalarQuantizer", 0.95),
+    ("ivf", "pq", "IndexIVFPQ", 0.9),
+])
+def test_compressed_store_recall_with_rerank(rag_dir, monkeypatch, ann, store, index_type, min_recall):
+    r = _recall(rag_dir, monkeypatch, ann, store)
+    assert r["index"] == index_type and r["lossy"]
+    assert r["index_bytes"] < RECALL_N * DIM * 4 / 3  # float32 の 1/3 未満
+    assert r["recall_at_k_search"] >= min_recall
+    assert r["recall_at_k_search"] >= r["recall_at_k"]
+
+
+def test_rerank_disabled_returns_raw_order(rag_dir, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_RERANK", 0)
+    r = _recall(rag_dir, monkeypatch, "flat", "pq")
+    assert r["recall_at_k_search"] == pytest.approx(r["recall_at_k"])
+    assert r["recall_at_k"] < 0.8  # 再採点しないと pq は大きく取りこぼす
+
+
+# ---------- 資料の削除・差し替え（ID 付き index とコンパクション） ----------
+def _add(m: IndexManager, mat_id: str, n: int, seed: int):
+    x = _vecs(n, seed)
+    rows = _rows(mat_id, [f"{mat_id} の {i} 番目のチャンク" for i in range(n)])
+    m.add(x, rows)
+    return x, rows
+
+
+def test_drop_material_tombstones_rows(rag_dir, mgr):
+    xa, _ = _add(mgr, "a", 5, seed=1)
+    _add(mgr, "b", 5, seed=2)
+    assert mgr.search(xa[:1], 1)[0]["mat_id"] == "a"
+
+    assert mgr.drop_material("a") == 5
+    assert len(mgr) == 5 and not mgr.has_material("a") and mgr.has_material("b")
+    assert {h["mat_id"] for h in mgr.search(xa[:1], 10)} == {"b"}  # 削除済みは検索に出ない
+    assert mgr.stats()["deleted"] == 5
+    assert mgr.drop_material("a") == 0
+    mgr.flush()
+
+    reopened = IndexManager(rag_dir)
+    assert len(reopened) == 5 and not reopened.has_material("a")
+    assert {h["mat_id"] for h in reopened.search(xa[:1], 10)} == {"b"}
+    reopened.close()
+
+
+def test_replace_keeps_unchanged_chunks(mgr):
+    _, rows = _add(mgr, "a", 4, seed=1)
+    ids = {r["h"]: r["id"] for r in rows}
+    keep = {rows[0]["h"], rows[2]["h"]}
+    assert mgr.drop_material("a", keep=keep) == 2
+    assert mgr.material_hashes("a") == keep
+    assert sorted(mgr.live_hashes()) == sorted(keep)
+    assert {ids[h] for h in keep} == {r["id"] for r in rows if r["h"] in keep}  # 残した行の ID は変わらない
+
+
+def test_shared_chunk_survives_owner_delete(mgr):
+    xa, rows = _add(mgr, "a", 3, seed=1)
+    mat_b = {"mat_id": "b", "title": "b", "filepath": "/tmp/b.txt", "kind": "txt", "ns": ["course:線形代数"]}
+    mgr.add_owner(mat_b, [(0, rows[1]["h"])])  # b にも同じチャンクが含まれる
+    assert mgr.has_material("b") and mgr.namespaces() == {"course:線形代数": 1}
+
+    assert mgr.drop_material("a") == 2  # 共有している行は消さず、所有者を b に付け替える
+    hit = mgr.search(xa[1:2], 1)[0]
+    assert hit["mat_id"] == "b" and hit["text"] == rows[1]["text"] and hit["filepath"] == "/tmp/b.txt"
+    assert mgr.drop_material("b") == 1
+    assert len(mgr) == 0
+
+
+def test_compaction_purges_tombstones(rag_dir, mgr, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_COMPACT_MIN", 4)
+    monkeypatch.setattr(rag, "RAG_COMPACT_RATIO", 0.2)
+    _add(mgr, "a", 10, seed=1)
+    xb, _ = _add(mgr, "b", 10, seed=2)
+    mgr.flush()
+    mgr.drop_material("a")
+    while mgr._rebuilding:
+        time.sleep(0.02)
+    mgr.flush()
+    st = mgr.stats()
+    assert (st["vectors"], st["live"], st["deleted"]) == (10, 10, 0)
+    assert [h["mat_id"] for h in mgr.search(xb[:1], 1)] == ["b"]
+
+    reopened = IndexManager(rag_dir)
+    st = reopened.stats()
+    assert (st["vectors"], st["live"], st["deleted"]) == (10, 10, 0)
+    report = reopened.check()
+    assert report["ok"], report
+    assert report["rows"] == 10 and report["tombstones"] == 0
+    reopened.close()
+
+
+# ---------- manifest による2相コミット・複数プロセスの書き込み ----------
+def test_failed_commit_leaves_previous_generation(rag_dir, mgr, monkeypatch):
+    _add(mgr, "a", 3, seed=1)
+    mgr.flush()
+    gen = mgr.stats()["generation"]
+    real = rag._write_manifest
+
+    def crash(path, m):
+        raise OSError("disk full")  # 1) 準備の後、2) 確定の前に落ちた
+
+    monkeypatch.setattr(rag, "_write_manifest", crash)
+    _add(mgr, "b", 4, seed=2)
+    with pytest.raises(OSError):
+        mgr.flush()
+
+    reader = IndexManager(rag_dir)  # 他プロセス相当：確定済みの世代だけが見える
+    assert len(reader) == 3 and not reader.has_material("b")
+    assert rag._read_manifest(reader.manifest_path)["generation"] == gen
+
+    monkeypatch.setattr(rag, "_write_manifest", real)
+    mgr.flush()  # 次の保存で書き直す（失敗した分のログも失わない）
+    assert len(reader) == 7 and reader.has_material("b")
+    reader.close()
+
+
+def test_check_repairs_uncommitted_leftovers(rag_dir, mgr):
+    _add(mgr, "a", 3, seed=1)
+    mgr.close()
+    m = rag._read_manifest(os.path.join(rag_dir, "manifest.json"))
+    with open(os.path.join(rag_dir, f"meta-{m['meta']}.rec"), "ab") as f:
+        f.write(b"\0" * 64)  # 確定前に落ちた追記
+    with open(os.path.join(rag_dir, "faiss-999.index"), "wb") as f:
+        f.write(b"half written")
+
+    m2 = IndexManager(rag_dir)  # 起動時に修復される
+    assert len(m2) == 3
+    report = m2.check()
+    assert report["ok"], report
+    assert not os.path.exists(os.path.join(rag_dir, "faiss-999.index"))
+    m2.close()
+
+
+def test_check_reports_and_repairs(rag_dir, mgr):
+    _add(mgr, "a", 3, seed=1)
+    mgr.flush()
+    with open(os.path.join(rag_dir, "faiss-999.index"), "wb") as f:
+        f.write(b"stray")
+    report = mgr.check()
+    assert not report["ok"] and "stray_files" in report["problems"]
+    assert mgr.check(repair=True)["repaired"]
+    assert mgr.check()["ok"]
+    assert len(mgr) == 3
+
+
+def test_concurrent_writers_do_not_overwrite_each_other(rag_dir):
+    managers = [IndexManager(rag_dir) for _ in range(2)]
+
+    def writer(k):
+        for j in range(5):
+            _add(managers[k], f"m{k}-{j}", 10, seed=10 * k + j)
+
+    threads = [threading.Thread(target=writer, args=(k,)) for k in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for m in managers:
+        m.close()
+
+    reopened = IndexManager(rag_dir)
+    st = reopened.stats()
+    assert (st["vectors"], st["live"]) == (100, 100)  # chunk ID が重ならず、互いの追加も消えていない
+    assert len(reopened.live_hashes()) == len(set(reopened.live_hashes())) == 100
+    assert reopened.check()["ok"]
+    reopened.close()
+
+
+def test_unloaded_tenant_closes_embedding_cache(rag_tenant):
+    texts = ["固有値と固有ベクトル。", "フーリエ変換とスペクトル。"]
+    rows = rag.new_chunk_rows({"mat_id": "m1", "title": "m1", "filepath": "/tmp/m1.txt", "kind": "txt", "ns": []},
+                              list(enumerate(texts)), set())
+    with tenants.scope("other"):
+        rag.index_rows(rag.embed_rows(rows), rows)
+        cache = rag.embedding_cache("other")
+        th = threading.Thread(target=lambda: cache.get_many([rows[0]["h"]]))  # 別スレッドの接続も閉じる
+        th.start()
+        th.join()
+    conns = list(cache._conns)
+    assert len(conns) >= 2
+    assert "other" in rag._rags.evict_idle(now=time.monotonic() + 1e9)
+    assert cache._conns == []
+    for conn in conns:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+    with tenants.scope("other"):  # 読み直せば使える
+        assert set(rag.embedding_cache("other").get_many([r["h"] for r in rows])) == {r["h"] for r in rows}
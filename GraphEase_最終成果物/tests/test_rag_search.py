@@ -0,0 +1,111 @@
+import uuid
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")  # rag は起動時に埋め込みモデルを読む
+
+from backend import rag  # noqa: E402
+
+TOPICS = {
+    "フーリエ": "フーリエ変換は周期関数を三角関数の和に分解する。スペクトルと周波数成分を調べる。",
+    "固有値": "固有値と固有ベクトルを求めて行列を対角化する。特性方程式の根が固有値になる。",
+    "確率": "確率分布の期待値と分散を計算する。正規分布と二項分布を比べる。",
+}
+
+
+def index_material(title: str, texts, ns=()):
+    """資料 title を索引に入れる（取り込みの各段を直接呼ぶ）"""
+    mat = {"mat_id": str(uuid.uuid4()), "title": title, "filepath": f"/tmp/{title}.txt", "kind": "txt",
+           "ns": list(ns)}
+    rows = rag.new_chunk_rows(mat, list(enumerate(texts)), set())
+    rag.index_rows(rag.embed_rows(rows), rows)
+    return mat["mat_id"]
+
+
+def _lecture(head: str, tail: str, repeat: int = 20) -> str:
+    # 講義の大半は head の話題で、最後の方だけ tail の話題になる文字起こし
+    return (TOPICS[head] + "えー、では次に進みます。") * repeat + TOPICS[tail] * 2
+
+
+def test_query_windows_short_and_empty():
+    assert rag.query_windows("短い質問です") == ["短い質問です"]
+    assert rag.query_windows("") == []
+
+
+def test_query_windows_capped_and_evenly_spread():
+    text = "".join(f"{i:04d}" for i in range(2000))  # 8000 文字
+    every = rag.chunk_text(text, 200, 40)
+    wins = rag.query_windows(text, size=200, overlap=40, max_windows=8)
+    assert len(every) > 8 and len(wins) == 8
+    assert wins[0] == every[0] and wins[-1] == every[-1]  # 冒頭から末尾まで
+    pos = [every.index(w) for w in wins]
+    gaps = np.diff(pos)
+    assert (gaps > 0).all() and gaps.max() - gaps.min() <= 1  # 等間隔
+
+
+def test_transcript_search_covers_whole_lecture(rag_tenant):
+    for title, text in TOPICS.items():
+        index_material(title, [text])
+    transcript = _lecture("フーリエ", "固有値")
+    res = rag.transcript_search(transcript, top_k=3)
+
+    assert res["windows"] == len(rag.query_windows(transcript)) > 1
+    titles = [h["title"] for h in res["hits"]]
+    assert titles[0] == "フーリエ"
+    assert "固有値" in titles  # 末尾でしか話していない話題も拾う
+    # 重なった窓が同じチャンクを引いても1件にまとまり、引いた窓の数が残る
+    assert len(titles) == len(set(titles))
+    assert all(1 <= h["_windows"] <= res["windows"] for h in res["hits"])
+
+
+def test_transcript_search_namespace_and_cache(rag_tenant):
+    index_material("フーリエ", [TOPICS["フーリエ"]], ns=["course:信号処理"])
+    index_material("固有値", [TOPICS["固有値"]], ns=["course:線形代数"])
+    transcript = _lecture("フーリエ", "固有値")
+
+    res = rag.transcript_search(transcript, top_k=3, namespace="course:線形代数")
+    assert [h["title"] for h in res["hits"]] == ["固有値"]
+    again = rag.transcript_search(transcript, top_k=3, namespace="course:線形代数")
+    assert again.get("cached") and again["hits"] == res["hits"]
+
+    index_material("確率", [TOPICS["確率"]], ns=["course:線形代数"])  # 索引が変われば計算し直す
+    fresh = rag.transcript_search(transcript, top_k=3, namespace="course:線形代数")
+    assert not fresh.get("cached")
+    assert {h["title"] for h in fresh["hits"]} == {"固有値", "確率"}
+
+
+def test_transcript_search_empty(rag_tenant):
+    assert rag.transcript_search("", top_k=3)["hits"] == []
+    index_material("確率", [TOPICS["確率"]])
+    assert rag.transcript_search("", top_k=3) == {"hits": [], "latency_ms": {"total": 0.0}, "windows": 0}
+
+
+def test_query_embedding_and_result_cache(rag_tenant, monkeypatch):
+    from backend.embedder import BatchEncoder
+    from conftest import hash_encode
+
+    encoded = []
+    monkeypatch.setattr(rag, "_encoder", BatchEncoder(lambda ts: encoded.extend(ts) or hash_encode(ts), enabled=False))
+    index_material("フーリエ", [TOPICS["フーリエ"]])
+    encoded.clear()
+
+    first = rag.hybrid_search("フーリエ変換 とは", top_k=3)
+    assert not first.get("cached")
+    again = rag.hybrid_search("  フーリエ変換　とは ", top_k=3)  # 正規化すると同じクエリ
+    assert again.get("cached") and again["hits"] == first["hits"]
+    again["hits"][0]["title"] = "書き換え"  # 返した結果を書き換えてもキャッシュは変わらない
+    assert rag.hybrid_search("フーリエ変換 とは", top_k=3)["hits"] == first["hits"]
+    assert encoded == ["フーリエ変換 とは"]
+
+    index_material("固有値", [TOPICS["固有値"]])  # 索引の世代が変わると結果は作り直す（埋め込みは再利用）
+    fresh = rag.hybrid_search("フーリエ変換 とは", top_k=3)
+    assert not fresh.get("cached") and len(fresh["hits"]) == 2
+    assert encoded.count("フーリエ変換 とは") == 1
+
+
+def test_result_cache_disabled(rag_tenant, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_RESULT_TTL", 0)
+    index_material("確率", [TOPICS["確率"]])
+    rag.hybrid_search("期待値", top_k=1)
+    assert not rag.hybrid_search("期待値", top_k=1).get("cached")
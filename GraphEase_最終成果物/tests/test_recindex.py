@@ -0,0 +1,87 @@
+import pytest
+
+pytest.importorskip("sentence_transformers")  # recindex は rag（埋め込みモデル）を使う
+
+import backend.storage as storage  # noqa: E402
+from backend import recindex, tenants  # noqa: E402
+
+SEGMENTS = [
+    {"start": 0.0, "end": 4.0, "text": "今日はフーリエ変換を導入します。"},
+    {"start": 4.0, "end": 9.5, "text": "周期関数を三角関数の和で表します。"},
+    {"start": 9.5, "end": 15.0, "text": "次に固有値と固有ベクトルを求めます。"},
+    {"start": 15.0, "end": 21.0, "text": "最後に確率分布の期待値を計算します。"},
+]
+
+
+def _record(rid: str, segments=SEGMENTS, transcript=None):
+    return {"id": rid, "title": rid, "summary": "", "segments": [dict(s) for s in segments],
+            "transcript": transcript if transcript is not None else "".join(s["text"] for s in segments)}
+
+
+@pytest.fixture
+def recs(rag_tenant, monkeypatch):
+    # 録音ストアはメモリ、区間索引は rag_tenant のテナント（tmp_path 下）
+    st = storage.MemoryStore()
+    monkeypatch.setattr(storage, "_stores", tenants.TenantMap(lambda t: st, idle_sec=None))
+    monkeypatch.setattr(storage, "_record_listeners", [recindex.enqueue])
+    monkeypatch.setattr(recindex, "RAG_REC_UNIT", 20)  # 1区間 = 1行
+    yield st
+    assert recindex.wait_idle(timeout=30)
+    recindex._managers.evict_idle(now=float("inf"))
+    st.close()
+
+
+def test_units_follow_segments_and_edits(monkeypatch):
+    monkeypatch.setattr(recindex, "RAG_REC_UNIT", 40)
+    units = recindex.recording_units(_record("r"))
+    assert [(u["start"], u["end"]) for u in units] == [(0.0, 9.5), (9.5, 21.0)]  # 40 文字程度ずつ束ねる
+
+    monkeypatch.setattr(recindex, "RAG_REC_UNIT", 20)
+    edited = _record("r", transcript="今日はフーリエ変換を導入します。周期関数を正弦波の和で表します。"
+                                     "次に固有値と固有ベクトルを求めます。最後に確率分布の期待値を計算します。")
+    units = recindex.recording_units(edited)
+    assert [u["text"] for u in units][1] == "周期関数を正弦波の和で表します。"
+    assert (units[1]["start"], units[1]["end"]) == (4.0, 9.5)  # 編集された区間は元の時間帯を引き継ぐ
+    assert [(u["start"], u["end"]) for u in units[2:]] == [(9.5, 15.0), (15.0, 21.0)]
+
+    no_segments = recindex.recording_units(_record("r", segments=[], transcript="区間の無い転写。"))
+    assert no_segments == [{"text": "区間の無い転写。", "start": None, "end": None}]
+
+
+def test_added_records_are_searchable(recs):
+    storage.add_record(_record("lec-1"))
+    storage.add_record(_record("lec-2", segments=[{"start": 30.0, "end": 40.0, "text": "確率分布の分散を求めます。"}]))
+    assert recindex.wait_idle(timeout=30)
+
+    hits = recindex.search("固有値と固有ベクトル", top_k=3)["hits"]
+    assert (hits[0]["id"], hits[0]["start"], hits[0]["end"]) == ("lec-1", 9.5, 15.0)
+    ids = {(h["id"], h["start"]) for h in recindex.search("確率分布", top_k=5)["hits"]}
+    assert {("lec-1", 15.0), ("lec-2", 30.0)} <= ids  # 全録音の区間から探す
+    assert recindex.stats()["live"] == 5
+
+
+def test_transcript_edit_updates_only_changed_units(recs):
+    storage.add_record(_record("lec-1"))
+    assert recindex.wait_idle(timeout=30)
+    assert recindex.index_recording("lec-1") == {"id": "lec-1", "units": 4, "added": 0, "removed": 0}
+
+    transcript = "".join(s["text"] for s in SEGMENTS).replace("固有値と固有ベクトル", "行列の対角化の手順")
+    storage.update_fields("lec-1", {"summary": "要約だけ"})  # 転写が変わらない更新では予約しない
+    assert not recindex._pending
+    storage.update_fields("lec-1", {"transcript": transcript})
+    assert recindex.wait_idle(timeout=30)
+
+    assert recindex.stats()["live"] == 4
+    hit = recindex.search("行列の対角化", top_k=1)["hits"][0]
+    assert (hit["id"], hit["start"], hit["end"]) == ("lec-1", 9.5, 15.0)
+    texts = {h["text"] for h in recindex.search("固有ベクトル", top_k=10)["hits"]}
+    assert "次に固有値と固有ベクトルを求めます。" not in texts
+    assert recindex.index_recording("lec-1")["added"] == 0  # もう差分は無い
+
+
+def test_missing_record_is_dropped(recs, monkeypatch):
+    storage.add_record(_record("lec-1"))
+    assert recindex.wait_idle(timeout=30)
+    monkeypatch.setattr(recindex, "get_record", lambda rid: None)  # 録音が無くなった
+    assert recindex.index_recording("lec-1") == {"id": "lec-1", "units": 0, "added": 0, "removed": 4}
+    assert recindex.search("フーリエ変換", top_k=3)["hits"] == []
@@ -0,0 +1,136 @@
+import pytest
+from backend.search import MIN_DOCS_FOR_DF_CUT, NgramIndex, match_segments, ngrams, normalize
+
+
+def _total_len(idx: NgramIndex) -> int:
+    # doc_grams から数え直した値（total_len の差分更新と一致するはず）
+    return sum(sum(c.values()) for c in idx.doc_grams.values())
+
+
+def test_total_len_add_replace_remove():
+    idx = NgramIndex()
+    idx.add("a", "機械学習の基礎")
+    idx.add("b", "線形代数")
+    assert idx.total_len == _total_len(idx) == 6 + 3
+
+    idx.add("a", "統計")  # 置き換え
+    assert idx.total_len == _total_len(idx) == 1 + 3
+    assert "機械" not in idx.postings
+
+    idx.remove("b")
+    idx.remove("b")  # 2回目は何もしない
+    idx.remove("missing")
+    assert idx.total_len == _total_len(idx) == 1
+    assert len(idx) == 1
+    assert set(idx.postings) == {"統計"}
+
+    idx.add("a", "   ")  # 空になる置き換えは削除と同じ
+    assert idx.total_len == 0 and len(idx) == 0 and idx.postings == {}
+
+
+def test_bm25_ordering():
+    idx = NgramIndex()
+    idx.add("many", "フーリエ変換とフーリエ級数。フーリエの話")
+    idx.add("once", "フーリエ変換について" + "あいうえお" * 10)
+    idx.add("none", "ラプラス変換")
+    ranked = idx.search("フーリエ")
+    assert [d for d, _ in ranked] == ["many", "once"]
+    assert ranked[0][1] > ranked[1][1] > 0
+
+    # 同じ出現回数なら短い文書が上（文書長の正規化）
+    idx2 = NgramIndex()
+    idx2.add("short", "行列式")
+    idx2.add("long", "行列式" + "の性質をいろいろ調べる" * 5)
+    assert [d for d, _ in idx2.search("行列式")] == ["short", "long"]
+
+    # 珍しい gram の方が効く（idf）
+    idx3 = NgramIndex()
+    for i in range(5):
+        idx3.add(f"common{i}", "講義ノート")
+    idx3.add("rare", "固有値の講義")
+    assert idx3.search("固有値講義")[0][0] == "rare"
+
+
+def test_search_top_k_and_allowed():
+    idx = NgramIndex()
+    for i in range(5):
+        idx.add(i, "微分方程式" * (i + 1))
+    assert len(idx.search("微分", top_k=3)) == 3
+    assert idx.search("微分", top_k=0) == []
+    assert {d for d, _ in idx.search("微分", allowed={1, 3})} == {1, 3}
+    assert idx.search("") == []
+    assert NgramIndex().search("微分") == []
+
+
+def test_max_df_ratio_cutoff():
+    idx = NgramIndex()
+    n = MIN_DOCS_FOR_DF_CUT
+    for i in range(n):
+        idx.add(i, f"ですます調の文{i}")
+    idx.add("x", "ですます量子力学")
+    # 「です」「すま」…はほぼ全文書に出るので飛ばされ、量子力学だけで採点される
+    cut = idx.search("ですます量子", max_df_ratio=0.5)
+    assert [d for d, _ in cut] == ["x"]
+    # 打ち切らなければ他の文書も出てくる
+    assert len(idx.search("ですます量子", top_k=100)) == n + 1
+
+
+def test_max_df_ratio_ignored_for_small_index():
+    idx = NgramIndex()
+    for i in range(MIN_DOCS_FOR_DF_CUT - 1):
+        idx.add(i, "ですます")
+    # 文書数が少ないうちは全 gram が飛ばないようにする
+    assert len(idx.search("ですます", top_k=100, max_df_ratio=0.1)) == MIN_DOCS_FOR_DF_CUT - 1
+
+
+def test_single_char_query():
+    idx = NgramIndex()
+    idx.add("a", "確率")
+    idx.add("b", "率直")
+    idx.add("c", "統計")
+    assert {d for d, _ in idx.search("率")} == {"a", "b"}
+    # 1文字だけの文書も拾える
+    idx.add("d", "率")
+    assert "d" in {d for d, _ in idx.search("率")}
+
+
+def test_normalize_width_and_case():
+    assert normalize("ＡＢＣ ａｂｃ\n１２") == "abcabc12"
+    idx = NgramIndex()
+    idx.add("a", "ＰＹＴＨＯＮ入門")
+    assert idx.search("python")[0][0] == "a"
+    assert ngrams("a") == ["a"]
+    assert ngrams("") == []
+
+
+SEGMENTS = [
+    {"start": 0.0, "end": 2.5, "text": "今日はフーリエ変換を扱います"},
+    {"start": 2.5, "end": 5.0, "text": "フーリエ級数の復習から"},
+    {"start": 5.0, "end": 7.0, "text": "ラプラス変換は来週"},
+    {"start": 7.0, "end": 9.0, "text": ""},
+]
+
+
+def test_match_segments_exact_first():
+    hits = match_segments(SEGMENTS, "フーリエ変換")
+    assert hits[0] == {"start": 0.0, "end": 2.5, "text": "今日はフーリエ変換を扱います", "score": 1.0}
+    # 部分一致（n-gram 一致率 >= 0.6）は後ろに並ぶ
+    assert [h["start"] for h in hits] == [0.0, 2.5]
+    assert 0.6 <= hits[1]["score"] < 1.0
+
+
+def test_match_segments_overlap_and_limit():
+    assert match_segments(SEGMENTS, "変換") == [
+        {"start": 0.0, "end": 2.5, "text": "今日はフーリエ変換を扱います", "score": 1.0},
+        {"start": 5.0, "end": 7.0, "text": "ラプラス変換は来週", "score": 1.0},
+    ]
+    assert len(match_segments(SEGMENTS, "変換", limit=1)) == 1
+    assert match_segments(SEGMENTS, "フーリエ変換", min_overlap=1.0) == match_segments(SEGMENTS, "フーリエ変換")[:1]
+    assert match_segments(SEGMENTS, "ＦＦＴ") == []
+    assert match_segments(SEGMENTS, "  ") == []
+    assert match_segments(None, "変換") == []
+
+
+@pytest.mark.parametrize("query", ["ふーりえ", "量子"])
+def test_match_segments_no_hit(query):
+    assert match_segments(SEGMENTS, query) == []
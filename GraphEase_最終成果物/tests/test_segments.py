@@ -0,0 +1,70 @@
+import pytest
+from backend.segments import SegmentArray, compact, to_jsonable
+
+SEGS = [
+    {"start": 2.5, "end": 5.0, "text": "二つ目"},
+    {"start": 0.1, "end": 2.5, "text": "一つ目"},
+    {"start": 7.1234567, "end": 9.87654, "text": "隙間の後"},
+]
+
+
+def test_roundtrip_sorted_and_rounded():
+    segs = SegmentArray.from_list(SEGS)
+    assert len(segs) == 3
+    assert segs.to_list() == [
+        {"start": 0.1, "end": 2.5, "text": "一つ目"},
+        {"start": 2.5, "end": 5.0, "text": "二つ目"},
+        {"start": 7.123, "end": 9.877, "text": "隙間の後"},
+    ]
+    assert segs[-1]["text"] == "隙間の後"
+    with pytest.raises(IndexError):
+        segs[3]
+
+
+@pytest.mark.parametrize("t,expected", [
+    (0.0, -1),
+    (0.0994, -1),
+    (0.1, 0),       # float32 だと 0.1 < 0.100000001 で取りこぼしていた
+    (1.0, 0),
+    (2.4994, 0),
+    (2.5, 1),       # 前の区間の end と次の start が同じなら後ろの区間
+    (5.0, 1),
+    (5.001, -1),    # 隙間
+    (7.1234, 2),
+    (9.877, 2),
+    (9.878, -1),
+])
+def test_index_at_boundaries(t, expected):
+    assert SegmentArray.from_list(SEGS).index_at(t) == expected
+
+
+def test_rounded_bounds_sent_back_hit_same_segment():
+    # API が返した start/end（小数3桁）をそのまま segment_at に渡しても同じ区間になる
+    segs = SegmentArray.from_list(
+        [{"start": i * 0.1 + 0.0123456, "end": i * 0.1 + 0.0876543, "text": str(i)} for i in range(2000)]
+    )
+    for i, s in enumerate(segs):
+        assert segs.index_at(s["start"]) == i
+        assert segs.index_at(s["end"]) == i
+        assert segs.segment_at(s["start"])["text"] == str(i)
+
+
+def test_long_recording_keeps_millisecond_precision():
+    # 3時間を超えても（float32 なら刻みが 1ms 近くになる）ミリ秒で引ける
+    segs = SegmentArray.from_list([
+        {"start": 10800.0, "end": 10800.001, "text": "a"},
+        {"start": 10800.002, "end": 10800.003, "text": "b"},
+    ])
+    assert segs.index_at(10800.001) == 0
+    assert segs.index_at(10800.0015) == 1  # ミリ秒に丸めると 10800.002
+    assert segs.segment_at(10800.002)["text"] == "b"
+    assert segs.to_list()[1] == {"start": 10800.002, "end": 10800.003, "text": "b"}
+
+
+def test_empty_and_helpers():
+    empty = compact(None)
+    assert len(empty) == 0 and empty.index_at(1.0) == -1 and empty.segment_at(1.0) is None
+    segs = compact(SEGS)
+    assert compact(segs) is segs
+    assert to_jsonable(segs) == segs.to_list()
+    assert to_jsonable(None) == []
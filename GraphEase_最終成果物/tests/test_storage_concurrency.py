@@ -0,0 +1,139 @@
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+import backend.reminders as reminders
+import backend.storage as storage
+import pytest
+from backend import tenants
+from backend.locks import FileLock
+
+WRITERS = 8
+UPDATES = 40
+ADDERS = 4
+REMINDERS_PER_ADDER = 25
+SENDERS = 4
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path, monkeypatch):
+    # 既定テナントのストアだけを差し替える（data/ は触らない）
+    db = str(tmp_path / "preppal.db")
+    st = storage.MemoryStore() if request.param == "memory" else storage.SqliteStore(db)
+    monkeypatch.setattr(tenants, "TENANTS_DIR", str(tmp_path / "tenants"))
+    monkeypatch.setattr(storage, "STORAGE_DB", db)
+    monkeypatch.setattr(storage, "SHARED", st.shared)
+    monkeypatch.setattr(storage, "_stores", tenants.TenantMap(lambda t: st, idle_sec=None))
+    monkeypatch.setattr(storage, "_record_listeners", [])
+    yield st
+    st.close()
+
+
+def _run(threads):
+    errors = []
+
+    def wrap(fn):
+        def run():
+            try:
+                fn()
+            except BaseException as e:  # スレッド内の失敗をテストに伝える
+                errors.append(e)
+        return run
+
+    ts = [threading.Thread(target=wrap(fn)) for fn in threads]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join(timeout=120)
+    assert not any(t.is_alive() for t in ts)
+    if errors:
+        raise errors[0]
+
+
+def test_concurrent_updates_reminders_and_listeners(store, tmp_path, monkeypatch):
+    notified = []
+    storage.add_record_listener(notified.append)
+    rid = "rec-1"
+    storage.add_record({"id": rid, "title": "t", "summary": "s0", "transcript": "", "segments": []})
+
+    sent = Counter()
+
+    def fake_send_email(to, subject, body):
+        sent[to] += 1
+        return True
+
+    monkeypatch.setattr(reminders, "send_email", fake_send_email)
+    due = datetime.utcnow() - timedelta(seconds=1)
+    lock_path = str(tmp_path / "reminders.lock")
+    adders_done = threading.Event()
+    n_adders_left = [ADDERS]
+    adders_lock = threading.Lock()
+
+    def writer(i):
+        def run():
+            for j in range(UPDATES):
+                fields = {f"w{i}": j, "summary": f"{i}-{j}"}
+                if j % 4 == 0:
+                    fields["transcript"] = f"transcript {i}-{j}"  # リスナーに通知される更新
+                assert storage.update_fields(rid, fields) is not None
+        return run
+
+    def adder(i):
+        def run():
+            for j in range(REMINDERS_PER_ADDER):
+                storage.add_reminder({"id": uuid.uuid4().hex, "email": f"{i}-{j}@example.com",
+                                      "due_at": due, "recording_id": rid, "title": "t", "sent": False})
+            with adders_lock:
+                n_adders_left[0] -= 1
+                if not n_adders_left[0]:
+                    adders_done.set()
+        return run
+
+    def sender():
+        # 各送信者は別々のファイルロックでリーダーを取り合い、1周ごとに手放す（リーダー交代の再現）
+        lock = FileLock(lock_path)
+        while True:
+            finished = adders_done.is_set()
+            if lock.acquire(blocking=False):
+                try:
+                    reminders._send_due()
+                finally:
+                    lock.release()
+            if finished:
+                return
+
+    _run([writer(i) for i in range(WRITERS)] + [adder(i) for i in range(ADDERS)] + [sender] * SENDERS)
+    with FileLock(lock_path):
+        reminders._send_due()  # 取り残しがあれば送る
+
+    # 更新が失われていない：各スレッドの最後の書き込みがすべて残り、版も全件ある
+    rec = storage.get_record(rid)
+    for i in range(WRITERS):
+        assert rec[f"w{i}"] == UPDATES - 1
+    assert len(storage.list_versions(rid)["summary"]) == 1 + WRITERS * UPDATES
+    assert storage.get_version(rid, "summary", 0) == "s0"
+    assert rec["summary"] in {f"{i}-{UPDATES - 1}" for i in range(WRITERS)}
+
+    # リスナーは追加 1 回 + transcript を変えた更新の回数だけ呼ばれる
+    assert notified.count(rid) == 1 + WRITERS * len(range(0, UPDATES, 4))
+
+    # リマインドは全件ちょうど 1 回ずつ送られる
+    assert len(sent) == ADDERS * REMINDERS_PER_ADDER
+    assert set(sent.values()) == {1}
+    assert storage.iter_due_reminders(datetime.utcnow()) == []
+
+
+def test_search_index_follows_concurrent_updates(store):
+    rids = [f"r{i}" for i in range(WRITERS)]
+    for rid in rids:
+        storage.add_record({"id": rid, "title": "", "summary": "", "transcript": "", "segments": []})
+
+    def writer(rid):
+        def run():
+            for j in range(UPDATES):
+                storage.update_fields(rid, {"summary": f"版{j}" + ("最終" if j == UPDATES - 1 else "")})
+        return run
+
+    _run([writer(rid) for rid in rids])
+    assert sorted(d for d, _ in storage.search_records("最終", top_k=100)) == sorted(rids)
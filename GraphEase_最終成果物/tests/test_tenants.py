@@ -0,0 +1,155 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import backend.storage as storage
+import pytest
+from backend import tenants
+
+
+# ---------- HTTP：テナントの決定・上限 ----------
+@pytest.fixture
+def client(monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")  # TestClient が使う
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(tenants, "TENANT_MAX_INFLIGHT", 1)
+    app = FastAPI()
+    app.middleware("http")(tenants.http_middleware)
+    app.add_exception_handler(tenants.QuotaExceeded, tenants.quota_response)
+    release = threading.Event()
+    entered = threading.Event()
+
+    @app.get("/who")
+    def who():
+        return {"tenant": tenants.current()}
+
+    @app.get("/full")
+    def full():
+        tenants.check_quota("records", 5, 5)
+
+    @app.get("/slow")
+    def slow():
+        entered.set()
+        release.wait(10)
+        return {"tenant": tenants.current()}
+
+    c = TestClient(app)
+    c.release, c.entered = release, entered
+    yield c
+    release.set()
+
+
+def test_header_selects_tenant(client):
+    assert client.get("/who").json() == {"tenant": tenants.DEFAULT_TENANT}
+    assert client.get("/who", headers={tenants.TENANT_HEADER: "school-a"}).json() == {"tenant": "school-a"}
+    r = client.get("/who", headers={tenants.TENANT_HEADER: "../etc"})
+    assert r.status_code == 400 and r.json()["ok"] is False
+
+
+def test_quota_exceeded_is_429(client):
+    r = client.get("/full", headers={tenants.TENANT_HEADER: "school-a"})
+    assert r.status_code == 429
+    assert "records quota exceeded" in r.json()["error"] and "school-a" in r.json()["error"]
+
+
+def test_inflight_limit_is_per_tenant(client):
+    a = {tenants.TENANT_HEADER: "school-a"}
+    first = {}
+    th = threading.Thread(target=lambda: first.update(r=client.get("/slow", headers=a)))
+    th.start()
+    assert client.entered.wait(10)
+    busy = client.get("/who", headers=a)
+    assert busy.status_code == 429 and busy.headers["Retry-After"] == "1"
+    assert client.get("/who", headers={tenants.TENANT_HEADER: "school-b"}).status_code == 200  # 他の学校は通る
+    client.release.set()
+    th.join(10)
+    assert first["r"].json() == {"tenant": "school-a"}
+    assert client.get("/who", headers=a).status_code == 200  # 終われば枠が空く
+    assert not tenants.in_use("school-a")
+
+
+# ---------- テナントごとのストア：分離・上限・メモリから外して読み直す ----------
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(tenants, "TENANTS_DIR", str(tmp_path / "tenants"))
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(storage, "STORAGE_DB", str(tmp_path / "preppal.db"))
+    m = tenants.TenantMap(storage._open_store, close=lambda s: s.close(), idle_sec=60, name="storage")
+    monkeypatch.setattr(storage, "_stores", m)
+    monkeypatch.setattr(storage, "_record_listeners", [])
+    yield m
+    m.close_all()
+
+
+def _add(rid: str, summary: str):
+    storage.add_record({"id": rid, "title": rid, "summary": summary, "transcript": "転写 " + rid,
+                        "segments": [{"start": 0.0, "end": 1.5, "text": "転写 " + rid}]})
+
+
+def test_records_are_isolated_per_tenant(stores):
+    with tenants.scope("school-a"):
+        _add("a1", "A の要約")
+    with tenants.scope("school-b"):
+        _add("b1", "B の要約")
+        assert [r["id"] for r in storage.list_records_light()] == ["b1"]
+        assert storage.get_record("a1") is None
+        assert {rid for rid, _ in storage.search_records("転写")} == {"b1"}
+    with tenants.scope("school-a"):
+        assert [r["id"] for r in storage.list_records_light()] == ["a1"]
+    assert sorted(stores.stats()["loaded"]) == ["school-a", "school-b"]
+
+
+def test_record_quota_per_tenant(stores, monkeypatch):
+    monkeypatch.setattr(tenants, "TENANT_MAX_RECORDS", 2)
+    with tenants.scope("school-a"):
+        _add("a1", "s")
+        _add("a2", "s")
+        with pytest.raises(tenants.QuotaExceeded):
+            storage.check_record_quota()
+    with tenants.scope("school-b"):
+        storage.check_record_quota()  # 他の学校には影響しない
+
+
+def test_evicted_tenant_reloads_intact(stores):
+    with tenants.scope("school-a"):
+        _add("a1", "第1版")
+        storage.update_fields("a1", {"summary": "第2版"})
+    with tenants.scope("school-b"):
+        _add("b1", "B")
+
+    with tenants.scope("school-b"):  # 使用中のテナントは外さない
+        gone = stores.evict_idle(now=time.monotonic() + 120)
+    assert gone == ["school-a"]
+    assert stores.evict_idle(now=time.monotonic() + 120) == ["school-b"]
+    assert stores.stats()["loaded"] == [] and stores.evictions == 2
+
+    with tenants.scope("school-a"):  # DB ファイルから読み直す
+        rec = storage.get_record("a1")
+        assert (rec["summary"], rec["transcript"]) == ("第2版", "転写 a1")
+        assert [(s["start"], s["end"], s["text"]) for s in rec["segments"]] == [(0.0, 1.5, "転写 a1")]
+        assert storage.get_version("a1", "summary", 0) == "第1版"
+        assert [rid for rid, _ in storage.search_records("転写 a1")][:1] == ["a1"]
+    assert stores.stats()["loaded"] == ["school-a"] and stores.loads == 3
+    assert stores.evict_idle() == []  # 使われたばかり
+
+
+def test_reminder_sweep_keeps_tenant_loaded(stores):
+    now = datetime.now()
+    with tenants.scope("school-a"):
+        storage.add_reminder({"id": "r1", "due_at": now - timedelta(minutes=1), "sent": False})
+    st = stores.peek("school-a")
+    real = st.iter_due_reminders
+
+    def evict_while_reading(t):
+        assert stores.evict_idle(now=time.monotonic() + 120) == []  # 送信の途中で閉じられない
+        return real(t)
+
+    st.iter_due_reminders = evict_while_reading
+    due = storage.iter_due_reminders(now)
+    assert [(r["id"], r["tenant"]) for r in due] == [("r1", "school-a")]
+    storage.mark_reminder_sent("r1", tenant="school-a")
+    assert stores.peek("school-a") is st and storage.iter_due_reminders(now) == []
+    assert not tenants.in_use("school-a")
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("gtts")
+
+from backend.tts import TTSCache  # noqa: E402
+
+SIZE = 100  # 1件あたりのバイト数
+
+
+class FakeSynth:
+    """gTTS の代わり：本文ごとに SIZE バイト書く。呼ばれた本文を記録する"""
+
+    def __init__(self, delay: float = 0.0):
+        self.calls = []
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str):
+        def write(f):
+            with self._lock:
+                self.calls.append(text)
+            time.sleep(self.delay)
+            f.write(text.encode("utf-8")[:SIZE].ljust(SIZE, b"\0"))
+        return write
+
+
+def _get(cache: TTSCache, synth: FakeSynth, text: str, lang: str = "ja", voice: str = "com") -> str:
+    return cache.get_or_create("gtts", lang, voice, text, synth(text))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return TTSCache(str(tmp_path / "tts"), max_bytes=int(2.5 * SIZE), min_age=0)
+
+
+def test_hit_and_miss(cache):
+    synth = FakeSynth()
+    p1 = _get(cache, synth, "こんにちは")
+    p2 = _get(cache, synth, "こんにちは")
+    assert p1 == p2 and os.path.getsize(p1) == SIZE
+    assert synth.calls == ["こんにちは"]
+    st = cache.stats()
+    assert (st["entries"], st["bytes"], st["hits"], st["misses"], st["hit_rate"]) == (1, SIZE, 1, 1, 0.5)
+
+
+def test_evicts_least_recently_used(cache):
+    synth = FakeSynth()
+    a = _get(cache, synth, "a")
+    b = _get(cache, synth, "b")
+    time.sleep(0.01)
+    assert cache.lookup(TTSCache.make_key("gtts", "ja", "com", "a")) == a  # a を使ったので古いのは b
+    time.sleep(0.01)
+    c = _get(cache, synth, "c")  # 3件（300 バイト）> 上限 250 バイト
+    assert os.path.exists(a) and os.path.exists(c) and not os.path.exists(b)
+    st = cache.stats()
+    assert (st["entries"], st["bytes"], st["evictions"]) == (2, 2 * SIZE, 1)
+    _get(cache, synth, "b")  # 消えたものは作り直す
+    assert synth.calls == ["a", "b", "c", "b"]
+
+
+def test_recently_used_entries_are_kept(tmp_path):
+    cache = TTSCache(str(tmp_path / "tts"), max_bytes=SIZE, min_age=60)
+    synth = FakeSynth()
+    paths = [_get(cache, synth, t) for t in "abc"]
+    assert all(os.path.exists(p) for p in paths)  # 他ワーカーが返している途中かもしれない間は消さない
+    assert cache.stats()["evictions"] == 0
+
+
+def test_key_includes_language_and_voice(cache):
+    synth = FakeSynth()
+    voices = [("ja", "com"), ("en", "com"), ("en", "co.uk")]
+    paths = {_get(cache, synth, "hello", lang, voice) for lang, voice in voices}
+    assert len(paths) == 3 and len(synth.calls) == 3
+
+
+def test_identical_concurrent_requests_synthesize_once(tmp_path):
+    cache = TTSCache(str(tmp_path / "tts"), max_bytes=10 * SIZE, min_age=0)
+    synth = FakeSynth(delay=0.05)
+    out = []
+    start = threading.Barrier(8)
+
+    def run():
+        start.wait()
+        out.append(_get(cache, synth, "同じ本文"))
+
+    ts = [threading.Thread(target=run) for _ in range(8)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    assert synth.calls == ["同じ本文"] and len(set(out)) == 1
+    st = cache.stats()
+    assert (st["hits"], st["misses"]) == (7, 1)
+    assert cache._key_locks == {}  # 待ち合わせ用のロックは残らない
+
+
+def test_failed_synthesis_leaves_no_files(cache):
+    def broken(f):
+        f.write(b"half")
+        raise RuntimeError("network error")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_create("gtts", "ja", "com", "失敗", broken)
+    assert not [n for n in os.listdir(cache.root) if ".mp3" in n]  # 一時ファイルも残らない
+    assert cache.stats()["entries"] == 0
+    synth = FakeSynth()
+    assert os.path.getsize(_get(cache, synth, "失敗")) == SIZE  # 次は合成し直す
+
+
+def test_shared_between_instances_and_missing_file(tmp_path):
+    root = str(tmp_path / "tts")
+    first, other = TTSCache(root, 10 * SIZE, 0), TTSCache(root, 10 * SIZE, 0)  # 別ワーカー相当
+    synth = FakeSynth()
+    path = _get(first, synth, "共有")
+    assert _get(other, synth, "共有") == path and synth.calls == ["共有"]
+    os.remove(path)  # 手で消された
+    assert _get(other, synth, "共有") == path and os.path.exists(path)
+    assert synth.calls == ["共有", "共有"]
@@ -0,0 +1,98 @@
+import json
+import random
+
+import backend.storage as storage
+import pytest
+from backend.versions import KEYFRAME_EVERY, VersionLog, apply_delta, describe, make_delta
+
+SENTENCES = ["フーリエ変換を導入する。", "例題を解く！", "質問はあるか？", "Today we start.", "\n", "次回は小テスト",
+             "固有値の定義。", "行列の対角化。", ""]
+
+
+def _texts(n: int, seed: int = 0):
+    # 文の追加・削除・置き換えを繰り返した版の列
+    rnd = random.Random(seed)
+    cur = []
+    out = []
+    for _ in range(n):
+        op = rnd.random()
+        if cur and op < 0.3:
+            del cur[rnd.randrange(len(cur))]
+        elif cur and op < 0.6:
+            cur[rnd.randrange(len(cur))] = rnd.choice(SENTENCES)
+        else:
+            cur.insert(rnd.randrange(len(cur) + 1), rnd.choice(SENTENCES))
+        out.append("".join(cur))
+    return out
+
+
+@pytest.mark.parametrize("a,b", [
+    ("", ""),
+    ("", "新しい要約。"),
+    ("古い要約。", ""),
+    ("第1文。第2文。第3文。", "第1文。第2文を直した。第3文。"),
+    ("終端なし", "終端なしに追記"),
+    ("A.\nB?\nC!", "C!\nA.\n"),
+])
+def test_delta_roundtrip(a, b):
+    ops = make_delta(a, b)
+    assert apply_delta(a, ops) == b
+    assert apply_delta(a, json.loads(json.dumps(ops))) == b  # JSON で保存しても戻せる
+
+
+def test_delta_roundtrip_random_edits():
+    texts = _texts(200, seed=1)
+    for a, b in zip(texts, texts[1:]):
+        assert apply_delta(a, make_delta(a, b)) == b
+
+
+def test_delta_stores_only_changes():
+    old = "".join(f"第{i}文。" for i in range(100))
+    new = old.replace("第50文。", "第50文を修正。")
+    ops = make_delta(old, new)
+    assert sum(len(v) for op, v in ops if op == "+") == len("第50文を修正。")
+
+
+def test_version_log_across_keyframes():
+    texts = _texts(3 * KEYFRAME_EVERY + 3, seed=2)
+    log = VersionLog()
+    for i, t in enumerate(texts):
+        assert log.append(t) == i
+    assert len(log) == len(texts)
+    for v, t in enumerate(texts):
+        assert log.get(v) == t
+    assert log.get(-1) is None and log.get(len(texts)) is None
+
+    summary = log.summary()
+    assert [e["v"] for e in summary] == list(range(len(texts)))
+    assert [v for v, e in enumerate(summary) if e["keyframe"]] == list(range(0, len(texts), KEYFRAME_EVERY))
+    assert all(e["stored_chars"] == len(texts[e["v"]]) for e in summary if e["keyframe"])
+
+
+def test_describe_counts_inserted_chars_only():
+    e = {"v": 1, "at": "t", "key": False, "data": [["=", 10], ["-", 3], ["+", "abc"]]}
+    assert describe(e) == {"v": 1, "at": "t", "keyframe": False, "stored_chars": 3}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    st = storage.MemoryStore() if request.param == "memory" else storage.SqliteStore(str(tmp_path / "v.db"))
+    yield st
+    st.close()
+
+
+def test_store_versions_across_keyframes(store):
+    texts = [t + f"（第{i}版）" for i, t in enumerate(_texts(2 * KEYFRAME_EVERY + 5, seed=3))]
+    store.add_record({"id": "r", "title": "t", "summary": texts[0], "transcript": "転写", "segments": []})
+    for t in texts[1:]:
+        store.update_fields("r", {"summary": t})
+    store.update_fields("r", {"summary": texts[-1]})  # 変わらない更新は版を増やさない
+    store.update_fields("r", {"title": "題名だけ"})
+
+    listed = store.list_versions("r")
+    assert [e["v"] for e in listed["summary"]] == list(range(len(texts)))
+    assert [e["v"] for e in listed["transcript"]] == [0]
+    for v, t in enumerate(texts):
+        assert store.get_version("r", "summary", v) == t
+    assert store.get_version("r", "summary", len(texts)) is None
+    assert store.get_version("r", "transcript", 0) == "転写"